@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Minimal client for the smart socket protocol of the adb server (default localhost:5037), so commands
+## can be sent to a device without forking the adb binary. A request is the length as 4 hex digits
+## followed by the payload, the server answers with OKAY or FAIL (followed by a length prefixed message).
+## After 'host:transport:<serial>' the connection is bound to the device and exactly one device service
+## (eg 'shell:<command>') can be requested on it.
+
+import os
+import socket
+import select
+import uuid
+
+ADB_SERVER_HOST = "127.0.0.1"
+ADB_SERVER_PORT_DEFAULT = 5037
+ADB_SOCKET_TIMEOUT = 10
+EMULATOR_CONSOLE_AUTH_TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".emulator_console_auth_token")
+
+class AdbClientError(Exception):
+    pass
+
+## the command was already written to the device when the connection failed or timed out, it might have
+## run (or might still run), so it must not be sent again
+class AdbCommandSentError(AdbClientError):
+    pass
+
+def __recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AdbClientError("Connection to adb server closed")
+        data = data + chunk
+    return data
+
+def adb_send_request(sock, request):
+    payload = request.encode("utf-8")
+    sock.sendall(("%04x" % len(payload)).encode("ascii") + payload)
+
+    status = __recv_exactly(sock, 4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        message_len = int(__recv_exactly(sock, 4), 16)
+        raise AdbClientError("Request [%s] failed: %s" % (request, __recv_exactly(sock, message_len).decode("utf-8", errors="replace")))
+
+    raise AdbClientError("Unexpected answer [%s] for request [%s]" % (status, request))
+
+def adb_read_length_prefixed(sock):
+    return __recv_exactly(sock, int(__recv_exactly(sock, 4), 16)).decode("utf-8", errors="replace")
+
+def adb_recv_all(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data = data + chunk
+
+## a shell on the device which stays open for many commands, uses the 'exec:' service (no pty, raw
+## stdin/stdout, available since Android 5), the end of the output of every command is detected by
+## a unique marker followed by the exit code
+class AdbShellSession:
+    def __init__(self, client, serial):
+        self.serial = serial
+        self.__marker = "__jah_done_" + uuid.uuid4().hex + "_"
+        self.__timeout = client.timeout
+        self.__sock = client.open_device_service(serial, "exec:sh")
+        self.__reader = self.__sock.makefile('rb')
+
+    ## timeout: seconds the command may run without any output, None for the timeout of the client
+    def run(self, command, timeout=None):
+        self.__sock.settimeout(timeout if timeout is not None else self.__timeout)
+        try:
+            # subshell, so an 'exit' in the command does not end the session
+            self.__sock.sendall(("(" + command + "\n)\necho \"" + self.__marker + "$?\"\n").encode("utf-8"))
+
+            output_lines = []
+            while True:
+                line = self.__reader.readline()
+                if not line:
+                    raise AdbClientError("Shell session to [%s] closed" % self.serial)
+
+                line = line.decode("utf-8", errors="replace")
+                marker_pos = line.find(self.__marker)
+                if marker_pos >= 0:
+                    # output without trailing newline ends up in front of the marker
+                    output_lines.append(line[:marker_pos])
+                    return int(line[marker_pos + len(self.__marker):].strip()), "".join(output_lines)
+
+                output_lines.append(line)
+        except (OSError, ValueError, AdbClientError) as e:
+            raise AdbCommandSentError("Shell command [%s] on [%s] failed after it was sent: %s" % (command, self.serial, e)) from e
+
+    ## False if the device side closed the session (eg the emulator was restarted) or left unread output,
+    ## checked before a command is written, so a stale session is never used
+    def is_open(self):
+        try:
+            readable, writable, failed = select.select([ self.__sock ], [], [], 0)
+            return len(readable) == 0
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self.__sock.sendall(b"exit\n")
+        except OSError:
+            pass
+        self.__reader.close()
+        self.__sock.close()
+
+class AdbClient:
+    def __init__(self, host=ADB_SERVER_HOST, port=None, timeout=ADB_SOCKET_TIMEOUT):
+        if port is None:
+            port = int(os.getenv("ANDROID_ADB_SERVER_PORT", str(ADB_SERVER_PORT_DEFAULT)))
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        ## serial -> AdbShellSession, reused by shell()
+        self.__sessions = {}
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def is_server_available(self):
+        try:
+            sock = self.connect()
+            try:
+                adb_send_request(sock, "host:version")
+                adb_read_length_prefixed(sock)
+            finally:
+                sock.close()
+            return True
+        except (OSError, AdbClientError, ValueError):
+            return False
+
+    def __host_query(self, request):
+        sock = self.connect()
+        try:
+            adb_send_request(sock, request)
+            return adb_read_length_prefixed(sock)
+        finally:
+            sock.close()
+
+    ## list of (serial, state)
+    def devices(self):
+        devices = []
+        for line in self.__host_query("host:devices").splitlines():
+            splitted = line.split("\t")
+            if len(splitted) == 2:
+                devices = devices + [ (splitted[0], splitted[1]) ]
+        return devices
+
+    def get_state(self, serial):
+        return self.__host_query("host-serial:" + serial + ":get-state").strip()
+
+    ## returns a socket bound to the given service of the device, the caller has to close it. If the
+    ## connection fails after the service was requested, AdbCommandSentError is raised: a 'shell:<command>'
+    ## might run on the device already.
+    def open_device_service(self, serial, service):
+        sock = self.connect()
+        try:
+            adb_send_request(sock, "host:transport:" + serial)
+            try:
+                adb_send_request(sock, service)
+            except OSError as e:
+                raise AdbCommandSentError("Request [%s] on [%s] failed after it was sent: %s" % (service, serial, e)) from e
+        except:
+            sock.close()
+            raise
+        return sock
+
+    ## socket on which the output of the command can be read while it runs, no timeout is applied
+    def shell_stream(self, serial, command):
+        sock = self.open_device_service(serial, "shell:" + command)
+        sock.settimeout(None)
+        return sock
+
+    ## runs the command on the device and returns (exit code, output), a shell session per device is kept
+    ## open for further calls, if that is not possible (old devices) one connection per command is used.
+    ## timeout: seconds the command may run without any output, None for the timeout of the client. Only a
+    ## failing connect or transport setup raises OSError/AdbClientError, the command was not sent then and
+    ## the caller may try another way. Once the command was sent, any failure raises AdbCommandSentError.
+    def shell(self, serial, command, timeout=None):
+        session = self.__sessions.get(serial)
+        if session is not None and not session.is_open():
+            self.close_session(serial)
+            session = None
+
+        if session is None:
+            try:
+                session = AdbShellSession(self, serial)
+                self.__sessions[serial] = session
+            except AdbClientError:
+                session = None
+
+        if session is not None:
+            try:
+                return session.run(command, timeout=timeout)
+            except AdbCommandSentError:
+                # the session is in an unknown state
+                self.close_session(serial)
+                raise
+
+        marker = "__jah_rc_" + uuid.uuid4().hex + "_"
+        sock = self.open_device_service(serial, "shell:(" + command + "); echo \"" + marker + "$?\"")
+        try:
+            sock.settimeout(timeout if timeout is not None else self.timeout)
+            output = adb_recv_all(sock).decode("utf-8", errors="replace").replace("\r\n", "\n")
+        except OSError as e:
+            raise AdbCommandSentError("Shell command [%s] on [%s] failed after it was sent: %s" % (command, serial, e)) from e
+        finally:
+            sock.close()
+
+        marker_pos = output.rfind(marker)
+        if marker_pos < 0:
+            raise AdbCommandSentError("Shell command [%s] on [%s] did not finish" % (command, serial))
+
+        return int(output[marker_pos + len(marker):].strip()), output[:marker_pos]
+
+    def close_session(self, serial):
+        session = self.__sessions.pop(serial, None)
+        if session is not None:
+            session.close()
+
+    def getprop(self, serial, prop):
+        rc, output = self.shell(serial, "getprop " + prop)
+        return output.strip()
+
+    def close(self):
+        for session in self.__sessions.values():
+            session.close()
+        self.__sessions = {}
+
+## sends the commands to the emulator console on localhost:<console_port>, like 'adb emu' does (which is
+## not a service of the adb server but handled by the adb binary itself). Authenticates with the token
+## of the user, if there is one. Returns the answers of the console per command. timeout: seconds for the
+## connection and the authentication, command_timeout: seconds to wait for the answer of a command (default:
+## timeout). Once a command is written every failure, also a 'KO' answer, is an AdbCommandSentError.
+def emulator_console_command(console_port, commands, timeout=ADB_SOCKET_TIMEOUT, command_timeout=None):
+    sock = socket.create_connection((ADB_SERVER_HOST, console_port), timeout=timeout)
+    reader = sock.makefile('rb')
+
+    def read_answer():
+        answer_lines = []
+        while True:
+            line = reader.readline()
+            if not line:
+                # eg 'kill' closes the connection without an answer
+                return "".join(answer_lines)
+            line = line.decode("utf-8", errors="replace")
+            if line.startswith("OK"):
+                return "".join(answer_lines)
+            if line.startswith("KO"):
+                raise AdbClientError("Emulator console on port [%d]: %s" % (console_port, line.strip()))
+            answer_lines.append(line)
+
+    try:
+        # banner
+        read_answer()
+
+        if os.path.isfile(EMULATOR_CONSOLE_AUTH_TOKEN_FILE):
+            with open(EMULATOR_CONSOLE_AUTH_TOKEN_FILE, "r") as token_file:
+                token = token_file.read().strip()
+            if token != "":
+                sock.sendall(("auth " + token + "\r\n").encode("utf-8"))
+                read_answer()
+
+        sock.settimeout(command_timeout if command_timeout is not None else timeout)
+        answers = []
+        for command in commands:
+            try:
+                sock.sendall((command + "\r\n").encode("utf-8"))
+                answers.append(read_answer())
+            except (OSError, ValueError, AdbClientError) as e:
+                raise AdbCommandSentError("Command [%s] sent to the emulator console on port [%d], but: %s" % (command, console_port, str(e) if str(e) != "" else type(e).__name__))
+        return answers
+    finally:
+        reader.close()
+        sock.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Node wide store of read-only raw disk images (eg the sdcard), the AVD config points to the image in the
+## store and the emulator itself writes into a qcow2 overlay within the avd directory. Images are created
+## once, published with an atomic rename and are never written afterwards. The overlays of an AVD are
+## recorded in a metadata file within the avd directory, so they can be removed when the emulator is killed.
+
+import os
+import re
+import json
+import stat
+import time
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import jenkins_android_helper_commons
+import jenkins_android_helper_trace
+
+AVD_STORE_METADATA_FILENAME = "jenkins-android-helper-store.json"
+AVD_STORE_OVERLAY_SUFFIX = ".qcow2"
+## sizes as accepted by mksdcard, the size is part of the image name in the store
+AVD_STORE_SDCARD_SIZE_PATTERN = r"^[0-9]+[KMG]?$"
+
+@contextlib.contextmanager
+def __avd_store_locked(store_dir, name):
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, "." + name + ".lock"), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+## bytes actually allocated on disk, sparse files and overlays only count what was written
+def avd_store_disk_usage(file_name):
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return 0
+
+    if hasattr(st, "st_blocks"):
+        return st.st_blocks * 512
+    return st.st_size
+
+def avd_store_is_valid_sdcard_size(sdcard_size):
+    return sdcard_size is not None and re.fullmatch(AVD_STORE_SDCARD_SIZE_PATTERN, sdcard_size) is not None
+
+## path of the sdcard image of the given size (as accepted by mksdcard, eg 200M) in the store, it is created
+## with mksdcard if not yet there. Returns (path, seconds needed to create it or 0 if it was already there),
+## raises a ValueError for an invalid size
+def avd_store_get_sdcard(store_dir, mksdcard_command, sdcard_size):
+    if not avd_store_is_valid_sdcard_size(sdcard_size):
+        raise ValueError("Invalid sdcard size [%s], expected a number with an optional K, M or G suffix" % (sdcard_size))
+
+    name = "sdcard-" + sdcard_size + ".img"
+    sdcard_image = os.path.join(store_dir, name)
+    if jenkins_android_helper_commons.is_file(sdcard_image):
+        return sdcard_image, 0
+
+    with __avd_store_locked(store_dir, name):
+        if jenkins_android_helper_commons.is_file(sdcard_image):
+            return sdcard_image, 0
+
+        create_start = time.monotonic()
+        staging_image = sdcard_image + ".tmp"
+        jenkins_android_helper_commons.remove_file_or_dir(staging_image)
+        jenkins_android_helper_trace.traced_run([ mksdcard_command, sdcard_size, staging_image ]).check_returncode()
+
+        # read-only from now on, every AVD writes into its own overlay
+        os.chmod(staging_image, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(staging_image, sdcard_image)
+
+        return sdcard_image, time.monotonic() - create_start
+
+## the overlay the emulator creates for a raw image outside the avd directory
+def avd_store_overlay_path(avd_dir, base_image):
+    return os.path.join(avd_dir, os.path.basename(base_image) + AVD_STORE_OVERLAY_SUFFIX)
+
+def avd_store_read_metadata(avd_dir):
+    try:
+        with open(os.path.join(avd_dir, AVD_STORE_METADATA_FILENAME), 'r') as metadata_file:
+            return json.load(metadata_file)
+    except (OSError, ValueError):
+        return {}
+
+def avd_store_write_metadata(avd_dir, metadata):
+    metadata_file_name = os.path.join(avd_dir, AVD_STORE_METADATA_FILENAME)
+    with open(metadata_file_name + ".tmp", 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(metadata_file_name + ".tmp", metadata_file_name)
+
+## removes the overlays of the avd, returns (bytes written into the overlays, bytes of the shared bases)
+def avd_store_remove_overlays(avd_dir):
+    written = 0
+    shared = 0
+    for overlay in avd_store_read_metadata(avd_dir).get("overlays", []):
+        written = written + avd_store_disk_usage(overlay["overlay"])
+        shared = shared + avd_store_disk_usage(overlay["base"])
+        jenkins_android_helper_commons.remove_file_or_dir(overlay["overlay"])
+
+    return written, shared
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Node wide cache of freshly created AVDs, keyed by everything that goes into the creation (system image
+## and its revision, sdcard size and hw properties). A template is created once with avdmanager and then
+## cloned into the workspace under the new name, so neither the avdmanager JVM nor the sdcard creation is
+## needed per build. A template is '<key>/template.ini' plus '<key>/template.avd/', it is published with an
+## atomic rename of the whole directory.
+##
+## The snapshot saved after the first cold boot of a configuration is published next to the templates as
+## 'snapshots/<snapshot key>/', with the files of the avd directory the snapshot depends on (the snapshot
+## itself, the qcow2 disks and their bases) and 'snapshot.json'. A new AVD of the same configuration gets a
+## clone of it and boots from the snapshot right away. The first published snapshot of a key is kept.
+
+import os
+import sys
+import json
+import stat
+import shutil
+import hashlib
+import contextlib
+import subprocess
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import jenkins_android_helper_commons
+import jenkins_android_helper_trace
+import ini_helper_functions
+
+AVD_TEMPLATE_NAME = "template"
+AVD_TEMPLATE_STAGING_PREFIX = ".staging-"
+
+## created by the emulator while running, must not end up in a clone
+AVD_TEMPLATE_CLONE_EXCLUDE = [ "hardware-qemu.ini", "snapshots" ]
+AVD_TEMPLATE_CLONE_EXCLUDE_SUFFIXES = ( ".lock", )
+
+AVD_SNAPSHOT_STORE_DIR = "snapshots"
+AVD_SNAPSHOT_METADATA_FILENAME = "snapshot.json"
+
+## belong to the avd, not to its snapshot
+AVD_SNAPSHOT_EXCLUDE = [ "config.ini", "emulator-user.ini" ] + AVD_TEMPLATE_CLONE_EXCLUDE
+
+## ioctl to share the data blocks of a file with a new one (btrfs, xfs with reflink, ...)
+FICLONE = 0x40049409
+
+def avd_template_key(android_system_image, image_revision, sdcard_size, additional_properties):
+    key_hash = hashlib.sha256()
+    key_hash.update(("image=" + android_system_image + "\n").encode("utf-8"))
+    key_hash.update(("image.revision=" + image_revision + "\n").encode("utf-8"))
+    key_hash.update(("sdcard=" + sdcard_size + "\n").encode("utf-8"))
+    for additional_property in sorted(filter(None, additional_properties)):
+        key_hash.update(("prop=" + additional_property + "\n").encode("utf-8"))
+
+    return key_hash.hexdigest()[:32]
+
+def avd_template_path(cache_dir, key):
+    return os.path.join(cache_dir, key)
+
+## the template directory, empty string if there is no complete template for the key
+def avd_template_lookup(cache_dir, key):
+    template_dir = avd_template_path(cache_dir, key)
+    if jenkins_android_helper_commons.is_directory(os.path.join(template_dir, AVD_TEMPLATE_NAME + ".avd")) and jenkins_android_helper_commons.is_file(os.path.join(template_dir, AVD_TEMPLATE_NAME + ".ini")):
+        return template_dir
+
+    return ""
+
+## serializes the creation of the same template, a second build waits and then finds the template
+@contextlib.contextmanager
+def avd_template_locked(cache_dir, key):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(avd_template_path(cache_dir, key) + ".lock", 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+## returns the avd home to create the template in with avdmanager (as AVD_TEMPLATE_NAME)
+def avd_template_staging_directory(cache_dir, key):
+    staging_dir = os.path.join(cache_dir, AVD_TEMPLATE_STAGING_PREFIX + key)
+    jenkins_android_helper_commons.remove_file_or_dir(staging_dir)
+    os.makedirs(staging_dir)
+    return staging_dir
+
+def avd_template_publish(cache_dir, key, staging_dir):
+    template_dir = avd_template_path(cache_dir, key)
+    jenkins_android_helper_commons.remove_file_or_dir(template_dir)
+    os.rename(staging_dir, template_dir)
+    return template_dir
+
+## copy-on-write clone if the filesystem supports it, files without write permission are never written
+## by the emulator and are hardlinked, everything else is copied
+def avd_template_clone_file(src, dst):
+    if fcntl is not None and sys.platform == "linux":
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                shutil.copymode(src, dst)
+                return "reflink"
+            except OSError:
+                pass
+        os.remove(dst)
+
+    if not os.stat(src).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+## clones the files of src_dir into dst_dir, except the excluded names, counts the clone methods used
+def __avd_template_clone_tree(src_dir, dst_dir, exclude, clone_methods):
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = [ dir_name for dir_name in dirs if not dir_name in exclude ]
+        dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(dst_root, exist_ok=True)
+
+        for file_name in files:
+            if file_name in exclude or file_name.endswith(AVD_TEMPLATE_CLONE_EXCLUDE_SUFFIXES):
+                continue
+            dst_file = os.path.join(dst_root, file_name)
+            # an existing file could be a hardlink into the cache, it must never be written through
+            if os.path.lexists(dst_file):
+                os.remove(dst_file)
+            clone_method = avd_template_clone_file(os.path.join(root, file_name), dst_file)
+            clone_methods[clone_method] = clone_methods.get(clone_method, 0) + 1
+
+    return clone_methods
+
+## clones the template into avd_home as avd_name, the paths in '<avd_name>.ini' and the name in the
+## config.ini are rewritten, returns a dict of clone method -> number of files
+def avd_template_clone(template_dir, avd_home, avd_name):
+    src_avd_dir = os.path.join(template_dir, AVD_TEMPLATE_NAME + ".avd")
+    dst_avd_dir = os.path.join(avd_home, avd_name + ".avd")
+
+    clone_methods = __avd_template_clone_tree(src_avd_dir, dst_avd_dir, AVD_TEMPLATE_CLONE_EXCLUDE, {})
+
+    avd_ini_file = os.path.join(avd_home, avd_name + ".ini")
+    shutil.copyfile(os.path.join(template_dir, AVD_TEMPLATE_NAME + ".ini"), avd_ini_file)
+    ini_helper_functions.ini_file_helper_add_or_update_key_values(avd_ini_file, [ "path:" + dst_avd_dir, "path.rel:" + os.path.join("avd", avd_name + ".avd") ])
+
+    ini_helper_functions.ini_file_helper_add_or_update_key_values(os.path.join(dst_avd_dir, "config.ini"), [ "AvdId:" + avd_name, "avd.ini.displayname:" + avd_name ])
+
+    return clone_methods
+
+def avd_snapshot_path(cache_dir, snapshot_key):
+    return os.path.join(cache_dir, AVD_SNAPSHOT_STORE_DIR, snapshot_key)
+
+## metadata of the published snapshot for the key, empty dict if there is none
+def avd_snapshot_lookup(cache_dir, snapshot_key):
+    try:
+        with open(os.path.join(avd_snapshot_path(cache_dir, snapshot_key), AVD_SNAPSHOT_METADATA_FILENAME), 'r') as metadata_file:
+            return json.load(metadata_file)
+    except (OSError, ValueError):
+        return {}
+
+## publishes the snapshot of the stopped emulator of avd_dir for the key, returns False if a snapshot for the
+## key was already there. Files only meaningful for the avd itself can be passed as exclude.
+def avd_snapshot_publish(cache_dir, snapshot_key, avd_dir, snapshot_name, metadata, exclude=[]):
+    snapshots_dir = os.path.join(cache_dir, AVD_SNAPSHOT_STORE_DIR)
+    with avd_template_locked(snapshots_dir, snapshot_key):
+        if len(avd_snapshot_lookup(cache_dir, snapshot_key)) > 0:
+            return False
+
+        staging_dir = avd_template_staging_directory(snapshots_dir, snapshot_key)
+        try:
+            clone_methods = __avd_template_clone_tree(avd_dir, staging_dir, AVD_SNAPSHOT_EXCLUDE + exclude, {})
+            snapshot_dir = os.path.join(AVD_SNAPSHOT_STORE_DIR, snapshot_name)
+            __avd_template_clone_tree(os.path.join(avd_dir, snapshot_dir), os.path.join(staging_dir, snapshot_dir), [], clone_methods)
+
+            # the qcow2 disks reference their bases by the absolute path in this avd
+            with open(os.path.join(staging_dir, AVD_SNAPSHOT_METADATA_FILENAME), 'w') as metadata_file:
+                json.dump(dict(metadata, snapshot_name=snapshot_name, snapshot_key=snapshot_key, avd_dir=avd_dir), metadata_file)
+
+            avd_template_publish(snapshots_dir, snapshot_key, staging_dir)
+        except OSError:
+            jenkins_android_helper_commons.remove_file_or_dir(staging_dir)
+            raise
+
+    return True
+
+## points the backing file of a qcow2 disk, which is part of the old avd, to the same file in the new avd
+def __avd_snapshot_rebase_disk(qemu_img_command, disk, old_avd_dir, new_avd_dir):
+    disk_info = json.loads(jenkins_android_helper_trace.traced_run([ qemu_img_command, "info", "--output=json", disk ], stdout=subprocess.PIPE, check=True).stdout)
+    backing_file = disk_info.get("backing-filename", "")
+    if old_avd_dir == "" or not backing_file.startswith(old_avd_dir + os.sep):
+        return
+
+    rebase_command = [ qemu_img_command, "rebase", "-u", "-b", os.path.join(new_avd_dir, os.path.relpath(backing_file, old_avd_dir)) ]
+    if disk_info.get("backing-filename-format", "") != "":
+        rebase_command = rebase_command + [ "-F", disk_info["backing-filename-format"] ]
+    jenkins_android_helper_trace.traced_run(rebase_command + [ disk ], stdout=subprocess.DEVNULL).check_returncode()
+
+## clones the published snapshot for the key into avd_dir, returns a dict of clone method -> number of files
+def avd_snapshot_restore(cache_dir, snapshot_key, avd_dir, qemu_img_command):
+    metadata = avd_snapshot_lookup(cache_dir, snapshot_key)
+    clone_methods = __avd_template_clone_tree(avd_snapshot_path(cache_dir, snapshot_key), avd_dir, [ AVD_SNAPSHOT_METADATA_FILENAME ], {})
+
+    for file_name in os.listdir(avd_dir):
+        if file_name.endswith(".qcow2"):
+            __avd_snapshot_rebase_disk(qemu_img_command, os.path.join(avd_dir, file_name), metadata.get("avd_dir", ""), avd_dir)
+
+    return clone_methods
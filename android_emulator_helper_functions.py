@@ -16,10 +16,20 @@
 # You should have received a copy of the GNU General Public License
 # along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import re
 import subprocess
 import time
+import queue
+import threading
+import socket
+import shlex
+import hashlib
+from collections import namedtuple
+
+import android_adb_client
+import jenkins_android_helper_trace
 
 ANDROID_ADB_PORTS_RANGE_START = 5554
 ANDROID_ADB_PORTS_RANGE_END = 5584
@@ -30,16 +40,72 @@ ERROR_CODE_WAIT_AVD_CREATED_BUT_NOT_RUNNING = 2
 ERROR_CODE_WAIT_EMULATOR_RUNNING_UNKNOWN_SERIAL = 3
 ERROR_CODE_WAIT_EMULATOR_RUNNING_STARTUP_TIMEOUT = 4
 
+## processes are looked up here on linux
+PROC_DIRECTORY = "/proc"
+## /proc/net/tcp state of a listening socket
+PROC_NET_TCP_STATE_LISTEN = "0A"
+PROC_NET_TCP_FILES = [ "tcp", "tcp6" ]
+
+def __get_socket_inodes_for_process(pid_to_check):
+    inodes = set()
+    fd_dir = os.path.join(PROC_DIRECTORY, str(pid_to_check), "fd")
+    for fd in os.listdir(fd_dir):
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            # fd was closed in the meantime
+            continue
+        if link.startswith("socket:["):
+            inodes.add(link[8:-1])
+
+    return inodes
+
+## reads the listening ports of a process directly from /proc, no need to fork lsof
+def get_open_ports_for_process_from_proc(pid_to_check):
+    open_ports = []
+
+    socket_inodes = __get_socket_inodes_for_process(pid_to_check)
+    if len(socket_inodes) == 0:
+        return open_ports
+
+    for tcp_file in PROC_NET_TCP_FILES:
+        try:
+            with open(os.path.join(PROC_DIRECTORY, str(pid_to_check), "net", tcp_file), 'r') as proc_net_tcp:
+                # skip header
+                next(proc_net_tcp, None)
+                for entry in proc_net_tcp:
+                    # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode
+                    splitted = entry.split()
+                    if len(splitted) < 10 or splitted[3] != PROC_NET_TCP_STATE_LISTEN or not splitted[9] in socket_inodes:
+                        continue
+                    port = str(int(splitted[1].split(":")[1], 16))
+                    if not port in open_ports:
+                        open_ports = open_ports + [ port ]
+        except FileNotFoundError:
+            pass
+
+    return open_ports
+
 def get_open_ports_for_process(pid_to_check):
     open_ports = []
 
     if pid_to_check <= 0:
         return open_ports
 
+    if sys.platform == "linux":
+        try:
+            return get_open_ports_for_process_from_proc(pid_to_check)
+        except FileNotFoundError:
+            # process is gone
+            return open_ports
+        except OSError:
+            # /proc not readable (eg hidepid), fallback to lsof
+            pass
+
     output = ""
     if sys.platform == "linux" or sys.platform == "darwin":
         header = True
-        output = subprocess.run([ 'lsof', '-sTCP:LISTEN', '-i4', '-P', '-p', str(pid_to_check), '-a' ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
+        output = jenkins_android_helper_trace.traced_run([ 'lsof', '-sTCP:LISTEN', '-i4', '-P', '-p', str(pid_to_check), '-a' ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
         for entry in output.splitlines():
             if header:
                 header = False
@@ -50,7 +116,7 @@ def get_open_ports_for_process(pid_to_check):
                 open_ports = open_ports + [ splitted[8].split(':')[1] ]
 
     elif sys.platform == "win32" or sys.platform == "cygwin":
-        output = subprocess.run([ 'netstat', '-aon' ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
+        output = jenkins_android_helper_trace.traced_run([ 'netstat', '-aon' ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
         for entry in output.splitlines():
             splitted = re.sub("\s+", " ", entry.strip()).split(' ')
             if len(splitted) == 5 and splitted[0] == 'TCP' and splitted[4] == str(pid_to_check) and not re.search('\[', splitted[1]):
@@ -58,20 +124,109 @@ def get_open_ports_for_process(pid_to_check):
 
     return open_ports
 
+## index of all running emulators, read from /proc, shared by all lookups within the ttl
+AndroidEmulatorProcess = namedtuple("AndroidEmulatorProcess", "pid, avd_name, console_port, adb_port, start_time")
+ANDROID_EMULATOR_PROCESS_INDEX_TTL = 2.0
+__emulator_process_index = None
+__emulator_process_index_time = 0
+
+## start time of a process in clock ticks since boot, together with the pid it identifies a process
+## uniquely, 0 if unknown
+def get_process_start_time(pid):
+    try:
+        with open(os.path.join(PROC_DIRECTORY, str(pid), "stat"), 'r') as proc_stat:
+            # the command name may contain spaces, fields are counted after its closing bracket
+            return int(proc_stat.read().rsplit(")", maxsplit=1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def __parse_emulator_cmdline(pid, argv):
+    if len(argv) == 0 or not "qemu" in os.path.basename(argv[0]):
+        return None
+
+    avd_name = ""
+    console_port = -1
+    adb_port = -1
+    for idx in range(0, len(argv) - 1):
+        if argv[idx] == "-avd":
+            avd_name = argv[idx + 1]
+        elif argv[idx] == "-port":
+            try:
+                console_port = int(argv[idx + 1])
+                adb_port = console_port + 1
+            except ValueError:
+                pass
+        elif argv[idx] == "-ports":
+            try:
+                console_port, adb_port = [ int(port) for port in argv[idx + 1].split(",") ]
+            except ValueError:
+                pass
+
+    if avd_name == "":
+        return None
+
+    return AndroidEmulatorProcess(pid=pid, avd_name=avd_name, console_port=console_port, adb_port=adb_port, start_time=get_process_start_time(pid))
+
+## reads the command line of every process once, returns a list of AndroidEmulatorProcess
+def android_emulator_scan_running_emulators():
+    emulators = []
+    for entry in os.listdir(PROC_DIRECTORY):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC_DIRECTORY, entry, "cmdline"), 'rb') as proc_cmdline:
+                argv = proc_cmdline.read().decode("utf-8", errors="replace").split("\0")
+        except OSError:
+            # process is gone or not accessible
+            continue
+
+        emulator = __parse_emulator_cmdline(int(entry), argv)
+        if emulator is not None:
+            emulators = emulators + [ emulator ]
+
+    return emulators
+
+def android_emulator_get_running_emulators():
+    global __emulator_process_index, __emulator_process_index_time
+
+    now = time.monotonic()
+    if __emulator_process_index is None or now - __emulator_process_index_time > ANDROID_EMULATOR_PROCESS_INDEX_TTL:
+        __emulator_process_index = android_emulator_scan_running_emulators()
+        __emulator_process_index_time = now
+
+    return __emulator_process_index
+
+## has to be called after an emulator was started or killed by this process
+def android_emulator_invalidate_process_index():
+    global __emulator_process_index
+    __emulator_process_index = None
+
+def android_emulator_get_process_from_avd_name(avd_name):
+    for emulator in android_emulator_get_running_emulators():
+        # exact match, a name can't match as prefix of another one
+        if emulator.avd_name == avd_name:
+            return emulator
+
+    return None
+
 def android_emulator_get_pid_from_avd_name(avd_name):
     if avd_name is None or avd_name == "":
         return ""
 
     emulator_pid = 0
 
-    if sys.platform == "linux" or sys.platform == "darwin":
-        output = subprocess.run([ 'pgrep', '-f', 'qemu.*-avd ' + avd_name + ''], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
+    if sys.platform == "linux" and os.path.isdir("/proc/self"):
+        emulator = android_emulator_get_process_from_avd_name(avd_name)
+        if emulator is not None:
+            emulator_pid = emulator.pid
+    elif sys.platform == "linux" or sys.platform == "darwin":
+        output = jenkins_android_helper_trace.traced_run([ 'pgrep', '-f', 'qemu.*-avd ' + avd_name + ''], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
         try:
             emulator_pid = int(output)
         except:
             emulator_pid = 0
     elif sys.platform == "win32" or sys.platform == "cygwin":
-        output = subprocess.run([ 'WMIC', 'path', 'win32_process', 'get', 'Caption,Processid,Commandline' ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
+        output = jenkins_android_helper_trace.traced_run([ 'WMIC', 'path', 'win32_process', 'get', 'Caption,Processid,Commandline' ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding)
         for entry in output.splitlines():
             entry = entry.strip()
             if re.search('qemu.*-avd ' + avd_name, entry):
@@ -84,10 +239,11 @@ def android_emulator_get_pid_from_avd_name(avd_name):
     return emulator_pid
 
 def android_emulator_detect_used_adb_port_by_pid(pid_to_check):
+    ports_used_by_pid = get_open_ports_for_process(pid_to_check)
+
     for pos_port in range(ANDROID_ADB_PORTS_RANGE_START, ANDROID_ADB_PORTS_RANGE_END, 2):
         pos_port2 = pos_port + 1
 
-        ports_used_by_pid = get_open_ports_for_process(pid_to_check)
         if str(pos_port) in ports_used_by_pid and str(pos_port2) in ports_used_by_pid:
             return pos_port
 
@@ -102,6 +258,12 @@ def android_emulator_serial_via_port_from_used_avd_name_single_run(avd_name):
     if emulator_pid <= 0:
         return ""
 
+    # the port was given explicitly on the command line, no need to look at the sockets
+    if sys.platform == "linux":
+        emulator = android_emulator_get_process_from_avd_name(avd_name)
+        if emulator is not None and emulator.pid == emulator_pid and emulator.console_port > 0:
+            return "emulator-" + str(emulator.console_port)
+
     android_adb_port_even = android_emulator_detect_used_adb_port_by_pid(emulator_pid)
 
     if android_adb_port_even >= 0:
@@ -123,3 +285,226 @@ def android_emulator_serial_via_port_from_used_avd_name(avd_name):
         time.sleep(3)
 
     return ""
+
+## the emulator only accepts even console ports within this range for -port
+ANDROID_EMULATOR_CONSOLE_PORT_MAX = 5682
+
+def __is_local_port_free(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+## console ports (the adb port is console port + 1) for count emulators, which are neither used by a
+## running emulator nor otherwise bound nor excluded, empty list if not enough ports are free
+def android_emulator_find_free_console_ports(count, excluded_ports=set()):
+    used_ports = set(excluded_ports)
+    if sys.platform == "linux" and os.path.isdir("/proc/self"):
+        for emulator in android_emulator_get_running_emulators():
+            used_ports.update([ emulator.console_port, emulator.adb_port ])
+
+    console_ports = []
+    for console_port in range(ANDROID_ADB_PORTS_RANGE_START, ANDROID_EMULATOR_CONSOLE_PORT_MAX + 1, 2):
+        if console_port in used_ports or console_port + 1 in used_ports:
+            continue
+        if not __is_local_port_free(console_port) or not __is_local_port_free(console_port + 1):
+            continue
+
+        console_ports = console_ports + [ console_port ]
+        if len(console_ports) == count:
+            return console_ports
+
+    return []
+
+## only these entries of the avd config.ini are part of the snapshot key, others like the name of the avd
+## differ between otherwise identical avds or are changed by the emulator itself
+ANDROID_AVD_CONFIG_SNAPSHOT_KEY_PREFIXES = ( "hw.", "image.", "abi.", "tag.", "sdcard.", "target" )
+## paths within the avd, the snapshot of one avd is valid for every other one of the same configuration
+ANDROID_AVD_CONFIG_SNAPSHOT_KEY_EXCLUDE = [ "hw.sdCard.path" ]
+
+def android_emulator_snapshot_key(avd_config, image_revision):
+    key_hash = hashlib.sha256()
+    for key, value in sorted(avd_config.items()):
+        if key.startswith(ANDROID_AVD_CONFIG_SNAPSHOT_KEY_PREFIXES) and not key in ANDROID_AVD_CONFIG_SNAPSHOT_KEY_EXCLUDE:
+            key_hash.update((key + "=" + value + "\n").encode("utf-8"))
+    key_hash.update(("image.revision=" + image_revision + "\n").encode("utf-8"))
+
+    return key_hash.hexdigest()[:16]
+
+## 'emulator-5554' -> 5554, -1 for serials not of a local emulator
+def get_console_port_from_serial(serial):
+    match = re.match(r"^emulator-([0-9]+)$", serial if serial is not None else "")
+    if not match:
+        return -1
+    return int(match.group(1))
+
+
+## Boot wait: a single 'adb wait-for-device shell' runs a loop on the device, which prints the boot state
+## whenever it changes, so no adb process needs to be forked per poll and a state change is seen within
+## a fraction of a second. Lines are "<sys.boot_completed>:<init.svc.bootanim>", the loop ends once the
+## boot animation is stopped.
+ANDROID_EMULATOR_BOOT_POLL_SCRIPT = ('last=""; while true; do '
+    'state="$(getprop sys.boot_completed):$(getprop init.svc.bootanim)"; '
+    'if [ "$state" != "$last" ]; then echo "$state"; last="$state"; fi; '
+    'case "$state" in *:stopped) exit 0;; esac; '
+    'sleep 0.2 2>/dev/null || sleep 1; done')
+ANDROID_EMULATOR_BOOT_RESTART_DELAY = 0.5
+## how often a cancel event is checked while waiting for the next boot state
+ANDROID_EMULATOR_BOOT_CANCEL_INTERVAL = 0.5
+
+def __read_lines_into_queue(stream, line_queue):
+    for line in iter(stream.readline, b''):
+        line_queue.put((time.monotonic(), line.decode("utf-8", errors="replace").strip()))
+    line_queue.put((time.monotonic(), None))
+
+## starts the boot poll script, returns the stream to read its output from and a function to stop it,
+## or None if the device is not (yet) connected. With an adb_client the script is run directly via
+## the adb server, otherwise via 'adb wait-for-device shell'.
+def __start_boot_poll(adb_command, serial, adb_client):
+    if adb_client is not None:
+        try:
+            sock = adb_client.shell_stream(serial, ANDROID_EMULATOR_BOOT_POLL_SCRIPT)
+        except (OSError, android_adb_client.AdbClientError):
+            return None
+
+        stream = sock.makefile('rb')
+        def stop_boot_poll():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            stream.close()
+            sock.close()
+        return stream, stop_boot_poll
+
+    boot_wait_command = [ adb_command, "-s", serial, "wait-for-device", "shell", ANDROID_EMULATOR_BOOT_POLL_SCRIPT ]
+    proc = jenkins_android_helper_trace.traced_popen(boot_wait_command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    def stop_boot_poll():
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+    return proc.stdout, stop_boot_poll
+
+## waits until the boot animation of the emulator with the given serial stopped, the phases are logged
+## with their time since the start of the wait. Returns True on success, False if the timeout (seconds)
+## passed or the cancel event (threading.Event) was set. If an adb_client (android_adb_client.AdbClient) is
+## given, no adb process is forked.
+def android_emulator_wait_for_boot(adb_command, serial, timeout, adb_client=None, cancel=None):
+    wait_start = time.monotonic()
+    deadline = wait_start + timeout
+    last_state = None
+
+    while time.monotonic() < deadline:
+        if cancel is not None and cancel.is_set():
+            print("Waiting for the boot of [%s] was cancelled" % (serial,))
+            return False
+
+        boot_poll = __start_boot_poll(adb_command, serial, adb_client)
+        if boot_poll is None:
+            # device not yet known to the adb server
+            time.sleep(ANDROID_EMULATOR_BOOT_RESTART_DELAY)
+            continue
+
+        stream, stop_boot_poll = boot_poll
+        line_queue = queue.Queue()
+        reader = threading.Thread(target=__read_lines_into_queue, args=(stream, line_queue), daemon=True)
+        reader.start()
+
+        try:
+            while True:
+                line_timeout = max(deadline - time.monotonic(), 0.01)
+                try:
+                    line_time, line = line_queue.get(timeout=min(line_timeout, ANDROID_EMULATOR_BOOT_CANCEL_INTERVAL) if cancel is not None else line_timeout)
+                except queue.Empty:
+                    if time.monotonic() < deadline and not (cancel is not None and cancel.is_set()):
+                        continue
+                    # deadline reached or cancelled
+                    break
+
+                if line is None:
+                    # adb ended without the boot to complete, eg the device went offline, try again
+                    break
+
+                if line == "" or line == last_state:
+                    continue
+
+                if last_state is None:
+                    print("[%6.1fs] Emulator [%s] is online" % (line_time - wait_start, serial))
+                    jenkins_android_helper_trace.trace_event("boot_online", category="boot", serial=serial, seconds=round(line_time - wait_start, 3))
+
+                boot_completed, bootanim = (line.split(":", maxsplit=1) + [ "" ])[:2]
+                print("[%6.1fs] Boot state of [%s]: sys.boot_completed=[%s] init.svc.bootanim=[%s]" % (line_time - wait_start, serial, boot_completed, bootanim))
+                jenkins_android_helper_trace.trace_event("boot_state", category="boot", serial=serial, seconds=round(line_time - wait_start, 3), boot_completed=boot_completed, bootanim=bootanim)
+                last_state = line
+
+                if bootanim == "stopped":
+                    print("[%6.1fs] Emulator [%s] finished booting" % (line_time - wait_start, serial))
+                    jenkins_android_helper_trace.trace_event("boot_finished", category="boot", serial=serial, seconds=round(line_time - wait_start, 3))
+                    return True
+        finally:
+            stop_boot_poll()
+
+        if time.monotonic() < deadline:
+            time.sleep(ANDROID_EMULATOR_BOOT_RESTART_DELAY)
+
+    return False
+
+## Device settings: a list of "<namespace>:<key>=<value>" entries, namespace is one of the settings
+## tables (global, secure, system) or 'prop' for a system property. All of them are applied in one
+## shell call, which first waits on the device until the settings provider answers.
+ANDROID_EMULATOR_SETTINGS_NAMESPACES = [ "global", "secure", "system" ]
+ANDROID_EMULATOR_SETTINGS_PROP_NAMESPACE = "prop"
+ANDROID_EMULATOR_SETTINGS_RESULT_MARKER = "__jah_setting_"
+ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT_MARKER = "__jah_settings_provider_timeout"
+
+AndroidDeviceSetting = namedtuple('AndroidDeviceSetting', 'namespace, key, value')
+
+## 'global:window_animation_scale=0' -> AndroidDeviceSetting, None if not in the expected format
+def android_emulator_parse_device_setting(setting):
+    match = re.match(r"^([a-z]+):([A-Za-z0-9_.\-]+)=(.*)$", setting.strip())
+    if not match:
+        return None
+
+    namespace = match.group(1)
+    if not namespace in ANDROID_EMULATOR_SETTINGS_NAMESPACES + [ ANDROID_EMULATOR_SETTINGS_PROP_NAMESPACE ]:
+        return None
+
+    return AndroidDeviceSetting(namespace=namespace, key=match.group(2), value=match.group(3))
+
+## the wait for the settings provider is bounded by the clock of the device, not by a number of tries, a
+## slow 'settings get' on a freshly booted device does not stretch it
+def android_emulator_build_device_settings_script(device_settings, provider_timeout):
+    # the provider is up once 'settings get' neither fails nor prints an error
+    script = ('start=$(date +%s); until out="$(settings get global device_provisioned 2>&1)" && '
+        'case "$out" in *rror*|*xception*) false;; *) true;; esac; do '
+        'if [ $(( $(date +%s) - start )) -ge ' + str(int(provider_timeout)) + ' ]; then echo "' + ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT_MARKER + '"; exit 1; fi; '
+        'sleep 0.2 2>/dev/null || sleep 1; done; ')
+
+    for idx, device_setting in enumerate(device_settings):
+        if device_setting.namespace == ANDROID_EMULATOR_SETTINGS_PROP_NAMESPACE:
+            script = script + "setprop " + shlex.quote(device_setting.key) + " " + shlex.quote(device_setting.value)
+        else:
+            script = script + "settings put " + device_setting.namespace + " " + shlex.quote(device_setting.key) + " " + shlex.quote(device_setting.value)
+        script = script + '; echo "' + ANDROID_EMULATOR_SETTINGS_RESULT_MARKER + str(idx) + ':$?"; '
+
+    return script
+
+## returns the exit code per setting (same order as given), -1 if the setting was not applied at all
+def android_emulator_parse_device_settings_results(output, device_settings):
+    results = [ -1 ] * len(device_settings)
+    for line in output.splitlines():
+        line = line.strip()
+        if not line.startswith(ANDROID_EMULATOR_SETTINGS_RESULT_MARKER):
+            continue
+
+        idx, rc = line[len(ANDROID_EMULATOR_SETTINGS_RESULT_MARKER):].split(":", maxsplit=1)
+        try:
+            results[int(idx)] = int(rc)
+        except (ValueError, IndexError):
+            pass
+
+    return results
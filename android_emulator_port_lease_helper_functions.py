@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Node wide registry of the emulator ports in use, so emulators can be started concurrently by
+## different builds. Every leased console port (the adb port is console port + 1) is a file
+## '<console port>.lease' in the registry directory, holding the pid (and its start time) of the
+## owner. The owner is the process starting the emulator until the emulator itself runs. Leases
+## of processes which are gone are reclaimed. All changes are done while holding an exclusive
+## lock on the registry.
+
+import os
+import json
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # no locking on windows, concurrent starts are not safe there
+    fcntl = None
+
+import jenkins_android_helper_commons
+import android_emulator_helper_functions
+
+PORT_LEASE_DIR_DEFAULT = os.path.join(tempfile.gettempdir(), "jenkins-android-helper-ports")
+PORT_LEASE_LOCK_FILENAME = ".lock"
+PORT_LEASE_SUFFIX = ".lease"
+
+@contextlib.contextmanager
+def __port_lease_locked(lease_dir):
+    os.makedirs(lease_dir, exist_ok=True)
+    with open(os.path.join(lease_dir, PORT_LEASE_LOCK_FILENAME), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def __port_lease_file_name(lease_dir, console_port):
+    return os.path.join(lease_dir, str(console_port) + PORT_LEASE_SUFFIX)
+
+def __port_lease_write(lease_dir, console_port, pid, owner):
+    lease = { "console_port": console_port, "adb_port": console_port + 1, "pid": pid,
+              "start_time": android_emulator_helper_functions.get_process_start_time(pid), "owner": owner }
+
+    lease_file_name = __port_lease_file_name(lease_dir, console_port)
+    with open(lease_file_name + ".tmp", 'w') as lease_file:
+        json.dump(lease, lease_file)
+    os.replace(lease_file_name + ".tmp", lease_file_name)
+
+def __port_lease_read(lease_dir, console_port):
+    try:
+        with open(__port_lease_file_name(lease_dir, console_port), 'r') as lease_file:
+            return json.load(lease_file)
+    except (OSError, ValueError):
+        return None
+
+def __port_lease_is_alive(lease):
+    try:
+        if not jenkins_android_helper_commons.is_process_running(lease["pid"]):
+            return False
+
+        # the pid could have been reused by another process
+        start_time = android_emulator_helper_functions.get_process_start_time(lease["pid"])
+        return lease["start_time"] == 0 or start_time == 0 or lease["start_time"] == start_time
+    except (KeyError, TypeError):
+        return False
+
+## console ports of all valid leases, stale leases are removed, has to be called with the lock held
+def __port_lease_collect(lease_dir):
+    leased_ports = set()
+    for entry in os.listdir(lease_dir):
+        if not entry.endswith(PORT_LEASE_SUFFIX):
+            continue
+
+        try:
+            console_port = int(entry[:-len(PORT_LEASE_SUFFIX)])
+        except ValueError:
+            continue
+
+        lease = __port_lease_read(lease_dir, console_port)
+        if lease is not None and __port_lease_is_alive(lease):
+            leased_ports.add(console_port)
+        else:
+            print("Reclaiming stale lease of emulator port [%d]" % (console_port))
+            jenkins_android_helper_commons.remove_file_or_dir(__port_lease_file_name(lease_dir, console_port))
+
+    return leased_ports
+
+## leases count free console ports for the process pid, returns them or an empty list if not enough
+## ports are free
+def port_lease_acquire(lease_dir, count, pid, owner=""):
+    with __port_lease_locked(lease_dir):
+        leased_ports = __port_lease_collect(lease_dir)
+        console_ports = android_emulator_helper_functions.android_emulator_find_free_console_ports(count, excluded_ports=leased_ports)
+
+        for console_port in console_ports:
+            __port_lease_write(lease_dir, console_port, pid, owner)
+
+        return console_ports
+
+## hands the lease over to another process, eg from the starting process to the emulator
+def port_lease_transfer(lease_dir, console_port, pid):
+    with __port_lease_locked(lease_dir):
+        lease = __port_lease_read(lease_dir, console_port)
+        __port_lease_write(lease_dir, console_port, pid, lease.get("owner", "") if lease is not None else "")
+
+def port_lease_release(lease_dir, console_port):
+    with __port_lease_locked(lease_dir):
+        jenkins_android_helper_commons.remove_file_or_dir(__port_lease_file_name(lease_dir, console_port))
+
+def port_lease_reclaim_stale(lease_dir):
+    with __port_lease_locked(lease_dir):
+        return __port_lease_collect(lease_dir)
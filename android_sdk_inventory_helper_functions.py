@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Inventory of the installed SDK packages: every source.properties below the SDK root is parsed once,
+## the result is an index of package path (relative, '/' separated, eg 'build-tools/27.0.1') to its
+## properties. The index is persisted as manifest together with the mtimes of all directories that were
+## visited, if none of them changed, the manifest is still valid and no file needs to be parsed.
+
+import os
+import json
+
+import ini_helper_functions
+
+SDK_INVENTORY_SRC_PROPS_FILENAME = "source.properties"
+## kept in its own directory, so writing the manifest does not change the mtime of the SDK root
+SDK_INVENTORY_MANIFEST_DIR = ".jenkins-android-helper"
+SDK_INVENTORY_MANIFEST_FILENAME = "inventory.json"
+SDK_INVENTORY_MANIFEST_VERSION = 1
+## deepest package is a system image: system-images/android-24/default/x86
+SDK_INVENTORY_MAX_DEPTH = 4
+
+## inventories already read by this process
+__inventories = {}
+
+def sdk_inventory_manifest_file(sdk_root):
+    return os.path.join(sdk_root, SDK_INVENTORY_MANIFEST_DIR, SDK_INVENTORY_MANIFEST_FILENAME)
+
+def sdk_inventory_scan(sdk_root):
+    packages = {}
+    mtimes = {}
+
+    for dirpath, dirnames, filenames in os.walk(sdk_root):
+        rel_dir = os.path.relpath(dirpath, sdk_root).replace(os.sep, "/")
+        mtimes[rel_dir] = os.stat(dirpath).st_mtime_ns
+
+        if SDK_INVENTORY_SRC_PROPS_FILENAME in filenames and rel_dir != ".":
+            src_props = os.path.join(dirpath, SDK_INVENTORY_SRC_PROPS_FILENAME)
+            try:
+                packages[rel_dir] = ini_helper_functions.ini_file_helper_read_all(src_props)
+                mtimes[rel_dir + "/" + SDK_INVENTORY_SRC_PROPS_FILENAME] = os.stat(src_props).st_mtime_ns
+            except (OSError, UnicodeDecodeError):
+                pass
+
+            # packages are not nested, no need to walk through eg the whole NDK
+            dirnames[:] = []
+            continue
+
+        depth = 0 if rel_dir == "." else len(rel_dir.split("/"))
+        if depth >= SDK_INVENTORY_MAX_DEPTH:
+            dirnames[:] = []
+        else:
+            # hidden directories are staging areas and the manifest itself
+            dirnames[:] = [ dirname for dirname in dirnames if not dirname.startswith(".") ]
+
+    return packages, mtimes
+
+def __is_manifest_valid(sdk_root, manifest):
+    if manifest.get("version") != SDK_INVENTORY_MANIFEST_VERSION:
+        return False
+
+    for rel_path, mtime in manifest["mtimes"].items():
+        try:
+            if os.stat(os.path.join(sdk_root, rel_path)).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+def sdk_inventory_load(sdk_root):
+    try:
+        with open(sdk_inventory_manifest_file(sdk_root), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if __is_manifest_valid(sdk_root, manifest):
+            return manifest["packages"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    return None
+
+def sdk_inventory_save(sdk_root, packages, mtimes):
+    manifest_file_name = sdk_inventory_manifest_file(sdk_root)
+    try:
+        with open(manifest_file_name + ".tmp", 'w') as manifest_file:
+            json.dump({ "version": SDK_INVENTORY_MANIFEST_VERSION, "packages": packages, "mtimes": mtimes }, manifest_file)
+        os.replace(manifest_file_name + ".tmp", manifest_file_name)
+    except OSError:
+        print("Could not write SDK inventory [%s]" % (manifest_file_name))
+
+## returns the index of all installed packages, from memory, from the manifest or by scanning the SDK
+def sdk_inventory_get(sdk_root):
+    if sdk_root in __inventories:
+        return __inventories[sdk_root]
+
+    packages = sdk_inventory_load(sdk_root)
+    if packages is None:
+        if not os.path.isdir(sdk_root):
+            return {}
+
+        # create the manifest directory before scanning, so the recorded mtime of the root stays valid
+        try:
+            os.makedirs(os.path.join(sdk_root, SDK_INVENTORY_MANIFEST_DIR), exist_ok=True)
+        except OSError:
+            pass
+
+        packages, mtimes = sdk_inventory_scan(sdk_root)
+        sdk_inventory_save(sdk_root, packages, mtimes)
+
+    __inventories[sdk_root] = packages
+    return packages
+
+## has to be called after packages were installed or removed by this process
+def sdk_inventory_invalidate(sdk_root):
+    __inventories.pop(sdk_root, None)
+
+def sdk_inventory_get_package(sdk_root, package_path):
+    return sdk_inventory_get(sdk_root).get(package_path.replace(os.sep, "/"))
+
+## durations of tool runs are kept next to the manifest, to be able to tell how much a skipped run saved
+def sdk_inventory_record_duration(sdk_root, name, seconds):
+    try:
+        os.makedirs(os.path.join(sdk_root, SDK_INVENTORY_MANIFEST_DIR), exist_ok=True)
+        with open(os.path.join(sdk_root, SDK_INVENTORY_MANIFEST_DIR, name + ".duration"), 'w') as duration_file:
+            print("%.3f" % seconds, file=duration_file)
+    except OSError:
+        pass
+
+def sdk_inventory_read_duration(sdk_root, name):
+    try:
+        with open(os.path.join(sdk_root, SDK_INVENTORY_MANIFEST_DIR, name + ".duration"), 'r') as duration_file:
+            return float(duration_file.readline().strip())
+    except (OSError, ValueError):
+        return None
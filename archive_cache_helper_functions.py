@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Node wide cache for downloaded archives, the entries are named after their sha256 checksum.
+## Entries are only ever added with an atomic rename, so concurrent builds on the same node
+## either see a complete archive or none at all. The mtime of an entry is used as last access
+## time for the LRU eviction.
+
+import os
+import re
+import shutil
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import jenkins_android_helper_commons
+
+ARCHIVE_CACHE_TMP_PREFIX = ".incoming-"
+
+def archive_cache_parse_size(size_str, default=0):
+    if size_str is None:
+        return default
+
+    match = re.match(r"^\s*([0-9]+)\s*([kKmMgGtT]?)[bB]?\s*$", size_str)
+    if not match:
+        return default
+
+    factor = { "": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4 }[match.group(2).lower()]
+    return int(match.group(1)) * factor
+
+def archive_cache_entry_path(cache_dir, checksum_sha256):
+    return os.path.join(cache_dir, checksum_sha256.lower())
+
+## returns a file name inside the cache directory, which can be used as download target and later passed
+## to archive_cache_insert, which is then a simple rename. If a name is given, the file name is stable
+## between runs, so an interrupted download can be resumed.
+def archive_cache_temp_file(cache_dir, name=""):
+    os.makedirs(cache_dir, exist_ok=True)
+    if name != "":
+        return os.path.join(cache_dir, ARCHIVE_CACHE_TMP_PREFIX + name)
+
+    fd, tmp_name = tempfile.mkstemp(dir=cache_dir, prefix=ARCHIVE_CACHE_TMP_PREFIX)
+    os.close(fd)
+    return tmp_name
+
+## serializes the download and insert of the same archive, a second run waits and then finds it in the
+## cache. The lock file is never removed, it is skipped by the eviction like the incoming files.
+@contextlib.contextmanager
+def archive_cache_locked(cache_dir, checksum_sha256):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, ARCHIVE_CACHE_TMP_PREFIX + checksum_sha256.lower() + ".lock"), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def archive_cache_lookup(cache_dir, checksum_sha256):
+    entry = archive_cache_entry_path(cache_dir, checksum_sha256)
+    if not jenkins_android_helper_commons.is_file(entry):
+        return ""
+
+    # verify on hit, a corrupt entry is dropped and treated as a miss
+    if jenkins_android_helper_commons.sha256sum(entry) != checksum_sha256.lower():
+        print("Cached archive [%s] is corrupt, removing it" % (entry))
+        jenkins_android_helper_commons.remove_file_or_dir(entry)
+        return ""
+
+    # mark as recently used
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+    return entry
+
+def archive_cache_insert(cache_dir, checksum_sha256, src, max_size=0):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = archive_cache_entry_path(cache_dir, checksum_sha256)
+
+    if os.path.dirname(os.path.abspath(src)) == os.path.abspath(cache_dir):
+        os.replace(src, entry)
+    else:
+        tmp_name = archive_cache_temp_file(cache_dir)
+        try:
+            shutil.copyfile(src, tmp_name)
+            os.replace(tmp_name, entry)
+        except:
+            jenkins_android_helper_commons.remove_file_or_dir(tmp_name)
+            raise
+
+    if max_size > 0:
+        archive_cache_evict(cache_dir, max_size, keep=entry)
+
+    return entry
+
+## remove the least recently used entries until the cache fits into max_size, the entry given
+## as keep is never removed, even if it alone exceeds the limit
+def archive_cache_evict(cache_dir, max_size, keep=""):
+    entries = []
+    total_size = 0
+    for entry_name in os.listdir(cache_dir):
+        if entry_name.startswith(ARCHIVE_CACHE_TMP_PREFIX):
+            continue
+
+        entry = os.path.join(cache_dir, entry_name)
+        try:
+            st = os.stat(entry)
+        except OSError:
+            continue
+
+        entries = entries + [ (st.st_mtime, st.st_size, entry) ]
+        total_size = total_size + st.st_size
+
+    for mtime, size, entry in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        if entry == keep:
+            continue
+
+        print("Evicting archive [%s] from cache" % (entry))
+        jenkins_android_helper_commons.remove_file_or_dir(entry)
+        total_size = total_size - size
+
+    return total_size
@@ -0,0 +1,1088 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Benchmark of jenkins_android_sdk_installer and every mode of jenkins_android_emulator_helper, without network
+## access, KVM or a real SDK:
+##  - a local HTTP server (with range requests, optional bandwidth limit and latency) serves synthetic, but
+##    reproducible, SDK tools and NDK archives
+##  - the SDK tools archive contains stub sdkmanager/avdmanager scripts with a configurable JVM start delay, the
+##    stub sdkmanager installs stub emulator, mksdcard, qemu-img and adb binaries
+##  - the stub emulator listens on its console and adb port, finishes its boot after a configurable delay and
+##    answers the console commands the helper sends (kill, avd snapshot save)
+##  - the stub adb server speaks the smart socket protocol, device shells run locally with stub getprop,
+##    setprop and settings commands
+##  - builds with their own workspace start pools at the same time, the benchmark fails if two of their
+##    emulators end up on the same port
+##  - single functions of the helpers are measured in a fresh interpreter against the implementation they
+##    replaced, eg the worker pool of unzip against the extraction one entry after the other, or a download
+##    in one segment against one in parallel segments from a server limiting the bandwidth per connection
+##  - the peak RSS (steps ending with -mib, in MiB) of an interpreter downloading a big file, streamed by
+##    download_file against the whole response read into memory
+## Every step is a fresh interpreter running the tool with runpy, only the download base url and the archive
+## checksums of AndroidSDK are pointed to the synthetic archives. The medians of all steps can be stored as
+## baseline and compared with later runs, a step slower than the baseline by more than the threshold fails.
+##
+##   benchmark/jenkins_android_helper_benchmark.py -r 5 -o baseline.json
+##   benchmark/jenkins_android_helper_benchmark.py -r 5 -b baseline.json
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import http.server
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SYSTEM_IMAGE = "system-images;android-24;default;x86_64"
+PLATFORM_VERSION = "27"
+BUILD_TOOLS_VERSION = "27.0.1"
+DEVICE_SETTINGS = [ "global:stay_on_while_plugged_in=7", "global:hidden_api_policy=1", "secure:immersive_mode_confirmations=confirmed", "prop:debug.hwui.renderer=skiagl" ]
+
+## a regression is only reported if the step is also slower by this many seconds, below that it is noise
+REGRESSION_MIN_SECONDS = 0.05
+## steps with this suffix measure memory in MiB, a regression needs to be at least this many MiB
+MEMORY_STEP_SUFFIX = "-mib"
+REGRESSION_MIN_MIB = 1.0
+
+## runs a tool in this interpreter with the download location and checksums patched, argv: <tool> <args...>
+BOOTSTRAP = """
+import sys, os, json, runpy
+sys.path.insert(0, os.environ["JAH_BENCH_REPO"])
+import jenkins_android_sdk
+for key, value in json.loads(os.environ["JAH_BENCH_SDK_PATCH"]).items():
+    if isinstance(value, dict):
+        getattr(jenkins_android_sdk.AndroidSDK, key).update(value)
+    else:
+        setattr(jenkins_android_sdk.AndroidSDK, key, value)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+## Measurements: run in a fresh interpreter with the repo in the path, print the measured value as last line
+MEASURE_UNZIP_WORKER_POOL = """
+import os, sys, time
+sys.path.insert(0, os.environ["JAH_BENCH_REPO"])
+import jenkins_android_helper_commons
+
+archive, dest = sys.argv[1:3]
+start = time.monotonic()
+jenkins_android_helper_commons.unzip(archive, dest)
+print(time.monotonic() - start)
+"""
+
+## the extraction unzip did before the worker pool
+MEASURE_UNZIP_PER_ENTRY = """
+import os, sys, time
+from zipfile import ZipFile
+
+archive, dest = sys.argv[1:3]
+start = time.monotonic()
+with ZipFile(archive, 'r') as zf:
+    for info in zf.infolist():
+        zf.extract(info.filename, path=dest)
+        os.chmod(os.path.join(dest, info.filename), info.external_attr >> 16)
+print(time.monotonic() - start)
+"""
+
+## seconds per lookup of the listening ports of a process with an emulator's console and adb port open,
+## argv: proc|lsof, number of lookups. For lsof the /proc lookup fails, like on a node with hidepid.
+MEASURE_OPEN_PORTS = """
+import os, sys, time, socket
+sys.path.insert(0, os.environ["JAH_BENCH_REPO"])
+import android_emulator_helper_functions
+
+method, lookups = sys.argv[1], int(sys.argv[2])
+listening = []
+for idx in range(0, 2):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    listening.append(sock)
+
+if method == "lsof":
+    def proc_not_readable(pid):
+        raise PermissionError("/proc not readable")
+    android_emulator_helper_functions.get_open_ports_for_process_from_proc = proc_not_readable
+
+expected = sorted([ str(sock.getsockname()[1]) for sock in listening ])
+start = time.monotonic()
+for idx in range(0, lookups):
+    ports = android_emulator_helper_functions.get_open_ports_for_process(os.getpid())
+duration = time.monotonic() - start
+if sorted(ports) != expected:
+    sys.exit("Ports found with %s: %s, expected: %s" % (method, ports, expected))
+print(duration / lookups)
+"""
+
+## seconds of download_file, argv: url, dest, segments, expected sha256
+MEASURE_DOWNLOAD = """
+import os, sys, time
+sys.path.insert(0, os.environ["JAH_BENCH_REPO"])
+import jenkins_android_helper_commons
+
+url, dest, segments, expected = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]
+start = time.monotonic()
+checksum = jenkins_android_helper_commons.download_file(url, dest, segments=segments)
+duration = time.monotonic() - start
+if checksum != expected:
+    sys.exit("Checksum of the download: %s, expected: %s" % (checksum, expected))
+print(duration)
+"""
+
+## peak RSS in MiB of the downloading interpreter, argv: streamed|whole-response, url, dest
+MEASURE_DOWNLOAD_PEAK_RSS = """
+import os, sys, resource, urllib.request
+sys.path.insert(0, os.environ["JAH_BENCH_REPO"])
+import jenkins_android_helper_commons
+
+method, url, dest = sys.argv[1:4]
+# ru_maxrss is in KiB, on macOS in bytes
+rss_unit = 1 if sys.platform == "darwin" else 1024
+if method == "streamed":
+    jenkins_android_helper_commons.download_file(url, dest)
+else:
+    # the download before it was streamed
+    with urllib.request.urlopen(url) as response, open(dest, "wb") as output:
+        output.write(response.read())
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / (1024.0 * 1024.0))
+"""
+
+STUB_SDKMANAGER = """
+import os, sys, time, shutil
+
+sdk = os.environ["ANDROID_SDK_ROOT"]
+stubs = os.path.join(os.environ["JAH_BENCH_DIR"], "stubs")
+
+# JVM start and repository index
+time.sleep(float(os.environ["JAH_BENCH_JVM_DELAY"]))
+sys.stdin.read()
+
+for package in [ arg for arg in sys.argv[1:] if not arg.startswith("-") ]:
+    print("Installing " + package)
+    time.sleep(float(os.environ["JAH_BENCH_PACKAGE_DELAY"]))
+
+    package_dir = os.path.join(sdk, *package.split(";"))
+    os.makedirs(package_dir, exist_ok=True)
+    if os.path.isdir(os.path.join(stubs, package)):
+        for stub in os.listdir(os.path.join(stubs, package)):
+            shutil.copy2(os.path.join(stubs, package, stub), os.path.join(package_dir, stub))
+    if package.startswith("system-images;"):
+        for image in [ "system.img", "vendor.img", "ramdisk.img", "userdata.img" ]:
+            with open(os.path.join(package_dir, image), "wb") as image_file:
+                image_file.truncate(8 * 1024 * 1024)
+
+    with open(os.path.join(package_dir, "source.properties"), "w") as props:
+        props.write("Pkg.Path=" + package + "\\nPkg.Revision=" + ("5" if package.startswith("system-images;") else "1.0.0") + "\\nPkg.Desc=" + package + "\\n")
+"""
+
+STUB_AVDMANAGER = """
+import os, sys, time
+
+time.sleep(float(os.environ["JAH_BENCH_JVM_DELAY"]))
+
+args = sys.argv[1:]
+def arg_value(name, default=""):
+    return args[args.index(name) + 1] if name in args and args.index(name) + 1 < len(args) else default
+
+avd_home = os.environ["ANDROID_AVD_HOME"]
+avd_name = arg_value("-n")
+image = arg_value("-k")
+sdcard = arg_value("-c")
+
+# custom hardware profile?
+sys.stdin.read()
+
+avd_dir = os.path.join(avd_home, avd_name + ".avd")
+os.makedirs(avd_dir, exist_ok=True)
+with open(os.path.join(avd_home, avd_name + ".ini"), "w") as avd_ini:
+    avd_ini.write("avd.ini.encoding=UTF-8\\npath=" + avd_dir + "\\npath.rel=avd/" + avd_name + ".avd\\ntarget=" + image.split(";")[1] + "\\n")
+
+config = [ "AvdId=" + avd_name, "avd.ini.displayname=" + avd_name, "abi.type=x86_64", "image.sysdir.1=" + "/".join(image.split(";")) + "/", "hw.ramSize=1536" ]
+if sdcard != "":
+    units = { "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024 }
+    with open(os.path.join(avd_dir, "sdcard.img"), "wb") as sdcard_file:
+        sdcard_file.truncate(int(sdcard[:-1]) * units[sdcard[-1].upper()] if sdcard[-1].upper() in units else int(sdcard))
+    config = config + [ "sdcard.size=" + sdcard, "hw.sdCard=yes" ]
+with open(os.path.join(avd_dir, "config.ini"), "w") as config_file:
+    config_file.write("\\n".join(config) + "\\n")
+with open(os.path.join(avd_dir, "userdata.img"), "wb") as userdata:
+    userdata.write(os.urandom(256 * 1024))
+"""
+
+STUB_EMULATOR = """#!/bin/bash
+exec -a qemu-system-x86_64 "{python}" "$JAH_BENCH_DIR/stubs/fake_emulator.py" "$@"
+"""
+
+STUB_FAKE_EMULATOR = """
+import os, sys, time, socket, signal, shutil, threading
+
+args = sys.argv[1:]
+def arg_value(name, default=""):
+    return args[args.index(name) + 1] if name in args and args.index(name) + 1 < len(args) else default
+
+avd_name = arg_value("-avd")
+console_port = int(arg_value("-port", "5554"))
+snapshot = arg_value("-snapshot")
+avd_dir = os.path.join(os.environ["ANDROID_AVD_HOME"], avd_name + ".avd")
+device_dir = os.path.join(os.environ["JAH_BENCH_DIR"], "devices", "emulator-%d" % console_port)
+
+time.sleep(float(os.environ["JAH_BENCH_EMULATOR_START_DELAY"]))
+
+console = socket.socket()
+console.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+console.bind(("127.0.0.1", console_port))
+console.listen()
+adbd = socket.socket()
+adbd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+adbd.bind(("127.0.0.1", console_port + 1))
+adbd.listen()
+
+shutil.rmtree(device_dir, ignore_errors=True)
+os.makedirs(device_dir)
+with open(os.path.join(device_dir, "pid"), "w") as pid_file:
+    pid_file.write(str(os.getpid()))
+
+def shutdown(*unused):
+    shutil.rmtree(device_dir, ignore_errors=True)
+    os._exit(0)
+signal.signal(signal.SIGTERM, shutdown)
+
+# like the emulator, a raw sdcard image outside the avd is only written through a qcow2 overlay within it
+sdcard_path = ""
+with open(os.path.join(avd_dir, "config.ini")) as config_file:
+    for line in config_file:
+        if line.split("=", 1)[0].strip() == "hw.sdCard.path":
+            sdcard_path = line.split("=", 1)[1].strip()
+if sdcard_path != "" and os.path.dirname(sdcard_path) != avd_dir:
+    sdcard_overlay = os.path.join(avd_dir, os.path.basename(sdcard_path) + ".qcow2")
+    if not os.path.exists(sdcard_overlay):
+        with open(sdcard_overlay, "wb") as overlay_file:
+            overlay_file.write(bytes(196608))
+
+from_snapshot = snapshot != "" and os.path.isdir(os.path.join(avd_dir, "snapshots", snapshot))
+boot_delay = float(os.environ["JAH_BENCH_SNAPSHOT_BOOT_DELAY" if from_snapshot else "JAH_BENCH_BOOT_DELAY"])
+def boot():
+    time.sleep(boot_delay)
+    open(os.path.join(device_dir, "booted"), "w").close()
+threading.Thread(target=boot, daemon=True).start()
+
+def accept_adbd():
+    while True:
+        adbd.accept()[0].close()
+threading.Thread(target=accept_adbd, daemon=True).start()
+
+def handle_console(conn):
+    reader = conn.makefile("rb")
+    try:
+        conn.sendall(b"Android Console: type 'help' for a list of commands\\r\\nOK\\r\\n")
+        for line in reader:
+            command = line.decode("utf-8", errors="replace").strip()
+            if command == "kill":
+                conn.sendall(b"OK: killing emulator, bye bye\\r\\n")
+                conn.close()
+                shutdown()
+            if command.startswith("avd snapshot save "):
+                time.sleep(float(os.environ["JAH_BENCH_SNAPSHOT_SAVE_DELAY"]))
+                os.makedirs(os.path.join(avd_dir, "snapshots", command.split()[3]), exist_ok=True)
+            conn.sendall(b"OK\\r\\n")
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+while True:
+    threading.Thread(target=handle_console, args=(console.accept()[0],), daemon=True).start()
+"""
+
+STUB_FAKE_ADB_SERVER = """
+import os, sys, socket, threading, subprocess
+
+bench = os.environ["JAH_BENCH_DIR"]
+devices_dir = os.path.join(bench, "devices")
+device_bin = os.path.join(bench, "stubs", "device-bin")
+
+def recv_exactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data = data + chunk
+    return data
+
+def read_request(conn):
+    return recv_exactly(conn, int(recv_exactly(conn, 4), 16)).decode("utf-8")
+
+def okay(conn, payload=None):
+    conn.sendall(b"OKAY" + (b"" if payload is None else b"%04x" % len(payload.encode("utf-8")) + payload.encode("utf-8")))
+
+def fail(conn, message):
+    conn.sendall(b"FAIL" + b"%04x" % len(message.encode("utf-8")) + message.encode("utf-8"))
+
+def device_dir(serial):
+    path = os.path.join(devices_dir, serial)
+    try:
+        with open(os.path.join(path, "pid")) as pid_file:
+            os.kill(int(pid_file.read()), 0)
+        return path
+    except (OSError, ValueError):
+        return None
+
+def running_devices():
+    return [ serial for serial in sorted(os.listdir(devices_dir)) if device_dir(serial) is not None ] if os.path.isdir(devices_dir) else []
+
+def run_service(conn, path, service):
+    env = dict(os.environ, FAKE_DEVICE_DIR=path, PATH=device_bin + os.pathsep + os.environ["PATH"])
+    if service.startswith("shell:"):
+        okay(conn)
+        proc = subprocess.Popen([ "sh", "-c", service[len("shell:"):] ], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        try:
+            for chunk in iter(lambda: os.read(proc.stdout.fileno(), 65536), b""):
+                conn.sendall(chunk.replace(b"\\n", b"\\r\\n"))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+    elif service == "exec:sh":
+        okay(conn)
+        subprocess.run([ "sh" ], stdin=conn.fileno(), stdout=conn.fileno(), stderr=subprocess.STDOUT, env=env)
+    else:
+        fail(conn, "unsupported service " + service)
+
+def handle(conn):
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        request = read_request(conn)
+        if request == "host:version":
+            okay(conn, "0029")
+        elif request == "host:kill":
+            okay(conn)
+            os._exit(0)
+        elif request == "host:devices":
+            okay(conn, "".join([ serial + "\\tdevice\\n" for serial in running_devices() ]))
+        elif request.startswith("host-serial:") and request.endswith(":get-state"):
+            serial = request[len("host-serial:"):-len(":get-state")]
+            if device_dir(serial) is not None:
+                okay(conn, "device")
+            else:
+                fail(conn, "device '" + serial + "' not found")
+        elif request.startswith("host:transport:"):
+            path = device_dir(request[len("host:transport:"):])
+            if path is None:
+                fail(conn, "device not found")
+                return
+            okay(conn)
+            run_service(conn, path, read_request(conn))
+        else:
+            fail(conn, "unknown request " + request)
+    except (EOFError, OSError, ValueError):
+        pass
+    finally:
+        conn.close()
+
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(("127.0.0.1", int(os.environ.get("ANDROID_ADB_SERVER_PORT", "5037"))))
+server.listen(64)
+with open(os.path.join(bench, "adb-server.pid"), "w") as pid_file:
+    pid_file.write(str(os.getpid()))
+
+while True:
+    threading.Thread(target=handle, args=(server.accept()[0],), daemon=True).start()
+"""
+
+STUB_ADB = """
+import os, sys, time, socket, subprocess
+
+bench = os.environ["JAH_BENCH_DIR"]
+port = int(os.environ.get("ANDROID_ADB_SERVER_PORT", "5037"))
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data = data + chunk
+    return data
+
+def request(sock, payload):
+    sock.sendall(b"%04x" % len(payload.encode("utf-8")) + payload.encode("utf-8"))
+    if recv_exactly(sock, 4) != b"OKAY":
+        raise RuntimeError(recv_exactly(sock, int(recv_exactly(sock, 4), 16)).decode("utf-8"))
+
+def host_query(payload):
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+        request(sock, payload)
+        return recv_exactly(sock, int(recv_exactly(sock, 4), 16)).decode("utf-8")
+
+def ensure_server():
+    try:
+        host_query("host:version")
+        return
+    except (OSError, EOFError, RuntimeError):
+        pass
+    subprocess.Popen([ sys.executable, os.path.join(bench, "stubs", "fake_adb_server.py") ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for attempt in range(200):
+        try:
+            host_query("host:version")
+            return
+        except (OSError, EOFError, RuntimeError):
+            time.sleep(0.025)
+
+args = sys.argv[1:]
+serial = os.environ.get("ANDROID_SERIAL", "")
+if args[:1] == [ "-s" ]:
+    serial = args[1]
+    args = args[2:]
+command = args[0] if len(args) > 0 else ""
+
+if command == "kill-server":
+    try:
+        host_query("host:kill")
+    except (OSError, EOFError, RuntimeError):
+        pass
+    sys.exit(0)
+
+ensure_server()
+if command == "start-server":
+    sys.exit(0)
+
+if command == "devices":
+    print("List of devices attached")
+    print(host_query("host:devices"), end="")
+    sys.exit(0)
+
+if command == "wait-for-device":
+    while True:
+        try:
+            host_query("host-serial:" + serial + ":get-state")
+            break
+        except (OSError, EOFError, RuntimeError):
+            time.sleep(0.1)
+    args = args[1:]
+    command = args[0] if len(args) > 0 else ""
+
+if command == "shell":
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        request(sock, "host:transport:" + serial)
+        request(sock, "shell:" + " ".join(args[1:]))
+        for chunk in iter(lambda: sock.recv(65536), b""):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+    sys.exit(0)
+
+if command == "emu":
+    with socket.create_connection(("127.0.0.1", int(serial.split("-")[1])), timeout=10) as sock:
+        reader = sock.makefile("rb")
+        while not reader.readline().startswith(b"OK"):
+            pass
+        sock.sendall((" ".join(args[1:]) + "\\r\\n").encode("utf-8"))
+        reader.readline()
+    sys.exit(0)
+
+print("adb stub: unsupported command " + " ".join(sys.argv[1:]), file=sys.stderr)
+sys.exit(1)
+"""
+
+STUB_DEVICE_GETPROP = """#!/bin/sh
+case "$1" in
+    sys.boot_completed) [ -f "$FAKE_DEVICE_DIR/booted" ] && echo 1 || echo "";;
+    init.svc.bootanim) [ -f "$FAKE_DEVICE_DIR/booted" ] && echo stopped || echo running;;
+    *) cat "$FAKE_DEVICE_DIR/prop.$1" 2>/dev/null || echo "";;
+esac
+"""
+
+STUB_DEVICE_SETPROP = """#!/bin/sh
+echo "$2" > "$FAKE_DEVICE_DIR/prop.$1"
+"""
+
+STUB_DEVICE_SETTINGS = """#!/bin/sh
+case "$1" in
+    get) cat "$FAKE_DEVICE_DIR/settings.$2.$3" 2>/dev/null || echo null;;
+    put) echo "$4" > "$FAKE_DEVICE_DIR/settings.$2.$3";;
+    *) echo "Error: unknown command $1"; exit 1;;
+esac
+"""
+
+STUB_MKSDCARD = """#!/bin/sh
+truncate -s "$1" "$2"
+"""
+
+STUB_QEMU_IMG = """#!/bin/sh
+case "$1" in
+    info)
+        echo '{}';;
+esac
+"""
+
+## serves the files of a directory with range requests, optionally limited in bandwidth and with a latency
+## before every answer
+class ArchiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    directory = ""
+    bandwidth = 0
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.__answer(send_body=False)
+
+    def do_GET(self):
+        self.__answer(send_body=True)
+
+    def __answer(self, send_body):
+        time.sleep(self.latency)
+        file_name = os.path.join(self.directory, os.path.basename(self.path))
+        if not os.path.isfile(file_name):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(file_name)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            range_start, range_end = range_header[len("bytes="):].split(",")[0].split("-")
+            start = int(range_start) if range_start != "" else max(size - int(range_end), 0)
+            end = min(int(range_end), size - 1) if range_end != "" and range_start != "" else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        with open(file_name, "rb") as archive:
+            archive.seek(start)
+            remaining = end - start + 1
+            chunk_size = 64 * 1024
+            sent_start = time.monotonic()
+            sent = 0
+            while remaining > 0:
+                chunk = archive.read(min(chunk_size, remaining))
+                try:
+                    self.wfile.write(chunk)
+                except OSError:
+                    return
+                remaining = remaining - len(chunk)
+                sent = sent + len(chunk)
+                if self.bandwidth > 0:
+                    ahead = sent / self.bandwidth - (time.monotonic() - sent_start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+## serves the files of the measurements, limited to the bandwidth of the throttled download scenario
+class ThrottledRequestHandler(ArchiveRequestHandler):
+    pass
+
+def write_file(file_name, content, executable=False):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, "w") as stub_file:
+        stub_file.write(content)
+    if executable:
+        os.chmod(file_name, 0o755)
+
+def python_stub(source):
+    return "#!" + sys.executable + "\n" + source.lstrip("\n")
+
+def zip_add(archive, name, data, executable=False):
+    info = zipfile.ZipInfo(name, date_time=(2018, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = ((0o100755 if executable else 0o100644) << 16)
+    archive.writestr(info, data)
+
+## the same seed gives the same archive (and checksum), half of the files compress well, half not at all
+def zip_add_filler(archive, prefix, file_count, total_size, seed):
+    rnd = random.Random(seed)
+    file_size = max(total_size // max(file_count, 1), 1)
+    for idx in range(0, file_count):
+        if idx % 2 == 0:
+            data = rnd.getrandbits(8 * file_size).to_bytes(file_size, "little")
+        else:
+            data = (("line %d of a generated file with some text in it\n" % idx) * (file_size // 40 + 1)).encode("utf-8")[:file_size]
+        zip_add(archive, "%s/lib%03d/file%05d.bin" % (prefix, idx % 97, idx), data)
+
+def sha256_of(file_name):
+    checksum = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.bench_dir = tempfile.mkdtemp(prefix="jenkins-android-helper-benchmark-")
+        self.stubs_dir = os.path.join(self.bench_dir, "stubs")
+        self.archives_dir = os.path.join(self.bench_dir, "archives")
+        self.measurements_dir = os.path.join(self.bench_dir, "measurements")
+        self.http_server = None
+        self.throttled_http_server = None
+        self.results = {}
+        self.adb_server_port = free_port()
+        self.sdk_patch = {}
+
+    def setup(self):
+        import jenkins_android_sdk
+
+        write_file(os.path.join(self.stubs_dir, "emulator", "emulator"), STUB_EMULATOR.format(python=sys.executable), executable=True)
+        write_file(os.path.join(self.stubs_dir, "emulator", "mksdcard"), STUB_MKSDCARD, executable=True)
+        write_file(os.path.join(self.stubs_dir, "emulator", "qemu-img"), STUB_QEMU_IMG, executable=True)
+        write_file(os.path.join(self.stubs_dir, "platform-tools", "adb"), python_stub(STUB_ADB), executable=True)
+        write_file(os.path.join(self.stubs_dir, "fake_emulator.py"), STUB_FAKE_EMULATOR)
+        write_file(os.path.join(self.stubs_dir, "fake_adb_server.py"), STUB_FAKE_ADB_SERVER)
+        write_file(os.path.join(self.stubs_dir, "device-bin", "getprop"), STUB_DEVICE_GETPROP, executable=True)
+        write_file(os.path.join(self.stubs_dir, "device-bin", "setprop"), STUB_DEVICE_SETPROP, executable=True)
+        write_file(os.path.join(self.stubs_dir, "device-bin", "settings"), STUB_DEVICE_SETTINGS, executable=True)
+        os.makedirs(os.path.join(self.bench_dir, "home"))
+
+        print("Generating the synthetic archives (SDK tools: %d MiB, NDK: %d MiB)" % (self.args.tools_size, self.args.ndk_size))
+        os.makedirs(self.archives_dir)
+        sdk = jenkins_android_sdk.AndroidSDK
+        tools_archive = os.path.join(self.archives_dir, sdk.ANDROID_SDK_TOOLS_ARCHIVE[sys.platform])
+        with zipfile.ZipFile(tools_archive, "w") as archive:
+            zip_add(archive, "tools/source.properties", "Pkg.Revision=%s\nPkg.Path=%s\nPkg.Desc=%s\n" % (sdk.ANDROID_SDK_TOOLS_PROP_VAL_PKG_REV, sdk.ANDROID_SDK_TOOLS_PROP_VAL_PKG_PATH, sdk.ANDROID_SDK_TOOLS_PROP_VAL_PKG_DESC))
+            zip_add(archive, "tools/bin/sdkmanager", python_stub(STUB_SDKMANAGER), executable=True)
+            zip_add(archive, "tools/bin/avdmanager", python_stub(STUB_AVDMANAGER), executable=True)
+            zip_add_filler(archive, "tools/lib", self.args.tools_files, self.args.tools_size * 1024 * 1024, seed=1)
+
+        ndk_archive = os.path.join(self.archives_dir, sdk.ANDROID_NDK_ARCHIVE[sys.platform])
+        with zipfile.ZipFile(ndk_archive, "w") as archive:
+            zip_add(archive, sdk.ANDROID_NDK_ARCHIVE_DIR + "/source.properties", "Pkg.Desc = %s\nPkg.Revision = %s\n" % (sdk.ANDROID_NDK_PROP_VAL_PKG_DESC, sdk.ANDROID_NDK_PROP_VAL_PKG_REV))
+            zip_add_filler(archive, sdk.ANDROID_NDK_ARCHIVE_DIR + "/toolchains", self.args.ndk_files, self.args.ndk_size * 1024 * 1024, seed=2)
+
+        print("Generating the many-file archive (%d files, %d MiB)" % (self.args.unzip_files, self.args.unzip_size))
+        os.makedirs(self.measurements_dir)
+        with zipfile.ZipFile(os.path.join(self.measurements_dir, "many-files.zip"), "w") as archive:
+            zip_add_filler(archive, "many-files", self.args.unzip_files, self.args.unzip_size * 1024 * 1024, seed=3)
+        with open(os.path.join(self.measurements_dir, "large-download.bin"), "wb") as large_download:
+            rnd = random.Random(4)
+            for mib in range(0, self.args.download_size):
+                large_download.write(rnd.getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, "little"))
+        # also served without a bandwidth limit
+        os.link(os.path.join(self.measurements_dir, "large-download.bin"), os.path.join(self.archives_dir, "large-download.bin"))
+
+        ArchiveRequestHandler.directory = self.archives_dir
+        ArchiveRequestHandler.bandwidth = self.args.bandwidth * 1024 * 1024
+        ArchiveRequestHandler.latency = self.args.latency / 1000.0
+        self.http_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveRequestHandler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+        ThrottledRequestHandler.directory = self.measurements_dir
+        ThrottledRequestHandler.bandwidth = self.args.throttled_bandwidth * 1024 * 1024
+        ThrottledRequestHandler.latency = self.args.latency / 1000.0
+        self.throttled_http_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ThrottledRequestHandler)
+        self.throttled_http_server.daemon_threads = True
+        threading.Thread(target=self.throttled_http_server.serve_forever, daemon=True).start()
+
+        self.sdk_patch = { "ANDROID_SDK_BASE_URL": "http://127.0.0.1:%d" % self.http_server.server_address[1],
+            "ANDROID_SDK_TOOLS_ARCHIVE_SHA256_CHECKSUM": { sys.platform: sha256_of(tools_archive) },
+            "ANDROID_NDK_ARCHIVE_SHA256_CHECKSUM": { sys.platform: sha256_of(ndk_archive) } }
+
+    def teardown(self):
+        # emulators which survived a failed step and the adb server
+        devices_dir = os.path.join(self.bench_dir, "devices")
+        pid_files = [ os.path.join(self.bench_dir, "adb-server.pid") ]
+        if os.path.isdir(devices_dir):
+            pid_files = pid_files + [ os.path.join(devices_dir, device, "pid") for device in os.listdir(devices_dir) ]
+        for pid_file in pid_files:
+            try:
+                with open(pid_file) as f:
+                    os.kill(int(f.read()), 9)
+            except (OSError, ValueError):
+                pass
+
+        for http_server in [ self.http_server, self.throttled_http_server ]:
+            if http_server is not None:
+                http_server.shutdown()
+
+        if self.args.keep:
+            print("Benchmark directory kept: " + self.bench_dir)
+        else:
+            shutil.rmtree(self.bench_dir, ignore_errors=True)
+
+    ## a new SDK root, workspace and caches for one run of a scenario
+    def environment(self, name, sdk_root=None, archive_cache=None):
+        run_dir = tempfile.mkdtemp(prefix=name + "-", dir=self.bench_dir)
+        env = dict(os.environ,
+            HOME=os.path.join(self.bench_dir, "home"),
+            PATH=os.path.dirname(sys.executable) + os.pathsep + os.environ.get("PATH", ""),
+            ANDROID_SDK_ROOT=sdk_root if sdk_root is not None else os.path.join(run_dir, "sdk"),
+            WORKSPACE=os.path.join(run_dir, "workspace"),
+            ANDROID_SDK_ARCHIVE_CACHE_DIR=archive_cache if archive_cache is not None else os.path.join(run_dir, "archive-cache"),
+            ANDROID_AVD_TEMPLATE_CACHE_DIR=os.path.join(run_dir, "avd-templates"),
+            ANDROID_AVD_SHARED_STORE_DIR=os.path.join(run_dir, "avd-store"),
+            ANDROID_EMULATOR_PORT_LEASE_DIR=os.path.join(self.bench_dir, "ports"),
+            ANDROID_ADB_SERVER_PORT=str(self.adb_server_port),
+            JAH_BENCH_DIR=self.bench_dir,
+            JAH_BENCH_REPO=REPO_DIRECTORY,
+            JAH_BENCH_SDK_PATCH=json.dumps(self.sdk_patch),
+            JAH_BENCH_JVM_DELAY=str(self.args.jvm_delay),
+            JAH_BENCH_PACKAGE_DELAY=str(self.args.package_delay),
+            JAH_BENCH_EMULATOR_START_DELAY=str(self.args.emulator_start_delay),
+            JAH_BENCH_BOOT_DELAY=str(self.args.boot_delay),
+            JAH_BENCH_SNAPSHOT_BOOT_DELAY=str(self.args.snapshot_boot_delay),
+            JAH_BENCH_SNAPSHOT_SAVE_DELAY=str(self.args.snapshot_save_delay))
+        env.pop("ANDROID_HOME", None)
+        env.pop("ANDROID_SERIAL", None)
+        if self.args.trace:
+            env["JENKINS_ANDROID_HELPER_TRACE"] = "jsonl"
+        os.makedirs(env["WORKSPACE"])
+        return env
+
+    ## runs the tool, with a name (and record) the duration is recorded for that step
+    def run_step(self, env, name, tool, tool_args, record=True):
+        if self.args.verbose:
+            print("Step [%s]: %s %s" % (name, tool, " ".join(tool_args)), flush=True)
+
+        # the output goes to a file, a pipe would be kept open by the emulators started in the background
+        step_start = time.monotonic()
+        with tempfile.TemporaryFile(dir=self.bench_dir) as output:
+            try:
+                returncode = subprocess.run([ sys.executable, "-c", BOOTSTRAP, os.path.join(REPO_DIRECTORY, tool) ] + tool_args, cwd=env["WORKSPACE"], env=env,
+                    stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT, timeout=self.args.step_timeout).returncode
+            except subprocess.TimeoutExpired:
+                returncode = "a timeout after %d seconds" % self.args.step_timeout
+            duration = time.monotonic() - step_start
+            output.seek(0)
+            output_text = output.read().decode("utf-8", errors="replace")
+
+        if returncode != 0:
+            print(output_text)
+            raise RuntimeError("Step [%s] (%s %s) failed with %s" % (name, tool, " ".join(tool_args), returncode))
+
+        if self.args.verbose:
+            print(output_text)
+
+        if name is not None and record:
+            self.results.setdefault(name, []).append(duration)
+        return duration
+
+    ## runs the step in all environments at the same time, the wall time until all finished is recorded
+    def run_step_concurrently(self, envs, name, tool, tool_args):
+        errors = []
+        def run(env):
+            try:
+                self.run_step(env, name, tool, tool_args, record=False)
+            except RuntimeError as e:
+                errors.append(e)
+
+        step_start = time.monotonic()
+        threads = [ threading.Thread(target=run, args=(env,)) for env in envs ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+        self.results.setdefault(name, []).append(time.monotonic() - step_start)
+
+    ## runs the measurement source in a fresh interpreter and records the value it printed last for the step
+    def run_measurement(self, name, source, measurement_args):
+        if self.args.verbose:
+            print("Measurement [%s]: %s" % (name, " ".join(measurement_args)), flush=True)
+
+        try:
+            result = subprocess.run([ sys.executable, "-c", source ] + measurement_args, cwd=self.measurements_dir, env=dict(os.environ, JAH_BENCH_REPO=REPO_DIRECTORY),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.args.step_timeout)
+        except subprocess.TimeoutExpired:
+            raise RuntimeError("Measurement [%s] failed with a timeout after %d seconds" % (name, self.args.step_timeout))
+
+        output_text = result.stdout.decode("utf-8", errors="replace")
+        if result.returncode != 0:
+            print(output_text)
+            raise RuntimeError("Measurement [%s] failed with %s" % (name, result.returncode))
+
+        if self.args.verbose:
+            print(output_text)
+
+        value = float(output_text.strip().splitlines()[-1])
+        self.results.setdefault(name, []).append(value)
+        return value
+
+    ## every emulator recorded in the sessions of the workspaces has to run on its own port
+    def check_boot_mode(self, env, boot_mode):
+        import jenkins_android_sdk
+
+        boot_modes = []
+        for session_file_name in glob.glob(os.path.join(env["WORKSPACE"], jenkins_android_sdk.AndroidSDK.AVD_SESSION_STORE_FILENAME_FORMAT.format("*"))):
+            with open(session_file_name) as session_file:
+                boot_modes = boot_modes + [ json.load(session_file).get("boot_mode", "") ]
+
+        if boot_modes != [ boot_mode ]:
+            raise RuntimeError("Emulator expected to boot [%s], booted: [%s]" % (boot_mode, ", ".join(boot_modes)))
+
+    def check_ports_unique(self, envs, expected_count):
+        import jenkins_android_sdk
+
+        serials = []
+        for env in envs:
+            for session_file_name in glob.glob(os.path.join(env["WORKSPACE"], jenkins_android_sdk.AndroidSDK.AVD_SESSION_STORE_FILENAME_FORMAT.format("*"))):
+                with open(session_file_name) as session_file:
+                    serials = serials + [ json.load(session_file)["serial"] ]
+
+        devices_dir = os.path.join(self.bench_dir, "devices")
+        running = sorted(os.listdir(devices_dir)) if os.path.isdir(devices_dir) else []
+
+        if len(serials) != expected_count or len(set(serials)) != len(serials) or sorted(serials) != running:
+            raise RuntimeError("Port collision of concurrently started emulators: %d expected, sessions: [%s], running: [%s]" % (expected_count, ", ".join(sorted(serials)), ", ".join(running)))
+
+    def installer_args(self, pipelined=False):
+        return [ "-a", PLATFORM_VERSION, "-b", BUILD_TOOLS_VERSION, "-s", SYSTEM_IMAGE ] + ([ "-p" ] if pipelined else [])
+
+    ## download, extract and sdkmanager on an empty node, then again on the installed SDK, and a new SDK
+    ## with the archive cache of the first one
+    def scenario_installer(self):
+        env = self.environment("installer")
+        self.run_step(env, "installer/cold", "jenkins_android_sdk_installer", self.installer_args())
+        self.run_step(env, "installer/warm", "jenkins_android_sdk_installer", self.installer_args())
+
+        env = self.environment("installer-cached", archive_cache=env["ANDROID_SDK_ARCHIVE_CACHE_DIR"])
+        self.run_step(env, "installer/cached-archives", "jenkins_android_sdk_installer", self.installer_args())
+
+        env = self.environment("installer-pipelined")
+        self.run_step(env, "installer/cold-pipelined", "jenkins_android_sdk_installer", self.installer_args(pipelined=True))
+
+    ## extraction of an archive with many small files, with the worker pool and one entry after the other
+    def scenario_unzip(self):
+        archive = os.path.join(self.measurements_dir, "many-files.zip")
+        for name, source in [ ("unzip/worker-pool", MEASURE_UNZIP_WORKER_POOL), ("unzip/per-entry-loop", MEASURE_UNZIP_PER_ENTRY) ]:
+            dest = tempfile.mkdtemp(prefix="unzip-", dir=self.measurements_dir)
+            try:
+                self.run_measurement(name, source, [ archive, dest ])
+            finally:
+                shutil.rmtree(dest, ignore_errors=True)
+
+    ## lookup of the listening ports of a process from /proc and with lsof, if it is installed
+    def scenario_open_ports(self):
+        methods = [ "proc" ] + ([ "lsof" ] if shutil.which("lsof") is not None else [])
+        for method in methods:
+            self.run_measurement("open-ports/" + method, MEASURE_OPEN_PORTS, [ method, str(self.args.port_lookups) ])
+
+    ## a big archive from a server limiting the bandwidth per connection, in one and in parallel segments
+    def scenario_throttled_download(self):
+        url = "http://127.0.0.1:%d/large-download.bin" % self.throttled_http_server.server_address[1]
+        expected = sha256_of(os.path.join(self.measurements_dir, "large-download.bin"))
+        for segments in sorted(set([ 1, self.args.download_segments ])):
+            dest_dir = tempfile.mkdtemp(prefix="download-", dir=self.measurements_dir)
+            try:
+                self.run_measurement("download-throttled/segments-%d" % segments, MEASURE_DOWNLOAD, [ url, os.path.join(dest_dir, "large-download.bin"), str(segments), expected ])
+            finally:
+                shutil.rmtree(dest_dir, ignore_errors=True)
+
+    ## peak memory while downloading the big file, streamed and read into memory as a whole
+    def scenario_download_peak_rss(self):
+        url = "http://127.0.0.1:%d/large-download.bin" % self.http_server.server_address[1]
+        for method in [ "streamed", "whole-response" ]:
+            dest_dir = tempfile.mkdtemp(prefix="download-", dir=self.measurements_dir)
+            try:
+                self.run_measurement("download-peak-rss/%s-mib" % method, MEASURE_DOWNLOAD_PEAK_RSS, [ method, url, os.path.join(dest_dir, "large-download.bin") ])
+            finally:
+                shutil.rmtree(dest_dir, ignore_errors=True)
+
+    ## every mode of the emulator helper and the cmd wrapper on a pool of the given size
+    def scenario_emulator(self, sdk_root, pool_size):
+        prefix = "emulator-pool%d/" % pool_size
+        env = self.environment("emulator", sdk_root=sdk_root)
+        self.run_step(env, prefix + "create", "jenkins_android_emulator_helper", [ "-C", "-i", SYSTEM_IMAGE, "-s", "xhdpi", "-n", str(pool_size) ])
+        self.run_step(env, prefix + "start", "jenkins_android_emulator_helper", [ "-S", "-r", "768x1280", "-l", "en_US" ])
+        self.run_step(env, prefix + "wait", "jenkins_android_emulator_helper", [ "-W" ])
+        self.run_step(env, prefix + "disable-animations", "jenkins_android_emulator_helper", [ "-D" ])
+        self.run_step(env, prefix + "settings", "jenkins_android_emulator_helper", [ "-E", "-e" ] + DEVICE_SETTINGS)
+        self.run_step(env, prefix + "cmd-wrapper", "jenkins_android_cmd_wrapper", [ "true" ])
+        if pool_size > 1:
+            self.run_step(env, prefix + "cmd-wrapper-sharded", "jenkins_android_cmd_wrapper", [ "-N", "true" ])
+        self.run_step(env, prefix + "kill", "jenkins_android_emulator_helper", [ "-K", "-x" ])
+
+        # the template exists now
+        env["WORKSPACE"] = env["WORKSPACE"] + "-2"
+        os.makedirs(env["WORKSPACE"])
+        self.run_step(env, prefix + "create-from-template", "jenkins_android_emulator_helper", [ "-C", "-i", SYSTEM_IMAGE, "-s", "xhdpi", "-n", str(pool_size), "-o" ])
+        self.run_step(env, None, "jenkins_android_emulator_helper", [ "-K", "-x" ])
+
+    ## the first build in snapshot mode cold boots and saves the snapshot, the second build creates a new AVD
+    ## of the same configuration in a new workspace and boots from the snapshot published by the first one
+    def scenario_snapshot(self, sdk_root):
+        env = self.environment("snapshot", sdk_root=sdk_root)
+        for boot in [ "cold", "from-snapshot" ]:
+            self.run_step(env, None, "jenkins_android_emulator_helper", [ "-C", "-i", SYSTEM_IMAGE ])
+            self.run_step(env, "snapshot/start-" + boot, "jenkins_android_emulator_helper", [ "-S", "-l", "en_US", "-q" ])
+            self.run_step(env, "snapshot/wait-" + boot, "jenkins_android_emulator_helper", [ "-W" ])
+            self.check_boot_mode(env, "cold" if boot == "cold" else "snapshot")
+            self.run_step(env, "snapshot/kill-" + boot, "jenkins_android_emulator_helper", [ "-K", "-x" ])
+
+            env["WORKSPACE"] = env["WORKSPACE"] + "-2"
+            os.makedirs(env["WORKSPACE"])
+
+    ## builds with their own workspace create and start pools at the same time, they only share the port
+    ## lease directory and the adb server. The started emulators must not collide on a port.
+    def scenario_concurrent_start(self, sdk_root, builds, pool_size):
+        prefix = "concurrent-%dx%d/" % (builds, pool_size)
+        envs = [ self.environment("concurrent", sdk_root=sdk_root) for build in range(0, builds) ]
+        self.run_step_concurrently(envs, prefix + "create", "jenkins_android_emulator_helper", [ "-C", "-i", SYSTEM_IMAGE, "-n", str(pool_size) ])
+        try:
+            self.run_step_concurrently(envs, prefix + "start", "jenkins_android_emulator_helper", [ "-S", "-l", "en_US" ])
+            self.check_ports_unique(envs, builds * pool_size)
+            self.run_step_concurrently(envs, prefix + "wait", "jenkins_android_emulator_helper", [ "-W" ])
+        finally:
+            self.run_step_concurrently(envs, prefix + "kill", "jenkins_android_emulator_helper", [ "-K", "-x" ])
+
+    def run(self):
+        # the emulator scenarios share an SDK installed once up front
+        sdk_env = self.environment("sdk")
+        self.run_step(sdk_env, None, "jenkins_android_sdk_installer", self.installer_args())
+
+        for run in range(0, self.args.runs):
+            print("Run %d/%d" % (run + 1, self.args.runs))
+            self.scenario_installer()
+            self.scenario_unzip()
+            self.scenario_throttled_download()
+            self.scenario_download_peak_rss()
+            if sys.platform == "linux":
+                self.scenario_open_ports()
+            for pool_size in self.args.pool_sizes:
+                self.scenario_emulator(sdk_env["ANDROID_SDK_ROOT"], pool_size)
+            self.scenario_snapshot(sdk_env["ANDROID_SDK_ROOT"])
+            if self.args.concurrent_builds > 1:
+                self.scenario_concurrent_start(sdk_env["ANDROID_SDK_ROOT"], self.args.concurrent_builds, self.args.concurrent_pool_size)
+
+    def medians(self):
+        return { name: statistics.median(durations) for name, durations in self.results.items() }
+
+    def configuration(self):
+        return { key: value for key, value in vars(self.args).items() if not key in [ "baseline", "output", "keep", "verbose", "trace", "runs", "step_timeout" ] }
+
+## prints the results, compared with the baseline if there is one, returns the regressed steps
+def report(medians, results, baseline, threshold):
+    baseline_medians = baseline.get("medians", {}) if baseline is not None else {}
+    regressions = []
+
+    print("")
+    print("%-40s %9s %9s %9s %9s  %s" % ("step", "median", "min", "max", "baseline", "change"))
+    for name in sorted(medians.keys()):
+        unit, regression_min = ("M", REGRESSION_MIN_MIB) if name.endswith(MEMORY_STEP_SUFFIX) else ("s", REGRESSION_MIN_SECONDS)
+        change = ""
+        if name in baseline_medians and baseline_medians[name] > 0:
+            ratio = medians[name] / baseline_medians[name] - 1
+            change = "%+.1f%%" % (ratio * 100)
+            if ratio > threshold and medians[name] - baseline_medians[name] > regression_min:
+                change = change + " REGRESSION"
+                regressions = regressions + [ name ]
+        print("%-40s %8.3f%s %8.3f%s %8.3f%s %9s  %s" % (name, medians[name], unit, min(results[name]), unit, max(results[name]), unit,
+            "%.3f%s" % (baseline_medians[name], unit) if name in baseline_medians else "-", change))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the installer and the emulator helper with a synthetic SDK, see the head of this file.")
+    parser.add_argument('-r', type=int, metavar='runs', dest='runs', default=3, help='Number of runs of every scenario, the median is reported (default: 3)')
+    parser.add_argument('-b', type=str, metavar='baseline.json', dest='baseline', help='Compare with this baseline, exit with 1 if a step regressed')
+    parser.add_argument('-o', type=str, metavar='results.json', dest='output', help='Store the results, usable as baseline for later runs')
+    parser.add_argument('-t', type=float, metavar='threshold', dest='threshold', default=0.2, help='Relative slowdown against the baseline which counts as regression (default: 0.2)')
+    parser.add_argument('-n', type=int, metavar='pool size', dest='pool_sizes', nargs='*', default=[ 1, 3 ], help='Pool sizes for the emulator scenario (default: 1 3)')
+    parser.add_argument('--concurrent-builds', type=int, default=3, help='Builds starting their pools at the same time, the ports of all emulators are checked for collisions, 0 to skip (default: 3)')
+    parser.add_argument('--concurrent-pool-size', type=int, default=2, help='Pool size of every concurrent build (default: 2)')
+    parser.add_argument('--tools-size', type=int, default=32, help='Size of the SDK tools archive content in MiB (default: 32)')
+    parser.add_argument('--tools-files', type=int, default=400, help='Number of files in the SDK tools archive (default: 400)')
+    parser.add_argument('--ndk-size', type=int, default=64, help='Size of the NDK archive content in MiB (default: 64)')
+    parser.add_argument('--ndk-files', type=int, default=4000, help='Number of files in the NDK archive (default: 4000)')
+    parser.add_argument('--unzip-size', type=int, default=32, help='Size of the content of the many-file archive for the unzip scenario in MiB (default: 32)')
+    parser.add_argument('--unzip-files', type=int, default=8000, help='Number of files in the many-file archive (default: 8000)')
+    parser.add_argument('--port-lookups', type=int, default=20, help='Lookups of the listening ports of a process, the time per lookup is reported (default: 20)')
+    parser.add_argument('--download-size', type=int, default=48, help='Size of the file of the throttled download and the peak RSS scenario in MiB, from 32 MiB on it is downloaded in segments (default: 48)')
+    parser.add_argument('--download-segments', type=int, default=4, help='Parallel segments compared with a single one in the throttled download scenario (default: 4)')
+    parser.add_argument('--throttled-bandwidth', type=float, default=8, help='Bandwidth per connection in MiB/s of the throttled download scenario (default: 8)')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Download bandwidth in MiB/s per connection, 0 is unlimited (default: 0)')
+    parser.add_argument('--latency', type=float, default=20, help='Latency of every HTTP answer in ms (default: 20)')
+    parser.add_argument('--jvm-delay', type=float, default=0.5, help='Start delay of the stub sdkmanager and avdmanager in seconds (default: 0.5)')
+    parser.add_argument('--package-delay', type=float, default=0.2, help='Delay per package installed by the stub sdkmanager in seconds (default: 0.2)')
+    parser.add_argument('--emulator-start-delay', type=float, default=0.3, help='Delay until the stub emulator listens on its ports in seconds (default: 0.3)')
+    parser.add_argument('--boot-delay', type=float, default=3, help='Cold boot time of the stub emulator in seconds (default: 3)')
+    parser.add_argument('--snapshot-boot-delay', type=float, default=1, help='Boot time of the stub emulator from a snapshot in seconds (default: 1)')
+    parser.add_argument('--snapshot-save-delay', type=float, default=0.5, help='Time the stub emulator needs to save a snapshot in seconds (default: 0.5)')
+    parser.add_argument('--step-timeout', type=int, default=300, help='A step running longer fails the benchmark, in seconds (default: 300)')
+    parser.add_argument('--trace', action='store_true', help='Enable the jsonl trace of the tools, kept in the workspaces (use with --keep)')
+    parser.add_argument('--keep', action='store_true', help='Keep the benchmark directory')
+    parser.add_argument('-v', action='store_true', dest='verbose', help='Print the output of every step')
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIRECTORY)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    # the emulators and the adb server are stopped on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    benchmark = Benchmark(args)
+    try:
+        benchmark.setup()
+        benchmark.run()
+    except RuntimeError as e:
+        print(e)
+        return 2
+    finally:
+        benchmark.teardown()
+
+    medians = benchmark.medians()
+    if baseline is not None and baseline.get("configuration") != benchmark.configuration():
+        print("WARNING: the baseline was recorded with a different configuration: " + json.dumps(baseline.get("configuration")))
+
+    regressions = report(medians, benchmark.results, baseline, args.threshold)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({ "configuration": benchmark.configuration(), "python": sys.version.split()[0], "recorded_at": time.time(),
+                "medians": medians, "results": benchmark.results }, output_file, indent=2, sort_keys=True)
+        print("Results stored in [" + args.output + "]")
+
+    if len(regressions) > 0:
+        print("%d step(s) regressed by more than %.0f%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
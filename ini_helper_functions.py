@@ -16,9 +16,96 @@
 # You should have received a copy of the GNU General Public License
 # along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
 
-import re, os
+import os
 from pathlib import Path
 
+## Parsed representation of ini/properties files (key=value), which keeps the order of all lines including
+## comments, so a file can be rewritten with only the changed values touched. Parsed files are cached by
+## (path, mtime, size), a changed file is parsed again.
+
+INI_COMMENT_PREFIXES = ( "#", ";", "!" )
+
+## path -> (mtime_ns, size, lines)
+__ini_document_cache = {}
+
+class IniDocument:
+    def __init__(self, file_name, lines):
+        self.file_name = file_name
+        self.__lines = list(lines)
+        self.__reindex()
+
+    @staticmethod
+    def parse_key(line):
+        stripped = line.strip()
+        if stripped == "" or stripped.startswith(INI_COMMENT_PREFIXES) or not "=" in stripped:
+            return None
+        return stripped.split("=", maxsplit=1)[0].strip()
+
+    def __reindex(self):
+        self.__index = {}
+        for idx, line in enumerate(self.__lines):
+            key = self.parse_key(line)
+            if key is not None and not key in self.__index:
+                self.__index[key] = idx
+
+    def lines(self):
+        return list(self.__lines)
+
+    def keys(self):
+        return list(self.__index.keys())
+
+    def get(self, key, default=None):
+        if not key in self.__index:
+            return default
+        return self.__lines[self.__index[key]].split("=", maxsplit=1)[1].strip()
+
+    def items(self):
+        return [ (key, self.get(key)) for key in self.__index.keys() ]
+
+    ## an existing key is updated in place (further duplicates are dropped), a new one is appended
+    def set(self, key, value):
+        new_line = key + "=" + value + "\n"
+        if key in self.__index:
+            idx = self.__index[key]
+            self.__lines = [ line for line_idx, line in enumerate(self.__lines) if line_idx == idx or self.parse_key(line) != key ]
+            self.__reindex()
+            self.__lines[self.__index[key]] = new_line
+        else:
+            if len(self.__lines) > 0 and not self.__lines[-1].endswith("\n"):
+                self.__lines[-1] = self.__lines[-1] + "\n"
+            self.__lines.append(new_line)
+            self.__index[key] = len(self.__lines) - 1
+
+    ## writes to a temporary file and renames it over the original
+    def save(self):
+        out_file_name = self.file_name + ".tmpout"
+        with open(out_file_name, 'w') as out_file:
+            out_file.writelines(self.__lines)
+        os.replace(out_file_name, self.file_name)
+        ini_file_helper_cache_update(self.file_name, self.__lines)
+
+def ini_file_helper_cache_update(ini_file_name, lines):
+    try:
+        st = os.stat(ini_file_name)
+        __ini_document_cache[os.path.abspath(ini_file_name)] = (st.st_mtime_ns, st.st_size, tuple(lines))
+    except OSError:
+        pass
+
+## returns the parsed document, every call gets its own copy, so changes are only visible after save()
+def ini_file_helper_load(ini_file_name):
+    cache_key = os.path.abspath(ini_file_name)
+    st = os.stat(ini_file_name)
+
+    cached = __ini_document_cache.get(cache_key)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return IniDocument(ini_file_name, cached[2])
+
+    with open(ini_file_name, 'r') as ini_file:
+        lines = ini_file.readlines()
+
+    __ini_document_cache[cache_key] = (st.st_mtime_ns, st.st_size, tuple(lines))
+    return IniDocument(ini_file_name, lines)
+
 def ini_file_helper_check_key_for_value(ini_file_name, ini_key, ini_val_expect):
 
     if not Path(ini_file_name).is_file():
@@ -27,41 +114,30 @@ def ini_file_helper_check_key_for_value(ini_file_name, ini_key, ini_val_expect):
     if ini_key is None or ini_key == "":
         return False
 
-    with open(ini_file_name, 'r') as ini_file:
-        for ini_file_line in ini_file:
-            try:
-                ini_val = ini_file_line.split("=", maxsplit=1)[1].strip()
-                if ini_val_expect == ini_val:
-                    return True
-            except:
-                pass
-
-    return False
+    return ini_file_helper_load(ini_file_name).get(ini_key) == ini_val_expect
 
 def ini_file_helper_add_or_update_key_value(ini_file_name, ini_key_val_pair):
+    return ini_file_helper_add_or_update_key_values(ini_file_name, [ ini_key_val_pair ])
+
+## applies all given <key>:<value> pairs with a single write of the file
+def ini_file_helper_add_or_update_key_values(ini_file_name, ini_key_val_pairs):
 
     if not Path(ini_file_name).is_file():
         return False
 
-    if ini_key_val_pair is None or ini_key_val_pair == "":
+    ini_key_val_pairs = [ ini_key_val_pair for ini_key_val_pair in ini_key_val_pairs if ini_key_val_pair is not None and ini_key_val_pair != "" ]
+    if len(ini_key_val_pairs) == 0:
         return False
 
-    ini_key_val_pair_splitted = ini_key_val_pair.split(":", maxsplit=1)
-    key_to_replace = ini_key_val_pair_splitted[0]
-    val_to_replace = ini_key_val_pair_splitted[1]
-
-    ## remove 'old' key
-    ini_out_file_name = ini_file_name + ".tmpout"
-    with open(ini_file_name, 'r') as ini_file:
-        with open(ini_out_file_name, 'w') as out_file:
-            for ini_file_line in ini_file:
-                if not re.match("^" + key_to_replace + "=", ini_file_line):
-                    out_file.write(ini_file_line)
-
-    ## append to end
-    with open(ini_out_file_name, 'a') as out_file:
-        print(key_to_replace + "=" + val_to_replace, file=out_file)
+    ini_document = ini_file_helper_load(ini_file_name)
+    for ini_key_val_pair in ini_key_val_pairs:
+        ini_key_val_pair_splitted = ini_key_val_pair.split(":", maxsplit=1)
+        ini_document.set(ini_key_val_pair_splitted[0], ini_key_val_pair_splitted[1])
 
-    os.replace(ini_out_file_name, ini_file_name)
+    ini_document.save()
 
     return True
+
+## returns all key/value pairs of a properties file as dict
+def ini_file_helper_read_all(ini_file_name):
+    return dict(ini_file_helper_load(ini_file_name).items())
@@ -18,14 +18,32 @@
 
 import os
 import sys
+import stat
 import shutil
 import urllib.request
+import http.client
+import json
+import threading
+import concurrent.futures
 import time
 import subprocess
+import signal
+import select
+import queue
+import struct
+import zlib
+import contextlib
 from hashlib import sha256
 from zipfile import ZipFile
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import jenkins_android_helper_trace
+
 def remove_file_or_dir(fn):
     p = Path(fn)
     if p.is_dir():
@@ -33,10 +51,215 @@ def remove_file_or_dir(fn):
     if p.is_file():
         p.unlink()
 
-def download_file(url, dest):
-    dwnldfile = urllib.request.urlopen(url)
-    with open(dest,'wb') as output:
-        output.write(dwnldfile.read())
+## read/write buffer for downloads and hashing, keeps the memory footprint constant for big archives
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+## archives of at least this size are fetched in parallel ranges, if the server supports it
+DOWNLOAD_PARALLEL_MIN_SIZE = 32 * 1024 * 1024
+DOWNLOAD_PARALLEL_SEGMENTS = 4
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_DELAY = 2
+DOWNLOAD_TIMEOUT = 60
+## partial downloads are kept in <dest>.part, with the progress of every range in <dest>.part.state
+DOWNLOAD_PART_SUFFIX = ".part"
+DOWNLOAD_PART_STATE_SUFFIX = ".part.state"
+DOWNLOAD_PART_STATE_INTERVAL = 16 * 1024 * 1024
+
+DOWNLOAD_ERRORS = (OSError, http.client.HTTPException)
+
+## all downloads to the same dest are serialized by a lock on <dest>.part.lock. The lock file is never
+## removed: a run blocked in flock holds the old inode, a third run would create a new file and lock that
+@contextlib.contextmanager
+def __download_locked(dest):
+    with open(dest + DOWNLOAD_PART_SUFFIX + ".lock", 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+## returns the size of the file behind url and whether the server answers range requests, -1 if the size is unknown
+def download_probe(url):
+    request = urllib.request.Request(url, headers={ "Range": "bytes=0-0" })
+    try:
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status == 206 and content_range.startswith("bytes ") and "/" in content_range:
+                try:
+                    return int(content_range.rsplit("/", maxsplit=1)[1]), True
+                except ValueError:
+                    return -1, False
+
+            return int(response.headers.get("Content-Length", "-1")), False
+    except DOWNLOAD_ERRORS + (ValueError,):
+        return -1, False
+
+## streams url to dest and returns the sha256 hexdigest of the written data. If the server supports
+## range requests, the download is resumable (also across interrupted runs) and big files are
+## fetched in multiple parallel segments, otherwise a single stream is used.
+## If data_callback is given, it is called with every chunk and its offset in the file, in order. A
+## restarted download starts again at offset 0, if the data can't be delivered in order at all, the
+## callback is called once with (None, -1).
+def download_file(url, dest, chunk_size=DOWNLOAD_CHUNK_SIZE, segments=DOWNLOAD_PARALLEL_SEGMENTS, data_callback=None):
+    with jenkins_android_helper_trace.trace_span("download", category="download", url=url, streaming=data_callback is not None) as span:
+        with __download_locked(dest):
+            checksum = __download_file(url, dest, chunk_size, segments, data_callback)
+        span.set(bytes=os.path.getsize(dest))
+        return checksum
+
+def __download_file(url, dest, chunk_size, segments, data_callback):
+    with jenkins_android_helper_trace.trace_span("download_probe", category="download", url=url) as span:
+        size, accepts_ranges = download_probe(url)
+        span.set(size=size, accepts_ranges=accepts_ranges)
+
+    if accepts_ranges and size > 0:
+        if size < DOWNLOAD_PARALLEL_MIN_SIZE or data_callback is not None:
+            segments = 1
+        return __download_file_ranged(url, dest, size, max(segments, 1), chunk_size, data_callback)
+
+    return __download_file_single_stream(url, dest, chunk_size, data_callback)
+
+def __download_file_single_stream(url, dest, chunk_size, data_callback):
+    retries = 0
+    while True:
+        checksum = sha256()
+        try:
+            with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as dwnldfile:
+                expected_size = int(dwnldfile.headers.get("Content-Length", "-1"))
+                with open(dest,'wb') as output:
+                    while True:
+                        chunk = dwnldfile.read(chunk_size)
+                        if not chunk:
+                            # a dropped connection just ends the response, only the size tells
+                            if expected_size >= 0 and output.tell() != expected_size:
+                                raise http.client.IncompleteRead(b"", expected_size - output.tell())
+                            break
+                        if data_callback is not None:
+                            data_callback(chunk, output.tell())
+                        checksum.update(chunk)
+                        output.write(chunk)
+
+            return checksum.hexdigest()
+        except DOWNLOAD_ERRORS as e:
+            retries = retries + 1
+            if retries > DOWNLOAD_RETRIES:
+                raise
+            print("Download of [%s] failed (%s), restarting from the beginning (%d/%d)" % (url, e, retries, DOWNLOAD_RETRIES))
+            time.sleep(DOWNLOAD_RETRY_DELAY)
+
+def __download_read_state(state_file, size, segments):
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        if state["size"] == size and len(state["segments"]) > 0:
+            return state
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # fresh state, split the file into segments of equal size
+    segment_size = -(-size // segments)
+    state = { "size": size, "segments": [] }
+    for start in range(0, size, segment_size):
+        state["segments"] = state["segments"] + [ [ start, min(start + segment_size, size), 0 ] ]
+
+    return state
+
+def __download_write_state(state_file, state):
+    with open(state_file + ".tmp", 'w') as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+def __download_file_ranged(url, dest, size, segments, chunk_size, data_callback):
+    part_file = dest + DOWNLOAD_PART_SUFFIX
+    state_file = dest + DOWNLOAD_PART_STATE_SUFFIX
+
+    state = __download_read_state(state_file, size, segments)
+    if not is_file(part_file) or os.path.getsize(part_file) != size:
+        for segment in state["segments"]:
+            segment[2] = 0
+        with open(part_file, 'wb') as f:
+            f.truncate(size)
+
+    already_done = sum([ segment[2] for segment in state["segments"] ])
+    if already_done > 0:
+        print("Resuming download of [%s] at %d of %d bytes" % (url, already_done, size))
+
+    # with a single segment the data arrives in order, so it can be hashed on the fly
+    checksum = None
+    if len(state["segments"]) == 1:
+        checksum = sha256()
+        with open(part_file, 'rb') as f:
+            remaining = state["segments"][0][2]
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if data_callback is not None:
+                    data_callback(chunk, f.tell() - len(chunk))
+                checksum.update(chunk)
+                remaining = remaining - len(chunk)
+    elif data_callback is not None:
+        # a previous run left multiple segments behind, the data won't arrive in order
+        data_callback(None, -1)
+        data_callback = None
+
+    state_lock = threading.Lock()
+
+    def fetch_segment(segment):
+        retries = 0
+        with open(part_file, 'r+b') as output:
+            while segment[0] + segment[2] < segment[1]:
+                offset = segment[0] + segment[2]
+                request = urllib.request.Request(url, headers={ "Range": "bytes=%d-%d" % (offset, segment[1] - 1) })
+                try:
+                    with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                        if response.status != 206:
+                            raise http.client.HTTPException("Server ignored range request for [%s]" % url)
+
+                        output.seek(offset)
+                        while segment[0] + segment[2] < segment[1]:
+                            chunk = response.read(min(chunk_size, segment[1] - segment[0] - segment[2]))
+                            if not chunk:
+                                raise http.client.IncompleteRead(b"", segment[1] - segment[0] - segment[2])
+                            if data_callback is not None:
+                                data_callback(chunk, segment[0] + segment[2])
+                            output.write(chunk)
+                            if checksum is not None:
+                                checksum.update(chunk)
+                            with state_lock:
+                                segment[2] = segment[2] + len(chunk)
+                                # persist the progress from time to time, so even a killed run can be resumed
+                                if segment[2] % DOWNLOAD_PART_STATE_INTERVAL < len(chunk):
+                                    output.flush()
+                                    __download_write_state(state_file, state)
+                except DOWNLOAD_ERRORS as e:
+                    retries = retries + 1
+                    with state_lock:
+                        output.flush()
+                        __download_write_state(state_file, state)
+                    if retries > DOWNLOAD_RETRIES:
+                        raise
+                    print("Download of [%s] interrupted at byte %d (%s), resuming (%d/%d)" % (url, segment[0] + segment[2], e, retries, DOWNLOAD_RETRIES))
+                    time.sleep(DOWNLOAD_RETRY_DELAY)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(state["segments"])) as executor:
+            for future in [ executor.submit(fetch_segment, segment) for segment in state["segments"] ]:
+                future.result()
+    except:
+        # keep the progress for the next run
+        with state_lock:
+            __download_write_state(state_file, state)
+        raise
+
+    os.replace(part_file, dest)
+    remove_file_or_dir(state_file)
+
+    if checksum is not None:
+        return checksum.hexdigest()
+
+    return sha256sum(dest, chunk_size=chunk_size)
 
 def is_directory(fn):
     p = Path(fn)
@@ -46,17 +269,352 @@ def is_file(fn):
     p = Path(fn)
     return p.is_file()
 
-def sha256sum(fn):
-    f = open(fn, 'rb')
-    return sha256(f.read()).hexdigest()
+def sha256sum(fn, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    with jenkins_android_helper_trace.trace_span("sha256", category="hash", file=fn) as span:
+        checksum = sha256()
+        with open(fn, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                checksum.update(chunk)
+            span.set(bytes=f.tell())
+
+        return checksum.hexdigest()
+
+## number of parallel workers for extracting archives
+UNZIP_WORKERS = min(8, os.cpu_count() or 1)
+## entries handed to a worker at once
+UNZIP_BATCH_SIZE = 64
+## a bigger buffer does not help, ZipExtFile reads ahead as much compressed data as requested
+UNZIP_CHUNK_SIZE = 64 * 1024
+
+## path of an archive entry below dest_root, raises a ValueError if the entry would end up outside
+def unzip_target_path(dest_root, name):
+    target = os.path.normpath(os.path.join(dest_root, name))
+    if target != dest_root and not target.startswith(dest_root + os.sep):
+        raise ValueError("Archive entry [%s] would be extracted outside of [%s]" % (name, dest_root))
+    return target
+
+def __unzip_entry_mode(info):
+    return info.external_attr >> 16
+
+def __unzip_batch(zf, batch, chunk_size):
+    for info, target in batch:
+        with zf.open(info) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, chunk_size)
+
+        perm = stat.S_IMODE(__unzip_entry_mode(info))
+        if perm != 0:
+            os.chmod(target, perm)
+
+def __unzip_batches_parallel(zipfn, batches, workers, chunk_size):
+    # every worker thread needs its own handle, a ZipFile can't be read concurrently
+    handles = []
+    handles_lock = threading.Lock()
+    thread_data = threading.local()
+
+    def worker(batch):
+        if not hasattr(thread_data, "zf"):
+            thread_data.zf = ZipFile(zipfn, 'r')
+            with handles_lock:
+                handles.append(thread_data.zf)
+        __unzip_batch(thread_data.zf, batch, chunk_size)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [ executor.submit(worker, batch) for batch in batches ]:
+                future.result()
+    finally:
+        for zf in handles:
+            zf.close()
+
+## extracts all entries of zipfn into dest, directories are created upfront, regular files are extracted
+## in parallel and symlinks as well as directory permissions are applied at the end
+def unzip(zipfn, dest, workers=UNZIP_WORKERS, chunk_size=UNZIP_CHUNK_SIZE):
+    with jenkins_android_helper_trace.trace_span("unzip", category="extract", archive=zipfn, workers=workers) as span:
+        files, uncompressed_bytes = __unzip(zipfn, dest, workers, chunk_size)
+        span.set(files=files, bytes=uncompressed_bytes, archive_bytes=os.path.getsize(zipfn))
+
+## returns the number of extracted files and their uncompressed size
+def __unzip(zipfn, dest, workers, chunk_size):
+    dest_root = os.path.realpath(dest)
+
+    directories = {}
+    files = []
+    symlinks = []
+    with ZipFile(zipfn, 'r') as zf:
+        for info in zf.infolist():
+            target = unzip_target_path(dest_root, info.filename)
+            mode = __unzip_entry_mode(info)
+
+            if info.is_dir():
+                directories[target] = stat.S_IMODE(mode)
+                continue
+
+            directories.setdefault(os.path.dirname(target), 0)
+            if stat.S_ISLNK(mode):
+                symlinks.append((target, zf.read(info).decode("utf-8")))
+            else:
+                files.append((info, target))
+
+    for directory in sorted(directories.keys()):
+        os.makedirs(directory, exist_ok=True)
+
+    # the entries are dealt round-robin from the biggest to the smallest, so every batch gets a similar
+    # share of the bytes and there are at least as many batches as workers
+    files.sort(key=lambda entry: entry[0].file_size, reverse=True)
+    batch_count = max(-(-len(files) // UNZIP_BATCH_SIZE), min(workers, len(files)))
+    batches = [ files[idx::batch_count] for idx in range(0, batch_count) ]
+    if workers <= 1 or len(batches) <= 1:
+        with ZipFile(zipfn, 'r') as zf:
+            for batch in batches:
+                __unzip_batch(zf, batch, chunk_size)
+    else:
+        __unzip_batches_parallel(zipfn, batches, workers, chunk_size)
+
+    for target, link_target in symlinks:
+        # the link itself must stay inside of dest as well
+        unzip_target_path(dest_root, os.path.join(os.path.dirname(target), link_target))
+        if os.path.lexists(target):
+            os.unlink(target)
+        os.symlink(link_target, target)
+
+    # deepest first, a read-only parent must not prevent changing its children
+    for directory in sorted(directories.keys(), reverse=True):
+        if directories[directory] != 0:
+            os.chmod(directory, directories[directory])
+
+    return len(files) + len(symlinks), sum([ info.file_size for info, target in files ])
+
+## Streaming extraction: the local file headers of a zip archive are parsed in order while the archive
+## is still downloading. Permissions and symlinks are only stored in the central directory at the end
+## of the archive, so unzip_apply_attributes needs to be run on the complete file afterwards.
+ZIP_LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ZIP_FLAG_ENCRYPTED = 0x1
+ZIP_FLAG_DATA_DESCRIPTOR = 0x8
+ZIP_FLAG_UTF8 = 0x800
+ZIP_EXTRA_ZIP64 = 0x0001
+ZIP_METHOD_STORED = 0
+ZIP_METHOD_DEFLATED = 8
+## chunks buffered between download and extraction, bounds the memory used by the pipeline
+UNZIP_STREAM_QUEUE_SIZE = 8
 
-def unzip(zipfn, dest):
+class UnzipStreamUnsupported(Exception):
+    pass
+
+class UnzipStream:
+    __ABORT = object()
+
+    def __init__(self, dest, queue_size=UNZIP_STREAM_QUEUE_SIZE):
+        self.__dest_root = os.path.realpath(dest)
+        self.__queue = queue.Queue(queue_size)
+        self.__buffer = b""
+        self.__buffer_pos = 0
+        self.__expected_offset = 0
+        self.__end_seen = False
+        self.__failed = False
+        self.__completed = False
+        self.error = None
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    ## to be used as data_callback for download_file
+    def feed(self, chunk, offset):
+        if self.__failed:
+            return
+
+        if chunk is None or offset != self.__expected_offset:
+            # restarted or out of order download, the already extracted data can't be trusted
+            self.__failed = True
+            self.__queue.put(self.__ABORT)
+            return
+
+        self.__expected_offset = self.__expected_offset + len(chunk)
+        self.__queue.put(chunk)
+
+    ## signals the end of the data, returns True if all entries were extracted
+    def finish(self):
+        self.__queue.put(None)
+        self.__thread.join()
+        return self.__completed and not self.__failed
+
+    def __next_chunk(self):
+        chunk = self.__queue.get()
+        if chunk is None:
+            self.__end_seen = True
+            raise EOFError("Archive ended unexpectedly")
+        if chunk is self.__ABORT:
+            raise UnzipStreamUnsupported("Download was restarted or is not in order")
+        return chunk
+
+    def __read(self, size):
+        while len(self.__buffer) - self.__buffer_pos < size:
+            self.__buffer = self.__buffer[self.__buffer_pos:] + self.__next_chunk()
+            self.__buffer_pos = 0
+
+        data = self.__buffer[self.__buffer_pos:self.__buffer_pos + size]
+        self.__buffer_pos = self.__buffer_pos + size
+        return data
+
+    def __read_some(self, size):
+        if self.__buffer_pos >= len(self.__buffer):
+            self.__buffer = self.__next_chunk()
+            self.__buffer_pos = 0
+
+        data = self.__buffer[self.__buffer_pos:self.__buffer_pos + size]
+        self.__buffer_pos = self.__buffer_pos + len(data)
+        return data
+
+    def __unread(self, data):
+        self.__buffer = data + self.__buffer[self.__buffer_pos:]
+        self.__buffer_pos = 0
+
+    def __run(self):
+        try:
+            self.__extract_entries()
+            self.__completed = True
+        except (UnzipStreamUnsupported, EOFError, ValueError, OSError, zlib.error, struct.error) as e:
+            self.error = e
+            self.__failed = True
+        finally:
+            # keep consuming, the download must never block on a full queue
+            while not self.__end_seen:
+                if self.__queue.get() is None:
+                    self.__end_seen = True
+
+    def __extract_entries(self):
+        while True:
+            signature = self.__read(4)
+            if signature == ZIP_CENTRAL_DIRECTORY_SIGNATURE or signature == ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE:
+                return
+            if signature != ZIP_LOCAL_FILE_HEADER_SIGNATURE:
+                raise UnzipStreamUnsupported("Unexpected zip signature %s" % signature)
+
+            version, flags, method, mod_time, mod_date, crc, compressed_size, file_size, name_len, extra_len = struct.unpack("<HHHHHIIIHH", self.__read(26))
+            name = self.__read(name_len).decode("utf-8" if flags & ZIP_FLAG_UTF8 else "cp437")
+            extra = self.__read(extra_len)
+
+            zip64 = False
+            extra_pos = 0
+            while extra_pos + 4 <= len(extra):
+                extra_id, extra_size = struct.unpack("<HH", extra[extra_pos:extra_pos + 4])
+                if extra_id == ZIP_EXTRA_ZIP64:
+                    zip64 = True
+                    zip64_data = extra[extra_pos + 4:extra_pos + 4 + extra_size]
+                    if file_size == 0xFFFFFFFF and len(zip64_data) >= 8:
+                        file_size = struct.unpack("<Q", zip64_data[:8])[0]
+                        zip64_data = zip64_data[8:]
+                    if compressed_size == 0xFFFFFFFF and len(zip64_data) >= 8:
+                        compressed_size = struct.unpack("<Q", zip64_data[:8])[0]
+                extra_pos = extra_pos + 4 + extra_size
+
+            if flags & ZIP_FLAG_ENCRYPTED:
+                raise UnzipStreamUnsupported("Encrypted entry [%s]" % name)
+
+            target = unzip_target_path(self.__dest_root, name)
+            # a stored directory has no content, also if its sizes only follow in a data descriptor
+            if name.endswith("/") and compressed_size == 0 and (method == ZIP_METHOD_STORED or not flags & ZIP_FLAG_DATA_DESCRIPTOR):
+                os.makedirs(target, exist_ok=True)
+                if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+                    self.__read_data_descriptor(zip64)
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            computed_crc = 0
+            with open(target, 'wb') as output:
+                if method == ZIP_METHOD_STORED:
+                    if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+                        raise UnzipStreamUnsupported("Stored entry [%s] without size" % name)
+                    remaining = compressed_size
+                    while remaining > 0:
+                        data = self.__read_some(min(UNZIP_CHUNK_SIZE, remaining))
+                        computed_crc = zlib.crc32(data, computed_crc)
+                        output.write(data)
+                        remaining = remaining - len(data)
+                elif method == ZIP_METHOD_DEFLATED:
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    while not decompressor.eof:
+                        data = decompressor.decompress(self.__read_some(UNZIP_CHUNK_SIZE))
+                        computed_crc = zlib.crc32(data, computed_crc)
+                        output.write(data)
+                    if decompressor.unused_data:
+                        self.__unread(decompressor.unused_data)
+                else:
+                    raise UnzipStreamUnsupported("Compression method %d of [%s]" % (method, name))
+
+            if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+                crc = self.__read_data_descriptor(zip64)
+
+            if computed_crc != crc:
+                raise ValueError("CRC mismatch for entry [%s]" % name)
+
+    ## the signature is optional, returns the crc
+    def __read_data_descriptor(self, zip64):
+        signature = self.__read(4)
+        if signature != ZIP_DATA_DESCRIPTOR_SIGNATURE:
+            self.__unread(signature)
+        crc = struct.unpack("<I", self.__read(4))[0]
+        self.__read(16 if zip64 else 8)
+        return crc
+
+## applies the permissions and symlinks from the central directory of zipfn to the entries extracted
+## by UnzipStream, returns False if an entry is missing
+def unzip_apply_attributes(zipfn, dest):
+    dest_root = os.path.realpath(dest)
+
+    directories = {}
     with ZipFile(zipfn, 'r') as zf:
         for info in zf.infolist():
-            zf.extract(info.filename, path=dest)
-            out_path = os.path.join(dest, info.filename)
-            perm = info.external_attr >> 16
-            os.chmod(out_path, perm)
+            target = unzip_target_path(dest_root, info.filename)
+            mode = __unzip_entry_mode(info)
+
+            if info.is_dir():
+                directories[target] = stat.S_IMODE(mode)
+                continue
+
+            if not os.path.isfile(target):
+                return False
+
+            if stat.S_ISLNK(mode):
+                # the link target was extracted as content of a regular file
+                with open(target, 'r') as f:
+                    link_target = f.read()
+                unzip_target_path(dest_root, os.path.join(os.path.dirname(target), link_target))
+                os.unlink(target)
+                os.symlink(link_target, target)
+            elif stat.S_IMODE(mode) != 0:
+                os.chmod(target, stat.S_IMODE(mode))
+
+    for directory in sorted(directories.keys(), reverse=True):
+        if directories[directory] != 0:
+            os.chmod(directory, directories[directory])
+
+    return True
+
+## downloads url to dest and extracts it into extract_dir while the data arrives. Returns the sha256
+## of the archive and whether the streaming extraction succeeded, if not, the caller needs to unzip
+## the complete archive.
+def download_and_unzip_file(url, dest, extract_dir, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    with jenkins_android_helper_trace.trace_span("download_and_unzip", category="download", url=url) as span:
+        stream = UnzipStream(extract_dir)
+        try:
+            checksum = download_file(url, dest, chunk_size=chunk_size, data_callback=stream.feed)
+        finally:
+            extracted = stream.finish()
+
+        if not extracted:
+            print("Streaming extraction of [%s] not possible: %s" % (url, stream.error))
+            span.set(extracted=False)
+            return checksum, False
+
+        with jenkins_android_helper_trace.trace_span("unzip_apply_attributes", category="extract", archive=dest):
+            extracted = unzip_apply_attributes(dest, extract_dir)
+        span.set(extracted=extracted)
+        return checksum, extracted
 
 def find_file_in_subtree(root, fn, depth):
     found_file = ""
@@ -78,23 +636,89 @@ def split_string_and_get_part(string, delimiter, index, default=""):
 
     return part
 
-def kill_process_by_pid_with_force_try(pid, wait_before_kill=0, time_to_force=10):
-    wait_time = 0
-    while True:
-        if not is_process_running(pid):
-            return
+## sends SIGTERM after wait_before_kill and SIGKILL after time_to_force seconds, unless the process exited
+## before, with a process group given the whole group is signalled. Returns True if the process is gone.
+def kill_process_by_pid_with_force_try(pid, wait_before_kill=0, time_to_force=10, process_group=0):
+    if wait_for_process_exit(pid, wait_before_kill):
+        return True
 
-        if wait_time == wait_before_kill:
-            kill_process_by_pid(pid)
+    kill_process_by_pid(pid, process_group=process_group)
+    if wait_for_process_exit(pid, max(time_to_force - wait_before_kill, 0)):
+        return True
 
-        # send kill after 15 seconds, and exit
-        if wait_time == time_to_force:
-            kill_process_by_pid(pid, force=True)
-            break
+    kill_process_by_pid(pid, force=True, process_group=process_group)
+    return wait_for_process_exit(pid, 1)
 
-        time.sleep(1)
+PROCESS_EXIT_POLL_INTERVAL_MIN = 0.01
+PROCESS_EXIT_POLL_INTERVAL_MAX = 0.2
 
-        wait_time = wait_time + 1
+## waits up to timeout seconds for the process to exit, returns True if it is gone. On linux a pidfd
+## notifies about the exit, otherwise the process is polled in short intervals.
+def wait_for_process_exit(pid, timeout):
+    if not is_process_running(pid):
+        return True
+
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            # gone in the meantime or not supported by the kernel
+            pidfd = -1
+
+        if pidfd >= 0:
+            try:
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+                return len(poller.poll(timeout * 1000)) > 0 or not is_process_running(pid)
+            finally:
+                os.close(pidfd)
+
+    deadline = time.monotonic() + timeout
+    poll_interval = PROCESS_EXIT_POLL_INTERVAL_MIN
+    while is_process_running(pid):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(poll_interval, remaining))
+        poll_interval = min(poll_interval * 2, PROCESS_EXIT_POLL_INTERVAL_MAX)
+
+    return True
+
+## pids of all processes of the process group, only available on linux (empty list otherwise)
+def get_process_group_members(process_group):
+    members = []
+    if not os.path.isdir("/proc/self"):
+        return members
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", entry, "stat"), 'r') as proc_stat:
+                # the command name may contain spaces, fields are counted after its closing bracket
+                fields = proc_stat.read().rsplit(")", maxsplit=1)[1].split()
+        except (OSError, IndexError):
+            continue
+
+        # state, ppid, pgrp; zombies are already gone, only not yet reaped
+        if len(fields) > 2 and fields[0] != "Z" and fields[2] == str(process_group):
+            members = members + [ int(entry) ]
+
+    return members
+
+## value of the environment variable of the process, None if it is not set or the environment can't be read
+## (only available on linux)
+def get_process_environment_value(pid, name):
+    try:
+        with open(os.path.join("/proc", str(pid), "environ"), 'rb') as proc_environ:
+            for entry in proc_environ.read().split(b"\0"):
+                key, separator, value = entry.partition(b"=")
+                if separator and key.decode("utf-8", errors="replace") == name:
+                    return value.decode("utf-8", errors="replace")
+    except OSError:
+        pass
+
+    return None
 
 def is_process_running(pid):
     if os.name == "posix":
@@ -105,23 +729,26 @@ def is_process_running(pid):
         else:
             return True
     elif os.name == "nt":
-        return len(subprocess.run([ "tasklist", "/FI", "PID eq " + str(pid) ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding).strip().splitlines()) > 1
+        return len(jenkins_android_helper_trace.traced_run([ "tasklist", "/FI", "PID eq " + str(pid) ], stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding).strip().splitlines()) > 1
     else:
         raise Exception("Unsupported platform: " + os.name)
 
-def kill_process_by_pid(pid, force=False):
+def kill_process_by_pid(pid, force=False, process_group=0):
     if not is_process_running(pid):
         return
 
     if os.name == "posix":
-        if force:
-            subprocess.run([ 'kill', '-9', str(pid) ])
-        else:
-            subprocess.run([ 'kill', str(pid) ])
+        try:
+            if process_group > 0:
+                os.killpg(process_group, signal.SIGKILL if force else signal.SIGTERM)
+            else:
+                os.kill(pid, signal.SIGKILL if force else signal.SIGTERM)
+        except ProcessLookupError:
+            pass
     elif os.name == "nt":
         if force:
-            subprocess.run([ 'Taskkill', '/PID', str(pid), '/F' ])
+            jenkins_android_helper_trace.traced_run([ 'Taskkill', '/PID', str(pid), '/F' ])
         else:
-            subprocess.run([ 'Taskkill', '/PID', str(pid) ])
+            jenkins_android_helper_trace.traced_run([ 'Taskkill', '/PID', str(pid) ])
     else:
         raise Exception("Unsupported platform: " + os.name)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## Timing trace of the helper phases, enabled by JENKINS_ANDROID_HELPER_TRACE=jsonl or =chrome. Every span
+## (a timed phase) and event is appended as soon as it ends to JENKINS_ANDROID_HELPER_TRACE_FILE, by default
+## jenkins_android_helper_trace.jsonl or .json in the WORKSPACE. All helper calls of a build (and the watchdog)
+## append to the same file, every record carries the pid and the wall clock time.
+##   jsonl:  one object per line: name, cat, ts (epoch seconds), dur (seconds, spans only), pid, tid, args
+##   chrome: the trace event format of chrome://tracing and perfetto, a JSON array whose closing bracket
+##           is optional, so it can be appended to by several processes
+## The helper starts its processes through traced_popen and traced_run, which record the process start
+## (fork/exec) with its latency and a run with its duration and return code. When disabled, trace_span
+## returns a shared object which does nothing, so an instrumented phase costs one call.
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TRACE_ENV = "JENKINS_ANDROID_HELPER_TRACE"
+TRACE_FILE_ENV = "JENKINS_ANDROID_HELPER_TRACE_FILE"
+TRACE_FORMAT_JSONL = "jsonl"
+TRACE_FORMAT_CHROME = "chrome"
+TRACE_FILE_NAMES = { TRACE_FORMAT_JSONL: "jenkins_android_helper_trace.jsonl", TRACE_FORMAT_CHROME: "jenkins_android_helper_trace.json" }
+
+__trace_format = os.getenv(TRACE_ENV, "").strip().lower()
+if __trace_format != "" and not __trace_format in TRACE_FILE_NAMES:
+    print("Unknown trace format [%s] in %s, use one of: %s" % (__trace_format, TRACE_ENV, ", ".join(sorted(TRACE_FILE_NAMES))), file=sys.stderr)
+    __trace_format = ""
+
+## the file is opened on the first record, the scripts set WORKSPACE only after the import
+__trace_fd = -1
+__trace_lock = threading.Lock()
+
+def trace_enabled():
+    return __trace_format != ""
+
+def __trace_file_name():
+    trace_file_name = os.getenv(TRACE_FILE_ENV, "")
+    if trace_file_name != "":
+        return trace_file_name
+    return os.path.join(os.getenv("WORKSPACE", os.getcwd()), TRACE_FILE_NAMES[__trace_format])
+
+def __trace_open():
+    global __trace_fd
+    trace_fd = os.open(__trace_file_name(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    if __trace_format == TRACE_FORMAT_CHROME:
+        # only the first process writes the opening bracket
+        if fcntl is not None:
+            fcntl.flock(trace_fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(trace_fd).st_size == 0:
+                os.write(trace_fd, b"[\n")
+        finally:
+            if fcntl is not None:
+                fcntl.flock(trace_fd, fcntl.LOCK_UN)
+
+    __trace_fd = trace_fd
+
+## ts in epoch seconds, duration in seconds or None for an instant event
+def trace_write_record(name, category, ts, duration, args):
+    if __trace_format == TRACE_FORMAT_CHROME:
+        record = { "name": name, "cat": category, "ph": "X" if duration is not None else "i", "ts": round(ts * 1000000),
+                   "pid": os.getpid(), "tid": threading.get_ident(), "args": args }
+        if duration is not None:
+            record["dur"] = round(duration * 1000000)
+        else:
+            record["s"] = "p"
+        line = json.dumps(record, default=str) + ",\n"
+    else:
+        record = { "name": name, "cat": category, "ts": round(ts, 6), "pid": os.getpid(), "tid": threading.get_ident(), "args": args }
+        if duration is not None:
+            record["dur"] = round(duration, 6)
+        line = json.dumps(record, default=str) + "\n"
+
+    try:
+        with __trace_lock:
+            if __trace_fd < 0:
+                __trace_open()
+            # one write per record, appends of concurrent processes don't interleave
+            os.write(__trace_fd, line.encode("utf-8"))
+    except OSError as e:
+        # the trace must never break the build
+        print("Could not write the trace (%s)" % (e), file=sys.stderr)
+
+class TraceSpan:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    ## adds arguments to the span, eg the number of bytes once known
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.__start_ts = time.time()
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        duration = time.perf_counter() - self.__start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        if "bytes" in self.args and duration > 0:
+            self.args["bytes_per_second"] = round(self.args["bytes"] / duration)
+        trace_write_record(self.name, self.category, self.__start_ts, duration, self.args)
+        return False
+
+class TraceNoopSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+TRACE_NOOP_SPAN = TraceNoopSpan()
+
+## 'with trace_span("unzip", category="install", archive=name) as span: ...; span.set(files=count)'
+def trace_span(name, category="helper", **args):
+    if __trace_format == "":
+        return TRACE_NOOP_SPAN
+    return TraceSpan(name, category, args)
+
+## an instant event, eg a boot state change
+def trace_event(name, category="helper", **args):
+    if __trace_format == "":
+        return
+    trace_write_record(name, category, time.time(), None, args)
+
+def __trace_command(args):
+    command = args if isinstance(args, (str, bytes)) else " ".join([ str(arg) for arg in args ])
+    return command[:200]
+
+## subprocess.Popen, the start is recorded with the time it took until the new process runs the command
+def traced_popen(args, **kwargs):
+    if __trace_format == "":
+        return subprocess.Popen(args, **kwargs)
+
+    with trace_span("process_start", category="process", command=__trace_command(args)) as span:
+        proc = subprocess.Popen(args, **kwargs)
+        span.set(child_pid=proc.pid)
+    return proc
+
+## subprocess.run, the run is recorded with its duration and the return code
+def traced_run(args, **kwargs):
+    if __trace_format == "":
+        return subprocess.run(args, **kwargs)
+
+    with trace_span("process_run", category="process", command=__trace_command(args)) as span:
+        completed = subprocess.run(args, **kwargs)
+        span.set(returncode=completed.returncode)
+    return completed
@@ -26,11 +26,22 @@ import re
 import uuid
 import time
 import shutil
+import json
+import signal
+import threading
+import concurrent.futures
 from collections import namedtuple
 
 import jenkins_android_helper_commons
+import jenkins_android_helper_trace
 import ini_helper_functions
 import android_emulator_helper_functions
+import archive_cache_helper_functions
+import android_sdk_inventory_helper_functions
+import android_adb_client
+import android_emulator_port_lease_helper_functions
+import android_avd_template_helper_functions
+import android_avd_store_helper_functions
 
 ERROR_CODE_WAIT_NO_AVD_CREATED = 1
 ERROR_CODE_WAIT_AVD_CREATED_BUT_NOT_RUNNING = 2
@@ -57,6 +68,8 @@ class AndroidSDK:
     ANDROID_SDK_TOOLS_BIN_SDKMANAGER = AndroidSDKContent(path=os.path.join(ANDROID_SDK_TOOLS_DIR, "bin", "sdkmanager"), executable=True, winending=".bat")
     ANDROID_SDK_TOOLS_BIN_AVDMANAGER = AndroidSDKContent(path=os.path.join(ANDROID_SDK_TOOLS_DIR, "bin", "avdmanager"), executable=True, winending=".bat")
     ANDROID_SDK_TOOLS_BIN_EMULATOR = AndroidSDKContent(path=os.path.join("emulator", "emulator"), executable=True, winending=".exe")
+    ANDROID_SDK_TOOLS_BIN_MKSDCARD = AndroidSDKContent(path=os.path.join("emulator", "mksdcard"), executable=True, winending=".exe")
+    ANDROID_SDK_TOOLS_BIN_QEMU_IMG = AndroidSDKContent(path=os.path.join("emulator", "qemu-img"), executable=True, winending=".exe")
     ANDROID_SDK_TOOLS_BIN_ADB = AndroidSDKContent(path=os.path.join("platform-tools", "adb"), executable=True, winending=".exe")
 
     ### Info: This package shall support the platforms: linux, windows, cygwin and mac, therefore
@@ -77,6 +90,7 @@ class AndroidSDK:
     ANDROID_SDK_BASE_URL = "https://dl.google.com/android/repository"
 
     ANDROID_NDK_ARCHIVE = { PLATFORM_ID_LINUX: "android-ndk-r16b-linux-x86_64.zip", PLATFORM_ID_MAC: "android-ndk-r16b-darwin-x86_64.zip", PLATFORM_ID_WIN: "android-ndk-r16b-windows-x86_64.zip", PLATFORM_ID_CYGWIN: "android-ndk-r16b-windows-x86_64.zip" }
+    ANDROID_NDK_ARCHIVE_DIR = "android-ndk-r16b"
     ANDROID_NDK_ARCHIVE_SHA256_CHECKSUM = { PLATFORM_ID_LINUX: "bcdea4f5353773b2ffa85b5a9a2ae35544ce88ec5b507301d8cf6a76b765d901", PLATFORM_ID_MAC: "9654a692ed97713e35154bfcacb0028fdc368128d636326f9644ed83eec5d88b", PLATFORM_ID_WIN: "4c6b39939b29dfd05e27c97caf588f26b611f89fe95aad1c987278bd1267b562", PLATFORM_ID_CYGWIN: "4c6b39939b29dfd05e27c97caf588f26b611f89fe95aad1c987278bd1267b562" }
 
     ANDROID_SDK_BUILD_TOOLS_VERSION_DEFAULT = "27.0.1"
@@ -114,18 +128,88 @@ class AndroidSDK:
 
     ANDROID_SDK_SYSTEM_IMAGE_IDENTIFIER = "system-images"
 
+    SDKMANAGER_DURATION_NAME = "sdkmanager"
+
 
     __download_if_neccessary = False
+    ## extract archives while they are downloaded
+    __pipelined_install = False
+    ANDROID_SDK_STAGING_DIR_PREFIX = ".staging-"
+    ANDROID_SDK_STAGING_DIR_MAX_AGE = 24 * 60 * 60
+    ANDROID_SDK_INSTALLED_MARKER_FILENAME = ".jenkins-android-helper-installed"
+
+    ## node wide archive cache, can be configured via ANDROID_SDK_ARCHIVE_CACHE_DIR/ANDROID_SDK_ARCHIVE_CACHE_MAX_SIZE,
+    ## setting ANDROID_SDK_ARCHIVE_CACHE_DIR to an empty string disables the cache
+    __archive_cache_directory = ""
+    __archive_cache_max_size = 0
+    ANDROID_SDK_ARCHIVE_CACHE_DIR_DEFAULT = os.path.join(os.path.expanduser("~"), ".cache", "jenkins-android-helper", "archives")
+    ANDROID_SDK_ARCHIVE_CACHE_MAX_SIZE_DEFAULT = "4G"
 
     # Emulator functionality
     emulator_avd_name = ""
+    emulator_avd_names = []
+
+    ## node wide cache of created AVDs, can be configured via ANDROID_AVD_TEMPLATE_CACHE_DIR, setting it
+    ## to an empty string disables the cache
+    __avd_template_cache_directory = ""
+    ANDROID_AVD_TEMPLATE_CACHE_DIR_DEFAULT = os.path.join(os.path.expanduser("~"), ".cache", "jenkins-android-helper", "avd-templates")
+
+    ## node wide store of read-only images referenced by the AVDs, the emulator writes into qcow2 overlays
+    ## within the AVD, can be configured via ANDROID_AVD_SHARED_STORE_DIR
+    __avd_shared_store_directory = ""
+    ANDROID_AVD_SHARED_STORE_DIR_DEFAULT = os.path.join(os.path.expanduser("~"), ".cache", "jenkins-android-helper", "avd-store")
 
     ANDROID_EMULATOR_DEFAULT_SDCARD_SIZE = "200M"
 
+    ## seconds to wait for the emulator to finish booting
+    ANDROID_EMULATOR_MAX_STARTUP_TIME = 300
+    ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT = 30
+    ## seconds the settings script may take on top of the provider wait (the last 'settings get' and the
+    ## settings themselves), until then the host waits for its answer
+    ANDROID_EMULATOR_SETTINGS_SCRIPT_MARGIN = 30
+    ## exit code of a shell command whose connection broke after it was sent, like the adb binary
+    ADB_SHELL_RC_CONNECTION_FAILED = 255
+
     ANDROID_EMULATOR_SWITCH_NO_WINDOW = "-no-window"
     ANDROID_EMULATOR_SWITCH_WIPE_DATA = "-wipe-data"
 
+    ANDROID_AVD_CONFIG_FILENAME = "config.ini"
+    ANDROID_AVD_CONFIG_SYSDIR_KEY = "image.sysdir.1"
+
+    ## snapshot mode: the snapshot is saved within the avd, the metadata next to it
+    ANDROID_EMULATOR_SNAPSHOTS_DIR = "snapshots"
+    ANDROID_EMULATOR_SNAPSHOT_NAME_PREFIX = "jenkins-android-helper-"
+    ANDROID_EMULATOR_SNAPSHOT_METADATA_FILENAME = "jenkins-android-helper-snapshot.json"
+    ## seconds the emulator may need to write the RAM and the disks of a snapshot
+    ANDROID_EMULATOR_SNAPSHOT_SAVE_TIMEOUT = ANDROID_EMULATOR_MAX_STARTUP_TIME
+
+    ANDROID_AVD_TRASH_DIR_PREFIX = ".trash-"
+
+    ## set for the emulator and its children to the id of the session they belong to
+    ANDROID_EMULATOR_SESSION_ENV = "JENKINS_ANDROID_HELPER_EMULATOR_SESSION"
+
+    ## watchdog: checks every interval, an emulator failing max_failures checks in a row is restarted,
+    ## after max_restarts the watchdog gives up
+    ANDROID_EMULATOR_WATCHDOG_INTERVAL = 5
+    ANDROID_EMULATOR_WATCHDOG_MAX_FAILURES = 3
+    ANDROID_EMULATOR_WATCHDOG_MAX_RESTARTS = 3
+    ## a stopped watchdog finishes the step of a restart it is in (killing the emulator, starting it, applying
+    ## the settings), only after this many seconds it is killed
+    ANDROID_EMULATOR_WATCHDOG_STOP_TIMEOUT = 120
+    ANDROID_EMULATOR_WATCHDOG_STATE_HEALTHY = "healthy"
+    ANDROID_EMULATOR_WATCHDOG_STATE_BOOTING = "booting"
+    ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY = "unhealthy"
+    ANDROID_EMULATOR_WATCHDOG_STATE_RESTARTING = "restarting"
+    ANDROID_EMULATOR_WATCHDOG_STATE_FAILED = "failed"
+    AVD_WATCHDOG_PROCESS_FILENAME = "emulator_watchdog_process.json"
+    AVD_WATCHDOG_STATUS_FILENAME = "emulator_watchdog_status.json"
+    AVD_WATCHDOG_LOG_FILENAME = "emulator_watchdog.log"
+    ## set by SIGTERM within the watchdog process
+    __watchdog_stop_requested = None
+    AVD_START_OPTIONS_STORE_FILENAME = "last_emulator_start_options.json"
+
     AVD_NAME_UNIQUE_STORE_FILENAME = "last_unique_avd_name.tmp"
+    AVD_SESSION_STORE_FILENAME_FORMAT = "last_emulator_session_{}.json"
 
     def __init__(self):
         self.__sdk_directory = os.getenv('ANDROID_SDK_ROOT', "")
@@ -145,6 +229,18 @@ class AndroidSDK:
         if self.__workspace_directory is None or self.__workspace_directory == "":
             raise Exception("Environment variable WORKSPACE needs to be set")
 
+        self.__archive_cache_directory = os.getenv('ANDROID_SDK_ARCHIVE_CACHE_DIR', self.ANDROID_SDK_ARCHIVE_CACHE_DIR_DEFAULT)
+        self.__archive_cache_max_size = archive_cache_helper_functions.archive_cache_parse_size(os.getenv('ANDROID_SDK_ARCHIVE_CACHE_MAX_SIZE', self.ANDROID_SDK_ARCHIVE_CACHE_MAX_SIZE_DEFAULT))
+
+        self.__avd_template_cache_directory = os.getenv('ANDROID_AVD_TEMPLATE_CACHE_DIR', self.ANDROID_AVD_TEMPLATE_CACHE_DIR_DEFAULT)
+
+        self.__avd_shared_store_directory = os.getenv('ANDROID_AVD_SHARED_STORE_DIR', self.ANDROID_AVD_SHARED_STORE_DIR_DEFAULT)
+
+        self.__port_lease_directory = os.getenv('ANDROID_EMULATOR_PORT_LEASE_DIR', android_emulator_port_lease_helper_functions.PORT_LEASE_DIR_DEFAULT)
+
+        self.__adb_client = None
+        self.__adb_client_checked = False
+
         self.emulator_read_avd_name()
 
         if not sys.platform in self.SUPPORTED_PLATFORMS:
@@ -178,28 +274,23 @@ class AndroidSDK:
     def download_if_neccessary(self):
         self.__download_if_neccessary = True
 
-    def is_module_installed(self, module_name, expected_revision, expected_pkg_path, expected_desc, verbose=False):
-        module_source_props = os.path.join(self.__get_full_sdk_path(module_name), self.ANDROID_SDK_SRC_PROPS_FILENAME)
+    def pipelined_install(self):
+        self.__pipelined_install = True
 
-        if not jenkins_android_helper_commons.is_file(module_source_props):
-            if verbose:
-                print("[%s] is not readable" % (module_source_props))
-            return False
-
-        if expected_revision is not None and not ini_helper_functions.ini_file_helper_check_key_for_value(module_source_props, self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_REV, expected_revision):
-            if verbose:
-                print("[%s] Value for key [%s] does not match expected: [%s]" % (module_source_props, self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_REV, expected_revision))
-            return False
+    def is_module_installed(self, module_name, expected_revision, expected_pkg_path, expected_desc, verbose=False):
+        module_props = android_sdk_inventory_helper_functions.sdk_inventory_get_package(self.__sdk_directory, module_name)
 
-        if expected_pkg_path is not None and not ini_helper_functions.ini_file_helper_check_key_for_value(module_source_props, self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_PATH, expected_pkg_path):
+        if module_props is None:
             if verbose:
-                print("[%s] Value for key [%s] does not match expected: [%s]" % (module_source_props, self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_PATH, expected_pkg_path))
+                print("[%s] is not readable" % (os.path.join(self.__get_full_sdk_path(module_name), self.ANDROID_SDK_SRC_PROPS_FILENAME)))
             return False
 
-        if expected_desc is not None and not ini_helper_functions.ini_file_helper_check_key_for_value(module_source_props, self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_DESC, expected_desc):
-            if verbose:
-                print("[%s] Value for key [%s] does not match expected: [%s]" % (module_source_props, self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_DESC, expected_desc))
-            return False
+        expected_props = [ (self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_REV, expected_revision), (self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_PATH, expected_pkg_path), (self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_DESC, expected_desc) ]
+        for prop_name, expected_value in expected_props:
+            if expected_value is not None and module_props.get(prop_name) != expected_value:
+                if verbose:
+                    print("[%s] Value for key [%s] does not match expected: [%s]" % (module_name, prop_name, expected_value))
+                return False
 
         return True
 
@@ -215,6 +306,9 @@ class AndroidSDK:
                 print("[%s] is not executable" % self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_SDKMANAGER))
             return False
 
+        if self.is_package_marked_installed(self.ANDROID_SDK_TOOLS_DIR, self.ANDROID_SDK_TOOLS_ARCHIVE_SHA256_CHECKSUM[sys.platform]):
+            return True
+
         if not self.is_module_installed(self.ANDROID_SDK_TOOLS_DIR, self.ANDROID_SDK_TOOLS_PROP_VAL_PKG_REV, self.ANDROID_SDK_TOOLS_PROP_VAL_PKG_PATH, self.ANDROID_SDK_TOOLS_PROP_VAL_PKG_DESC, verbose=verbose):
             if verbose:
                 print("SDK tools are not correclty (or in the correct version) installed")
@@ -229,7 +323,10 @@ class AndroidSDK:
         if not self.are_sdk_tools_installed(verbose=True):
             raise Exception("Newly setup SDK directory [%s] does not look like a valid installation!" % self.__sdk_directory)
 
-    def download_and_install_package(self, archive_to_download, checksum_sha256, directory_inside_tools):
+    def download_and_install_package(self, archive_to_download, checksum_sha256, directory_inside_tools, directory_inside_archive=None):
+        if directory_inside_archive is None:
+            directory_inside_archive = directory_inside_tools
+
         if not os.path.isdir(self.__sdk_directory):
             try:
                 os.makedirs(self.__sdk_directory, exist_ok=True)
@@ -239,32 +336,144 @@ class AndroidSDK:
         if not os.access(self.__sdk_directory, os.W_OK):
             raise Exception("Directory [%s] is not writable!!" % self.__sdk_directory)
 
-        # remove dest dir, if already exists
-        jenkins_android_helper_commons.remove_file_or_dir(self.__get_full_sdk_path(directory_inside_tools))
+        self.__remove_stale_staging_directories()
+
+        # the package is extracted next to its final location and only published with a rename, so an
+        # interrupted or failed install leaves the previous installation untouched
+        staging_dir = tempfile.mkdtemp(dir=self.__sdk_directory, prefix=self.ANDROID_SDK_STAGING_DIR_PREFIX)
+        try:
+            with jenkins_android_helper_trace.trace_span("install_package", category="install", archive=archive_to_download, pipelined=self.__pipelined_install):
+                self.__download_and_unzip_package(archive_to_download, checksum_sha256, staging_dir)
+
+            staged_package = os.path.join(staging_dir, directory_inside_archive)
+            if not jenkins_android_helper_commons.is_directory(staged_package):
+                print("Archive [%s] does not contain the directory [%s]" % (archive_to_download, directory_inside_archive))
+                sys.exit(ERROR_CODE_SDK_TOOLS_ARCHIVE_EXTRACT_ERROR)
+
+            with open(os.path.join(staged_package, self.ANDROID_SDK_INSTALLED_MARKER_FILENAME), 'w') as marker:
+                print(checksum_sha256, file=marker)
+
+            self.__publish_staged_directory(staged_package, self.__get_full_sdk_path(directory_inside_tools))
+            android_sdk_inventory_helper_functions.sdk_inventory_invalidate(self.__sdk_directory)
+        finally:
+            jenkins_android_helper_commons.remove_file_or_dir(staging_dir)
+
+    ## the marker is written by download_and_install_package as last step before publishing, if it is present
+    ## with the expected checksum, the content is complete and does not need to be validated again
+    def is_package_marked_installed(self, directory_inside_tools, checksum_sha256):
+        try:
+            with open(os.path.join(self.__get_full_sdk_path(directory_inside_tools), self.ANDROID_SDK_INSTALLED_MARKER_FILENAME)) as marker:
+                return marker.readline().strip() == checksum_sha256
+        except OSError:
+            return False
+
+    def __download_and_unzip_package(self, archive_to_download, checksum_sha256, staging_dir):
+        if self.__archive_cache_directory != "":
+            if self.__unzip_cached_package(archive_to_download, checksum_sha256, staging_dir):
+                return
+
+            try:
+                # download directly into the cache directory, so the insert is only a rename and
+                # a partial download can be resumed by the next run
+                dest_file_name = archive_cache_helper_functions.archive_cache_temp_file(self.__archive_cache_directory, checksum_sha256)
+            except OSError:
+                print("Archive cache [%s] is not usable, downloading to a temporary directory" % (self.__archive_cache_directory))
+            else:
+                # the incoming file has a stable name, a concurrent run of the same archive waits here
+                # and then finds the archive in the cache
+                with archive_cache_helper_functions.archive_cache_locked(self.__archive_cache_directory, checksum_sha256):
+                    if not self.__unzip_cached_package(archive_to_download, checksum_sha256, staging_dir):
+                        self.__download_and_unzip_package_to(archive_to_download, checksum_sha256, staging_dir, dest_file_name, cache=True)
+                return
 
         with tempfile.TemporaryDirectory() as tmp_download_dir:
-            dest_file_name = os.path.join(tmp_download_dir, archive_to_download)
-            download_url = self.ANDROID_SDK_BASE_URL + "/" + archive_to_download
+            self.__download_and_unzip_package_to(archive_to_download, checksum_sha256, staging_dir, os.path.join(tmp_download_dir, archive_to_download), cache=False)
+
+    def __unzip_cached_package(self, archive_to_download, checksum_sha256, staging_dir):
+        cached_archive = archive_cache_helper_functions.archive_cache_lookup(self.__archive_cache_directory, checksum_sha256)
+        if cached_archive == "":
+            return False
 
-            jenkins_android_helper_commons.download_file(download_url, dest_file_name)
+        print("Using cached archive [%s] for [%s]" % (cached_archive, archive_to_download))
+        jenkins_android_helper_trace.trace_event("archive_cache_hit", category="install", archive=archive_to_download)
+        self.__unzip_package(cached_archive, staging_dir)
+        return True
+
+    def __download_and_unzip_package_to(self, archive_to_download, checksum_sha256, staging_dir, dest_file_name, cache):
+        download_url = self.ANDROID_SDK_BASE_URL + "/" + archive_to_download
+
+        inserted = False
+        try:
+            extracted = False
+            if self.__pipelined_install:
+                try:
+                    computed_checksum, extracted = jenkins_android_helper_commons.download_and_unzip_file(download_url, dest_file_name, staging_dir)
+                except ValueError:
+                    sys.exit(ERROR_CODE_SDK_TOOLS_ARCHIVE_EXTRACT_ERROR)
+            else:
+                # the checksum is computed while the archive is written, no need to read it again
+                computed_checksum = jenkins_android_helper_commons.download_file(download_url, dest_file_name)
 
-            # check archive
-            computed_checksum = jenkins_android_helper_commons.sha256sum(dest_file_name)
             if computed_checksum != checksum_sha256:
                 sys.exit(ERROR_CODE_SDK_TOOLS_ARCHIVE_CHKSUM_MISMATCH)
 
+            if cache:
+                try:
+                    dest_file_name = archive_cache_helper_functions.archive_cache_insert(self.__archive_cache_directory, checksum_sha256, dest_file_name, max_size=self.__archive_cache_max_size)
+                    inserted = True
+                except OSError:
+                    print("Could not add [%s] to the archive cache [%s]" % (archive_to_download, self.__archive_cache_directory))
+
+            if not extracted:
+                if self.__pipelined_install:
+                    print("Extracting the complete archive [%s] instead" % (dest_file_name))
+                    jenkins_android_helper_commons.remove_file_or_dir(staging_dir)
+                    os.mkdir(staging_dir)
+                self.__unzip_package(dest_file_name, staging_dir)
+        finally:
+            # only leftovers of a failed download, a cached archive was already renamed
+            if cache and not inserted:
+                jenkins_android_helper_commons.remove_file_or_dir(dest_file_name)
+
+    def __unzip_package(self, archive_file_name, dest):
+        try:
+            jenkins_android_helper_commons.unzip(archive_file_name, dest)
+        except ValueError:
+            sys.exit(ERROR_CODE_SDK_TOOLS_ARCHIVE_EXTRACT_ERROR)
+
+    ## a non-empty directory can't be replaced by a rename, so the old one is renamed aside right before
+    ## the new one is renamed into place and only removed afterwards
+    def __publish_staged_directory(self, staged_dir, target):
+        old_dir = ""
+        if os.path.lexists(target):
+            old_dir = tempfile.mkdtemp(dir=self.__sdk_directory, prefix=self.ANDROID_SDK_STAGING_DIR_PREFIX)
+            os.rename(target, os.path.join(old_dir, os.path.basename(target)))
+
+        os.rename(staged_dir, target)
+
+        if old_dir != "":
+            jenkins_android_helper_commons.remove_file_or_dir(old_dir)
+
+    ## staging directories of killed runs are removed, after some time, so a concurrent install is not disturbed
+    def __remove_stale_staging_directories(self):
+        for entry in os.listdir(self.__sdk_directory):
+            if not entry.startswith(self.ANDROID_SDK_STAGING_DIR_PREFIX):
+                continue
+
+            staging_dir = self.__get_full_sdk_path(entry)
             try:
-                jenkins_android_helper_commons.unzip(dest_file_name, self.get_sdk_directory())
-            except ValueError:
-                sys.exit(ERROR_CODE_SDK_TOOLS_ARCHIVE_EXTRACT_ERROR)
+                if time.time() - os.path.getmtime(staging_dir) > self.ANDROID_SDK_STAGING_DIR_MAX_AGE:
+                    print("Removing stale staging directory [%s]" % (staging_dir))
+                    jenkins_android_helper_commons.remove_file_or_dir(staging_dir)
+            except OSError:
+                pass
 
     def download_and_install_sdk_tools(self):
         self.download_and_install_package(self.ANDROID_SDK_TOOLS_ARCHIVE[sys.platform], self.ANDROID_SDK_TOOLS_ARCHIVE_SHA256_CHECKSUM[sys.platform], self.ANDROID_SDK_TOOLS_DIR)
 
     ### Workaround for removed archs in r17
     def download_and_install_ndk(self):
-        self.download_and_install_package(self.ANDROID_NDK_ARCHIVE[sys.platform], self.ANDROID_NDK_ARCHIVE_SHA256_CHECKSUM[sys.platform], self.ANDROID_NDK_DIR)
-        shutil.move(self.__get_full_sdk_path('android-ndk-r16b'), self.__get_full_sdk_path(self.ANDROID_NDK_DIR))
+        self.download_and_install_package(self.ANDROID_NDK_ARCHIVE[sys.platform], self.ANDROID_NDK_ARCHIVE_SHA256_CHECKSUM[sys.platform], self.ANDROID_NDK_DIR, directory_inside_archive=self.ANDROID_NDK_ARCHIVE_DIR)
 
     def download_sdk_modules(self, build_tools_version="", platform_version="", ndk=False, system_image="", additional_modules=[]):
         sdkmanager_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_SDKMANAGER) ]
@@ -274,7 +483,7 @@ class AndroidSDK:
         # install ndk if requested
         if ndk:
             if self.ANDROID_NDK_WORKAROUND_KEEP_R16:
-                if not self.is_module_installed(self.ANDROID_NDK_DIR, self.ANDROID_NDK_PROP_VAL_PKG_REV, self.ANDROID_NDK_PROP_VAL_PKG_PATH, self.ANDROID_NDK_PROP_VAL_PKG_DESC, verbose=True):
+                if not self.is_package_marked_installed(self.ANDROID_NDK_DIR, self.ANDROID_NDK_ARCHIVE_SHA256_CHECKSUM[sys.platform]) and not self.is_module_installed(self.ANDROID_NDK_DIR, self.ANDROID_NDK_PROP_VAL_PKG_REV, self.ANDROID_NDK_PROP_VAL_PKG_PATH, self.ANDROID_NDK_PROP_VAL_PKG_DESC, verbose=True):
                     print("Manually downloading NDK version %s, otherwise build failes due to missing MIPS tools" % (self.ANDROID_NDK_PROP_VAL_PKG_REV))
                     self.download_and_install_ndk()
             else:
@@ -324,48 +533,309 @@ class AndroidSDK:
         ## remove empty entries
         sdkmanager_command = list(filter(None, sdkmanager_command))
 
+        # pre-flight: only hand the packages to sdkmanager, which are not installed yet
+        if self.__download_if_neccessary:
+            preflight_start = time.monotonic()
+            requested_packages = sdkmanager_command[1:]
+            with jenkins_android_helper_trace.trace_span("sdkmanager_preflight", category="install", requested=len(requested_packages)) as span:
+                missing_packages = [ package for package in requested_packages if not self.is_sdk_package_installed(package) ]
+                span.set(missing=len(missing_packages))
+            preflight_duration = time.monotonic() - preflight_start
+
+            if len(missing_packages) == 0:
+                last_duration = android_sdk_inventory_helper_functions.sdk_inventory_read_duration(self.__sdk_directory, self.SDKMANAGER_DURATION_NAME)
+                print("All %d requested packages are already installed, skipping sdkmanager (pre-flight took %.3fs, last sdkmanager run took %s)" % (len(requested_packages), preflight_duration, "%.1fs" % last_duration if last_duration is not None else "unknown"))
+                return
+
+            if len(missing_packages) < len(requested_packages):
+                print("Already installed: " + ' '.join([ package for package in requested_packages if not package in missing_packages ]))
+            sdkmanager_command = sdkmanager_command[:1] + missing_packages
+
         print('echo y | ' + ' '.join(sdkmanager_command))
-        subprocess.run(sdkmanager_command, input=b"y\n", stdout=None, stderr=None)
+        sdkmanager_start = time.monotonic()
+        with jenkins_android_helper_trace.trace_span("sdkmanager", category="install", packages=sdkmanager_command[1:]):
+            jenkins_android_helper_trace.traced_run(sdkmanager_command, input=b"y\n", stdout=None, stderr=None)
+        android_sdk_inventory_helper_functions.sdk_inventory_record_duration(self.__sdk_directory, self.SDKMANAGER_DURATION_NAME, time.monotonic() - sdkmanager_start)
+        android_sdk_inventory_helper_functions.sdk_inventory_invalidate(self.__sdk_directory)
+
+    ## sdkmanager package ids map directly to their directory, eg 'system-images;android-24;default;x86'
+    def is_sdk_package_installed(self, package_id):
+        package_props = android_sdk_inventory_helper_functions.sdk_inventory_get_package(self.__sdk_directory, package_id.replace(";", "/"))
+        if package_props is None:
+            return False
+
+        # if the package tells its id, it has to match
+        pkg_path = package_props.get(self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_PATH)
+        return pkg_path is None or pkg_path == package_id
 
-    def create_avd(self, android_system_image, sdcard_size="default", additional_properties=[]):
+    ## with shared_store the sdcard is not part of the AVD, it uses an sdcard image in the node wide store,
+    ## the emulator only keeps a qcow2 overlay of it within the AVD
+    def create_avd(self, android_system_image, sdcard_size="default", additional_properties=[], count=1, shared_store=False):
         if android_system_image is None or android_system_image == "":
             raise ValueError("An android emulator image needs to be set!")
 
-        self.generate_unique_avd_name()
+        # the size names the image in the shared store, check it before any AVD is created
+        if shared_store and sdcard_size != "default" and sdcard_size is not None and sdcard_size != "" and not android_avd_store_helper_functions.avd_store_is_valid_sdcard_size(sdcard_size):
+            raise ValueError("Invalid sdcard size [%s], expected a number with an optional K, M or G suffix" % (sdcard_size))
+
+        self.generate_unique_avd_names(count)
 
+        if len(self.emulator_avd_names) == 1:
+            return self.__create_single_avd(self.emulator_avd_name, android_system_image, sdcard_size, additional_properties, shared_store)
+
+        # avdmanager calls are independent of each other, create the pool concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.emulator_avd_names)) as executor:
+            futures = [ executor.submit(self.__create_single_avd, avd_name, android_system_image, sdcard_size, additional_properties, shared_store) for avd_name in self.emulator_avd_names ]
+            return self.__first_error([ future.result() for future in futures ])
+
+    def __create_single_avd(self, avd_name, android_system_image, sdcard_size, additional_properties, shared_store=False):
+        if sdcard_size == "default":
+            sdcard_size = self.ANDROID_EMULATOR_DEFAULT_SDCARD_SIZE
+
+        create_start = time.monotonic()
+        with jenkins_android_helper_trace.trace_span("create_avd", category="avd", avd=avd_name, image=android_system_image, shared_store=shared_store):
+            self.__create_avd_directory(avd_name, android_system_image, sdcard_size if not shared_store else "", additional_properties)
+
+            if shared_store and sdcard_size is not None and sdcard_size != "":
+                self.__attach_shared_sdcard(avd_name, sdcard_size)
+
+        print("AVD [%s] created in %.2fs, %.1f MiB on disk" % (avd_name, time.monotonic() - create_start, self.__get_avd_disk_usage(avd_name) / (1024 * 1024)))
+
+        return 0
+
+    def __get_avd_disk_usage(self, avd_name):
+        disk_usage = 0
+        for root, dirs, files in os.walk(self.__get_avd_directory(avd_name)):
+            for file_name in files:
+                disk_usage = disk_usage + android_avd_store_helper_functions.avd_store_disk_usage(os.path.join(root, file_name))
+        return disk_usage
+
+    ## the config points to the raw sdcard image of the store, the emulator opens it read-only and writes
+    ## into its own qcow2 overlay within the avd
+    def __attach_shared_sdcard(self, avd_name, sdcard_size):
+        avd_dir = self.__get_avd_directory(avd_name)
+        with jenkins_android_helper_trace.trace_span("shared_sdcard", category="avd", avd=avd_name, size=sdcard_size) as span:
+            sdcard_image, sdcard_create_time = android_avd_store_helper_functions.avd_store_get_sdcard(self.__avd_shared_store_directory, self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_MKSDCARD), sdcard_size)
+            span.set(created=sdcard_create_time > 0)
+
+        ini_helper_functions.ini_file_helper_add_or_update_key_values(os.path.join(avd_dir, self.ANDROID_AVD_CONFIG_FILENAME), [ "hw.sdCard:yes", "hw.sdCard.path:" + sdcard_image ])
+        android_avd_store_helper_functions.avd_store_write_metadata(avd_dir, { "overlays": [ { "base": sdcard_image, "overlay": android_avd_store_helper_functions.avd_store_overlay_path(avd_dir, sdcard_image) } ] })
+
+        print("AVD [%s] uses the shared sdcard [%s] (%.1f MiB, %s)" % (avd_name, sdcard_image,
+            android_avd_store_helper_functions.avd_store_disk_usage(sdcard_image) / (1024 * 1024),
+            "created in %.2fs" % sdcard_create_time if sdcard_create_time > 0 else "reused"))
+
+    def __create_avd_directory(self, avd_name, android_system_image, sdcard_size, additional_properties):
+        if self.__avd_template_cache_directory != "":
+            try:
+                self.__create_avd_from_template(avd_name, android_system_image, sdcard_size, additional_properties)
+                return
+            except (OSError, subprocess.CalledProcessError) as e:
+                print("Creating the AVD from a template failed (" + str(e) + "), creating it directly")
+
+        self.__run_avdmanager_create(self.__avd_home_directory, avd_name, android_system_image, sdcard_size, additional_properties)
+
+    def __run_avdmanager_create(self, avd_home_directory, avd_name, android_system_image, sdcard_size, additional_properties):
         avdmanager_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_AVDMANAGER) ]
 
         avdmanager_command = avdmanager_command + [ "create", "avd", "-f" ]
 
         if sdcard_size is not None and sdcard_size != "":
-            if sdcard_size == "default":
-                avdmanager_command = avdmanager_command + [ "-c", self.ANDROID_EMULATOR_DEFAULT_SDCARD_SIZE ]
-            else:
-                avdmanager_command = avdmanager_command + [ "-c", sdcard_size ]
+            avdmanager_command = avdmanager_command + [ "-c", sdcard_size ]
 
-        avdmanager_command = avdmanager_command + [ "-n", self.emulator_avd_name, "-k", android_system_image ]
+        avdmanager_command = avdmanager_command + [ "-n", avd_name, "-k", android_system_image ]
 
         ## remove empty entries
         avdmanager_command = list(filter(None, avdmanager_command))
 
         print('echo no | ' + ' '.join(avdmanager_command))
-        subprocess.run(avdmanager_command, input=b"no\n", stdout=None, stderr=None).check_returncode()
+        with jenkins_android_helper_trace.trace_span("avdmanager", category="avd", avd=avd_name, image=android_system_image):
+            jenkins_android_helper_trace.traced_run(avdmanager_command, input=b"no\n", stdout=None, stderr=None, env=dict(os.environ, ANDROID_AVD_HOME=avd_home_directory)).check_returncode()
 
         # write the additional properties to the avd config file
-        avd_home_directory = os.path.join(self.__avd_home_directory, self.emulator_avd_name + ".avd")
-        avd_config_file = os.path.join(avd_home_directory, "config.ini")
+        avd_config_file = os.path.join(avd_home_directory, avd_name + ".avd", self.ANDROID_AVD_CONFIG_FILENAME)
+
+        ini_helper_functions.ini_file_helper_add_or_update_key_values(avd_config_file, additional_properties)
+
+    ## the template for the configuration is created once per node with avdmanager, every AVD is a clone of it
+    def __create_avd_from_template(self, avd_name, android_system_image, sdcard_size, additional_properties):
+        image_revision = self.get_system_image_revision(android_system_image)
+        template_key = android_avd_template_helper_functions.avd_template_key(android_system_image, image_revision, sdcard_size, additional_properties)
+
+        template_dir = android_avd_template_helper_functions.avd_template_lookup(self.__avd_template_cache_directory, template_key)
+        if template_dir == "":
+            with android_avd_template_helper_functions.avd_template_locked(self.__avd_template_cache_directory, template_key):
+                # created by someone else in the meantime?
+                template_dir = android_avd_template_helper_functions.avd_template_lookup(self.__avd_template_cache_directory, template_key)
+                if template_dir == "":
+                    print("Creating AVD template [" + template_key + "] for [" + android_system_image + "]")
+                    staging_dir = android_avd_template_helper_functions.avd_template_staging_directory(self.__avd_template_cache_directory, template_key)
+                    self.__run_avdmanager_create(staging_dir, android_avd_template_helper_functions.AVD_TEMPLATE_NAME, android_system_image, sdcard_size, additional_properties)
+                    template_dir = android_avd_template_helper_functions.avd_template_publish(self.__avd_template_cache_directory, template_key, staging_dir)
+
+        clone_start = time.monotonic()
+        with jenkins_android_helper_trace.trace_span("avd_template_clone", category="avd", avd=avd_name, template=template_key) as span:
+            clone_methods = android_avd_template_helper_functions.avd_template_clone(template_dir, self.__avd_home_directory, avd_name)
+            span.set(**clone_methods)
+        print("Cloned AVD [%s] from template [%s] in %.2fs (%s)" % (avd_name, template_key, time.monotonic() - clone_start,
+            ", ".join([ "%s: %d" % (clone_method, count) for clone_method, count in sorted(clone_methods.items()) ])))
+
+    ## 'system-images;android-24;default;x86_64' -> Pkg.Revision of the installed image, empty if unknown
+    def get_system_image_revision(self, android_system_image):
+        try:
+            image_props = ini_helper_functions.ini_file_helper_read_all(os.path.join(self.__sdk_directory, *android_system_image.split(";"), self.ANDROID_SDK_SRC_PROPS_FILENAME))
+        except OSError:
+            return ""
 
-        for keyval in additional_properties:
-            ini_helper_functions.ini_file_helper_add_or_update_key_value(avd_config_file, keyval)
+        return image_props.get(self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_REV, "")
 
+    ## first non zero return code of the list, 0 otherwise
+    def __first_error(self, return_codes):
+        for rc in return_codes:
+            if rc != 0:
+                return rc
         return 0
 
-    def emulator_start(self, skin="", lang="", country="", show_window=False, keep_user_data=False, additional_cli_opts=[]):
-        print("Start the emulator!")
+    def __get_avd_directory(self, avd_name):
+        return os.path.join(self.__avd_home_directory, avd_name + ".avd")
+
+    ## key of the snapshot for the current configuration of the avd and the revision of its system image,
+    ## a changed configuration or an updated image invalidates the snapshot
+    def emulator_snapshot_key(self, avd_name):
+        try:
+            avd_config = ini_helper_functions.ini_file_helper_read_all(os.path.join(self.__get_avd_directory(avd_name), self.ANDROID_AVD_CONFIG_FILENAME))
+        except OSError:
+            return ""
+
+        image_revision = ""
+        system_image_dir = avd_config.get(self.ANDROID_AVD_CONFIG_SYSDIR_KEY, "")
+        if system_image_dir != "":
+            try:
+                image_props = ini_helper_functions.ini_file_helper_read_all(os.path.join(self.__sdk_directory, system_image_dir, self.ANDROID_SDK_SRC_PROPS_FILENAME))
+                image_revision = image_props.get(self.ANDROID_SDK_TOOLS_PROP_NAME_PKG_REV, "")
+            except OSError:
+                pass
+
+        return android_emulator_helper_functions.android_emulator_snapshot_key(avd_config, image_revision)
+
+    def __get_snapshot_metadata_file_name(self, avd_name):
+        return os.path.join(self.__get_avd_directory(avd_name), self.ANDROID_EMULATOR_SNAPSHOT_METADATA_FILENAME)
 
+    def emulator_read_snapshot_metadata(self, avd_name):
+        try:
+            with open(self.__get_snapshot_metadata_file_name(avd_name), 'r') as metadata_file:
+                return json.load(metadata_file)
+        except (OSError, ValueError):
+            return {}
+
+    def emulator_write_snapshot_metadata(self, avd_name, metadata):
+        metadata_file_name = self.__get_snapshot_metadata_file_name(avd_name)
+        with open(metadata_file_name + ".tmp", 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(metadata_file_name + ".tmp", metadata_file_name)
+
+    ## name of the saved snapshot of the avd, if it still matches the configuration, otherwise the snapshot
+    ## is removed and an empty string returned
+    def emulator_get_valid_snapshot(self, avd_name, snapshot_key):
+        metadata = self.emulator_read_snapshot_metadata(avd_name)
+        snapshot_name = metadata.get("snapshot_name", "")
+        if snapshot_name == "":
+            return ""
+
+        snapshot_dir = os.path.join(self.__get_avd_directory(avd_name), self.ANDROID_EMULATOR_SNAPSHOTS_DIR, snapshot_name)
+        if metadata.get("snapshot_key", "") == snapshot_key and jenkins_android_helper_commons.is_directory(snapshot_dir):
+            return snapshot_name
+
+        print("Snapshot [" + snapshot_name + "] of AVD [" + avd_name + "] does not match the configuration or system image anymore, removing it")
+        jenkins_android_helper_commons.remove_file_or_dir(snapshot_dir)
+        jenkins_android_helper_commons.remove_file_or_dir(self.__get_snapshot_metadata_file_name(avd_name))
+        return ""
+
+    ## called once the emulator booted, a cold boot in snapshot mode saves the snapshot, the boot time is
+    ## recorded per boot mode and reported next to the other one
+    def __emulator_snapshot_after_boot(self, avd_name, serial, session):
+        boot_time = time.time() - session.get("started_at", time.time())
+        boot_mode = session.get("boot_mode", "")
+        metadata = self.emulator_read_snapshot_metadata(avd_name)
+
+        if boot_mode == "cold":
+            snapshot_name = self.ANDROID_EMULATOR_SNAPSHOT_NAME_PREFIX + session["snapshot_key"]
+            print("Saving snapshot [" + snapshot_name + "] of AVD [" + avd_name + "]")
+            with jenkins_android_helper_trace.trace_span("snapshot_save", category="emulator", avd=avd_name, snapshot=snapshot_name):
+                snapshot_saved = self.adb_emu(serial, [ "avd", "snapshot", "save", snapshot_name ], timeout=self.ANDROID_EMULATOR_SNAPSHOT_SAVE_TIMEOUT) == 0
+            if not snapshot_saved:
+                print("Saving snapshot [" + snapshot_name + "] failed, next start will cold boot again")
+                return
+
+            # published node wide once the emulator is stopped
+            metadata = { "snapshot_name": snapshot_name, "snapshot_key": session["snapshot_key"], "cold_boot_time": boot_time, "published": False }
+        elif boot_mode == "snapshot":
+            metadata["snapshot_boot_time"] = boot_time
+        else:
+            return
+
+        self.emulator_write_snapshot_metadata(avd_name, metadata)
+
+        cold_boot_time = metadata.get("cold_boot_time")
+        snapshot_boot_time = metadata.get("snapshot_boot_time")
+        print("Boot times of AVD [%s]: cold boot: %s, snapshot boot: %s" % (avd_name,
+            "%.1fs" % cold_boot_time if cold_boot_time is not None else "n/a",
+            "%.1fs" % snapshot_boot_time if snapshot_boot_time is not None else "n/a"))
+
+    ## a new avd gets a clone of the snapshot published by an earlier build of the same configuration, returns
+    ## the name of the snapshot, empty string if there is none
+    def __emulator_restore_published_snapshot(self, avd_name, snapshot_key):
+        if self.__avd_template_cache_directory == "" or snapshot_key == "":
+            return ""
+
+        metadata = android_avd_template_helper_functions.avd_snapshot_lookup(self.__avd_template_cache_directory, snapshot_key)
+        snapshot_name = metadata.get("snapshot_name", "")
+        if snapshot_name == "":
+            return ""
+
+        avd_dir = self.__get_avd_directory(avd_name)
+        restore_start = time.monotonic()
+        try:
+            with jenkins_android_helper_trace.trace_span("snapshot_restore", category="avd", avd=avd_name, snapshot=snapshot_name) as span:
+                clone_methods = android_avd_template_helper_functions.avd_snapshot_restore(self.__avd_template_cache_directory, snapshot_key, avd_dir, self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_QEMU_IMG))
+                span.set(**clone_methods)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            print("Restoring snapshot [" + snapshot_name + "] into AVD [" + avd_name + "] failed (" + str(e) + ")")
+            jenkins_android_helper_commons.remove_file_or_dir(os.path.join(avd_dir, self.ANDROID_EMULATOR_SNAPSHOTS_DIR, snapshot_name))
+            return ""
+
+        self.emulator_write_snapshot_metadata(avd_name, { "snapshot_name": snapshot_name, "snapshot_key": snapshot_key, "cold_boot_time": metadata.get("cold_boot_time"), "published": True })
+        print("Restored snapshot [%s] into AVD [%s] in %.2fs (%s)" % (snapshot_name, avd_name, time.monotonic() - restore_start,
+            ", ".join([ "%s: %d" % (clone_method, count) for clone_method, count in sorted(clone_methods.items()) ])))
+        return snapshot_name
+
+    ## the snapshot of a cold boot is published once the emulator is stopped, its disks are consistent then
+    def __emulator_publish_snapshot(self, avd_name):
+        metadata = self.emulator_read_snapshot_metadata(avd_name)
+        if self.__avd_template_cache_directory == "" or metadata.get("published", True):
+            return
+
+        try:
+            with jenkins_android_helper_trace.trace_span("snapshot_publish", category="avd", avd=avd_name, snapshot=metadata["snapshot_name"]):
+                published = android_avd_template_helper_functions.avd_snapshot_publish(self.__avd_template_cache_directory, metadata["snapshot_key"],
+                    self.__get_avd_directory(avd_name), metadata["snapshot_name"], { "cold_boot_time": metadata.get("cold_boot_time") },
+                    exclude=[ self.ANDROID_EMULATOR_SNAPSHOT_METADATA_FILENAME, android_avd_store_helper_functions.AVD_STORE_METADATA_FILENAME ])
+        except OSError as e:
+            print("Publishing snapshot [" + metadata["snapshot_name"] + "] of AVD [" + avd_name + "] failed (" + str(e) + ")")
+            return
+
+        if published:
+            print("Published snapshot [" + metadata["snapshot_name"] + "] of AVD [" + avd_name + "] for new AVDs of the same configuration")
+        metadata["published"] = True
+        self.emulator_write_snapshot_metadata(avd_name, metadata)
+
+    def __build_emulator_start_command(self, avd_name, skin, lang, country, show_window, keep_user_data, additional_cli_opts, console_port=-1, snapshot_switches=[]):
         emulator_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_EMULATOR) ]
 
-        emulator_command = emulator_command + [ "-avd", self.emulator_avd_name ]
+        emulator_command = emulator_command + [ "-avd", avd_name ]
+
+        if console_port > 0:
+            emulator_command = emulator_command + [ "-port", str(console_port) ]
 
         if skin is not None and skin != "":
             emulator_command = emulator_command + [ "-skin", skin ]
@@ -382,23 +852,100 @@ class AndroidSDK:
         if not keep_user_data:
             emulator_command = emulator_command + [ self.ANDROID_EMULATOR_SWITCH_WIPE_DATA ]
 
-        emulator_command = emulator_command + additional_cli_opts
+        emulator_command = emulator_command + snapshot_switches + additional_cli_opts
 
         ## remove empty entries
-        emulator_command = list(filter(None, emulator_command))
+        return list(filter(None, emulator_command))
+
+    ## in snapshot mode the emulator boots from the snapshot saved after the first cold boot of the
+    ## configuration on this node, the snapshot is never overwritten by the run itself
+    def emulator_start(self, skin="", lang="", country="", show_window=False, keep_user_data=False, additional_cli_opts=[], snapshot=False, avd_names=None):
+        print("Start the emulator!")
+
+        if avd_names is None:
+            avd_names = self.emulator_avd_names
+            # the watchdog restarts a crashed emulator the same way
+            self.__store_json(self.__get_workspace_file_name(self.AVD_START_OPTIONS_STORE_FILENAME), { "skin": skin, "lang": lang, "country": country,
+                "show_window": show_window, "keep_user_data": keep_user_data, "additional_cli_opts": additional_cli_opts, "snapshot": snapshot })
 
-        print(' '.join(emulator_command))
-        proc = subprocess.Popen(emulator_command)
+        # the ports are leased node wide and passed explicitly, so concurrent starts don't race for the same free port
+        console_ports = android_emulator_port_lease_helper_functions.port_lease_acquire(self.__port_lease_directory, len(avd_names), os.getpid(), owner=self.__workspace_directory)
+        if len(console_ports) < len(avd_names):
+            print("Not enough free emulator ports for " + str(len(avd_names)) + " emulator(s)")
+            return 1
+
+        procs = []
+        snapshot_sessions = []
+        for avd_name, console_port in zip(avd_names, console_ports):
+            snapshot_switches = []
+            snapshot_session = {}
+            keep_user_data_avd = keep_user_data
+            if snapshot:
+                snapshot_key = self.emulator_snapshot_key(avd_name)
+                snapshot_name = self.emulator_get_valid_snapshot(avd_name, snapshot_key)
+                if snapshot_name == "":
+                    snapshot_name = self.__emulator_restore_published_snapshot(avd_name, snapshot_key)
+                if snapshot_name != "":
+                    print("Booting AVD [" + avd_name + "] from snapshot [" + snapshot_name + "]")
+                    snapshot_switches = [ "-snapshot", snapshot_name, "-no-snapshot-save" ]
+                    # the snapshot contains the clean user data
+                    keep_user_data_avd = True
+                    snapshot_session = { "boot_mode": "snapshot", "snapshot_key": snapshot_key }
+                else:
+                    print("No snapshot for AVD [" + avd_name + "] yet, cold boot")
+                    snapshot_switches = [ "-no-snapshot-load", "-no-snapshot-save" ]
+                    snapshot_session = { "boot_mode": "cold", "snapshot_key": snapshot_key }
+
+            emulator_command = self.__build_emulator_start_command(avd_name, skin, lang, country, show_window, keep_user_data_avd, additional_cli_opts, console_port=console_port, snapshot_switches=snapshot_switches)
+
+            print(' '.join(emulator_command))
+            snapshot_session["started_at"] = time.time()
+            # inherited by all children of the emulator, identifies them once the process group id is reused
+            snapshot_session["session_id"] = uuid.uuid4().hex
+            snapshot_sessions = snapshot_sessions + [ snapshot_session ]
+            # own process group, so the emulator and all its children can be killed at once
+            procs = procs + [ jenkins_android_helper_trace.traced_popen(emulator_command, start_new_session=(os.name == "posix"),
+                env=dict(os.environ, **{ self.ANDROID_EMULATOR_SESSION_ENV: snapshot_session["session_id"] })) ]
+            jenkins_android_helper_trace.trace_event("emulator_launched", category="emulator", avd=avd_name, console_port=console_port, boot_mode=snapshot_session.get("boot_mode", "cold"))
+        android_emulator_helper_functions.android_emulator_invalidate_process_index()
 
         ## check process after a few seconds
-        time.sleep(5)
-        rc = proc.poll()
+        with jenkins_android_helper_trace.trace_span("emulator_start_check", category="emulator", avds=len(avd_names)):
+            time.sleep(5)
 
-        # still running?
-        if rc is None:
-            rc = 0
+        return_codes = []
+        for avd_name, console_port, proc, snapshot_session in zip(avd_names, console_ports, procs, snapshot_sessions):
+            rc = proc.poll()
 
-        return rc
+            # still running?
+            if rc is None:
+                rc = 0
+                emulator = android_emulator_helper_functions.android_emulator_get_process_from_avd_name(avd_name)
+                emulator_pid = emulator.pid if emulator is not None else proc.pid
+
+                # the lease lives as long as the emulator
+                android_emulator_port_lease_helper_functions.port_lease_transfer(self.__port_lease_directory, console_port, emulator_pid)
+
+                # record the session, so subsequent calls don't need to search for the emulator again
+                self.emulator_remove_session(avd_name)
+                self.emulator_write_session(emulator_pid, "emulator-" + str(console_port), avd_name)
+                self.emulator_update_session(avd_name, process_group=proc.pid if os.name == "posix" else 0, **snapshot_session)
+            else:
+                android_emulator_port_lease_helper_functions.port_lease_release(self.__port_lease_directory, console_port)
+
+            return_codes = return_codes + [ rc ]
+
+        return self.__first_error(return_codes)
+
+    ## runs function(avd_name) for every avd of the pool concurrently, returns the first error
+    def __for_each_avd_concurrently(self, function):
+        if len(self.emulator_avd_names) == 1:
+            return function(self.emulator_avd_names[0])
+
+        # create the client once up front, instead of every thread trying
+        self.get_adb_client()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.emulator_avd_names)) as executor:
+            return self.__first_error(list(executor.map(function, self.emulator_avd_names)))
 
     def emulator_wait_for_start(self):
         print("Waiting for the emulator!")
@@ -407,35 +954,31 @@ class AndroidSDK:
             print("It seems that an AVD was never created! Nothing to wait for!")
             return ERROR_CODE_WAIT_NO_AVD_CREATED
 
-        emulator_pid = android_emulator_helper_functions.android_emulator_get_pid_from_avd_name(self.emulator_avd_name)
+        return self.__for_each_avd_concurrently(self.__emulator_wait_for_start_avd)
+
+    def __emulator_wait_for_start_avd(self, avd_name, cancel=None):
+        emulator_pid, android_emulator_serial = self.emulator_get_pid_and_serial(retry=True, avd_name=avd_name)
         if emulator_pid <= 0:
-            print("AVD with the name [" + self.emulator_avd_name + "] does not seem to run! Startup failure? Nothing to wait for!")
+            print("AVD with the name [" + avd_name + "] does not seem to run! Startup failure? Nothing to wait for!")
             return ERROR_CODE_WAIT_AVD_CREATED_BUT_NOT_RUNNING
 
-        emulator_max_startup_time = 300
-        emulator_startup_time = 0
-
-        android_emulator_serial = android_emulator_helper_functions.android_emulator_serial_via_port_from_used_avd_name(self.emulator_avd_name)
         if android_emulator_serial is None or android_emulator_serial == '':
-            print("Could not detect android_emulator_serial for emulator [PID: '" + str(emulator_pid) + "', AVD: '" + self.emulator_avd_name + "']! Can't properly wait!")
+            print("Could not detect android_emulator_serial for emulator [PID: '" + str(emulator_pid) + "', AVD: '" + avd_name + "']! Can't properly wait!")
             return ERROR_CODE_WAIT_EMULATOR_RUNNING_UNKNOWN_SERIAL
 
-        while True:
-            emulator_wait_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), "-s", android_emulator_serial, "shell", "getprop", "init.svc.bootanim" ]
+        with jenkins_android_helper_trace.trace_span("emulator_boot_wait", category="emulator", avd=avd_name, serial=android_emulator_serial) as span:
+            booted = android_emulator_helper_functions.android_emulator_wait_for_boot(self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), android_emulator_serial, self.ANDROID_EMULATOR_MAX_STARTUP_TIME, adb_client=self.get_adb_client(), cancel=cancel)
+            span.set(booted=booted)
 
-            bootanim_output = subprocess.run(emulator_wait_command, stdout=subprocess.PIPE).stdout.decode(sys.stdout.encoding).strip()
-            if bootanim_output == "stopped":
-                return 0
+        if booted:
+            self.emulator_update_session(avd_name, boot_completed=True)
 
-            time.sleep(5)
-
-            if emulator_startup_time > emulator_max_startup_time:
-                print("AVD with the name [" + self.emulator_avd_name + "] seems to run, but startup does not finish within " + emulator_max_startup_time + " seconds!")
-                break
-
-            time.sleep(1)
-            emulator_startup_time = emulator_startup_time + 1
+            session = self.emulator_read_session(avd_name)
+            if session is not None:
+                self.__emulator_snapshot_after_boot(avd_name, android_emulator_serial, session)
+            return 0
 
+        print("AVD with the name [" + avd_name + "] seems to run, but startup does not finish within " + str(self.ANDROID_EMULATOR_MAX_STARTUP_TIME) + " seconds!")
         return ERROR_CODE_WAIT_EMULATOR_RUNNING_STARTUP_TIMEOUT
 
     def emulator_disable_animations(self):
@@ -443,61 +986,555 @@ class AndroidSDK:
 
         animations_to_disable = [ 'window_animation_scale', 'transition_animation_scale', 'animator_duration_scale' ]
 
+        return self.emulator_apply_device_settings([ "global:" + animation_to_disable + "=0" for animation_to_disable in animations_to_disable ])
+
+    ## applies a list of '<namespace>:<key>=<value>' settings (namespace: global, secure, system or prop)
+    ## on the running emulators, returns the first error or 0
+    def emulator_apply_device_settings(self, settings=[]):
         if self.emulator_avd_name is None or self.emulator_avd_name == '':
             print("It seems that an AVD was never created! Nothing to do here!")
             return 1
 
-        emulator_pid = android_emulator_helper_functions.android_emulator_get_pid_from_avd_name(self.emulator_avd_name)
+        device_settings = []
+        for setting in settings:
+            device_setting = android_emulator_helper_functions.android_emulator_parse_device_setting(setting)
+            if device_setting is None:
+                print("Device setting [" + setting + "] not in form of <global|secure|system|prop>:<key>=<value>")
+                return 1
+            device_settings = device_settings + [ device_setting ]
+
+        if len(device_settings) == 0:
+            print("No device settings given. Nothing to do here!")
+            return 0
+
+        # the watchdog applies them again after a restart
+        start_options = self.__read_json(self.__get_workspace_file_name(self.AVD_START_OPTIONS_STORE_FILENAME))
+        if start_options is not None:
+            start_options["device_settings"] = start_options.get("device_settings", []) + settings
+            self.__store_json(self.__get_workspace_file_name(self.AVD_START_OPTIONS_STORE_FILENAME), start_options)
+
+        return self.__for_each_avd_concurrently(lambda avd_name: self.__emulator_apply_device_settings_avd(avd_name, settings, device_settings))
+
+    def __emulator_apply_device_settings_avd(self, avd_name, settings, device_settings):
+        emulator_pid, android_emulator_serial = self.emulator_get_pid_and_serial(avd_name=avd_name)
         if emulator_pid <= 0:
-            print("AVD with the name [" + self.emulator_avd_name + "] does not seem to run. Nothing to do here!")
+            print("AVD with the name [" + avd_name + "] does not seem to run. Nothing to do here!")
             return 1
 
-        android_emulator_serial = android_emulator_helper_functions.android_emulator_serial_via_port_from_used_avd_name_single_run(self.emulator_avd_name)
         if android_emulator_serial is None or android_emulator_serial == '':
-            print("Could not detect android_emulator_serial for emulator [PID: '" + str(emulator_pid) + "', AVD: '" + self.emulator_avd_name + "']")
+            print("Could not detect android_emulator_serial for emulator [PID: '" + str(emulator_pid) + "', AVD: '" + avd_name + "']")
             return 1
 
-        # WORKAROUND: Settings provider needs sometimes more time to start, so even after waiting for emulator, the commands could fail
-        time.sleep(5)
-
         rc = 0
-        for animation_to_disable in animations_to_disable:
-            disable_animation_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), '-s', android_emulator_serial, 'shell', 'settings', 'put', 'global', animation_to_disable, '0' ]
-            rc_last = subprocess.run(disable_animation_command).returncode
+        for device_setting, rc_setting in zip(settings, self.device_settings_apply(android_emulator_serial, device_settings)):
+            print("Device setting [" + device_setting + "] on [" + android_emulator_serial + "]: " + ("OK" if rc_setting == 0 else "FAILED (" + str(rc_setting) + ")"))
 
             # save first error as rc
-            if rc == 0 and rc_last != 0:
-                rc = rc_last
+            if rc == 0 and rc_setting != 0:
+                rc = 1 if rc_setting < 0 else rc_setting
 
         return rc
 
-    def emulator_kill(self):
+    ## applies the AndroidDeviceSetting list within one shell call on the device, the settings provider
+    ## needs sometimes more time to start after the boot, so the script waits on the device until it
+    ## answers. Returns the exit code per setting, -1 if it was not applied at all.
+    def device_settings_apply(self, serial, device_settings):
+        script = android_emulator_helper_functions.android_emulator_build_device_settings_script(device_settings, self.ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT)
+        with jenkins_android_helper_trace.trace_span("device_settings", category="emulator", serial=serial, settings=len(device_settings)):
+            # the script is silent while it waits for the provider, every check takes up to a few seconds
+            rc, output = self.adb_shell_with_output(serial, [ script ], timeout=self.ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT + self.ANDROID_EMULATOR_SETTINGS_SCRIPT_MARGIN)
+
+        if android_emulator_helper_functions.ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT_MARKER in output:
+            print("Settings provider of [" + serial + "] did not answer within " + str(self.ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT) + " seconds")
+
+        return android_emulator_helper_functions.android_emulator_parse_device_settings_results(output, device_settings)
+
+    ## with remove_avd the AVDs are removed from the workspace afterwards, in the background
+    def emulator_kill(self, remove_avd=False):
         print("Stop emulator!")
 
         if self.emulator_avd_name is None or self.emulator_avd_name == '':
             print("It seems that an AVD was never created! Nothing to do here!")
             return 0
 
-        emulator_pid = android_emulator_helper_functions.android_emulator_get_pid_from_avd_name(self.emulator_avd_name)
+        # otherwise it would restart the emulators
+        self.emulator_watchdog_stop()
+
+        rc = self.__for_each_avd_concurrently(self.__emulator_kill_avd)
+
+        if remove_avd:
+            self.__remove_avds_in_background()
+
+        return rc
+
+    def __emulator_kill_avd(self, avd_name):
+        teardown_start = time.monotonic()
+
+        emulator_pid, android_emulator_serial = self.emulator_get_pid_and_serial(avd_name=avd_name)
         if emulator_pid <= 0:
-            print("AVD with the name [" + self.emulator_avd_name + "] does not seem to run. Nothing to do here!")
+            print("AVD with the name [" + avd_name + "] does not seem to run. Nothing to do here!")
+
+            # children of a crashed emulator
+            crashed_session = self.__read_json(self.__get_emulator_session_file_name(avd_name))
+            if crashed_session is not None:
+                for leaked_process in self.__get_emulator_group_members(crashed_session):
+                    jenkins_android_helper_commons.kill_process_by_pid(leaked_process, force=True)
+
+            self.emulator_remove_session(avd_name)
+            self.__remove_avd_overlays(avd_name)
             return 0
 
-        android_emulator_serial = android_emulator_helper_functions.android_emulator_serial_via_port_from_used_avd_name_single_run(self.emulator_avd_name)
+        # only signal the group if it still is the one the emulator was started in
+        process_group = 0
+        session = self.emulator_read_session(avd_name)
+        if session is not None and session.get("process_group", 0) > 0:
+            try:
+                if os.getpgid(emulator_pid) == session["process_group"]:
+                    process_group = session["process_group"]
+            except OSError:
+                pass
+
         if android_emulator_serial is None or android_emulator_serial == '':
-            print("Could not detect android_emulator_serial for emulator [PID: '" + str(emulator_pid) + "', AVD: '" + self.emulator_avd_name + "']")
+            print("Could not detect android_emulator_serial for emulator [PID: '" + str(emulator_pid) + "', AVD: '" + avd_name + "']")
             print("  > skip sending 'emu kill' command and proceed with sending kill signals")
         else:
-            emulator_kill_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), '-s', android_emulator_serial, 'emu', 'kill' ]
-            subprocess.run(emulator_kill_command)
+            self.adb_emu(android_emulator_serial, [ 'kill' ])
+
+        with jenkins_android_helper_trace.trace_span("emulator_stop", category="emulator", avd=avd_name, serial=android_emulator_serial) as span:
+            stopped = jenkins_android_helper_commons.kill_process_by_pid_with_force_try(emulator_pid, wait_before_kill=10, time_to_force=20, process_group=process_group)
+
+            # children of the emulator which outlived it
+            leaked_processes = []
+            if process_group > 0:
+                leaked_processes = self.__get_emulator_group_members(session)
+                for leaked_process in leaked_processes:
+                    jenkins_android_helper_commons.kill_process_by_pid(leaked_process, force=True)
+            span.set(stopped=stopped, leaked_processes=len(leaked_processes))
+
+        android_emulator_helper_functions.android_emulator_invalidate_process_index()
+        self.emulator_remove_session(avd_name)
+
+        console_port = android_emulator_helper_functions.get_console_port_from_serial(android_emulator_serial)
+        if console_port > 0:
+            android_emulator_port_lease_helper_functions.port_lease_release(self.__port_lease_directory, console_port)
+
+        if stopped:
+            self.__emulator_publish_snapshot(avd_name)
+
+        self.__remove_avd_overlays(avd_name)
+
+        print("Teardown of AVD [%s] took %.2fs, emulator %s, %d leaked process(es) killed" % (avd_name, time.monotonic() - teardown_start,
+            "stopped" if stopped else "still running", len(leaked_processes)))
+
+        return 0
+
+    ## processes of the group the emulator of the session was started in. Once the group is empty its id can
+    ## be reused by any other process, only members carrying the id of the session in their environment
+    ## belong to the emulator.
+    def __get_emulator_group_members(self, session):
+        if session.get("process_group", 0) <= 0 or session.get("session_id", "") == "":
+            return []
+
+        return [ member for member in jenkins_android_helper_commons.get_process_group_members(session["process_group"])
+            if jenkins_android_helper_commons.get_process_environment_value(member, self.ANDROID_EMULATOR_SESSION_ENV) == session["session_id"] ]
+
+    ## the AVD directories and .ini files are moved aside (a rename, so the workspace is clean right away) and
+    ## deleted by a detached process, which does not delay the build
+    def __remove_avds_in_background(self):
+        trash_dir = os.path.join(self.__avd_home_directory, self.ANDROID_AVD_TRASH_DIR_PREFIX + uuid.uuid4().hex)
+        os.makedirs(trash_dir)
+
+        for avd_name in self.emulator_avd_names:
+            for avd_file in [ self.__get_avd_directory(avd_name), os.path.join(self.__avd_home_directory, avd_name + ".ini") ]:
+                if os.path.lexists(avd_file):
+                    os.rename(avd_file, os.path.join(trash_dir, os.path.basename(avd_file)))
+
+        jenkins_android_helper_commons.remove_file_or_dir(self.__get_unique_avd_file_name())
+        self.emulator_read_avd_name()
+
+        print("Removing AVD files [" + trash_dir + "] in the background")
+        jenkins_android_helper_trace.traced_popen([ sys.executable, "-c", "import shutil, sys; shutil.rmtree(sys.argv[1], ignore_errors=True)", trash_dir ],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=(os.name == "posix"))
+
+    ## the emulator creates the overlays of the shared store again on the next start, they are kept while the
+    ## avd has a snapshot, which contains their state
+    def __remove_avd_overlays(self, avd_name):
+        if self.emulator_read_snapshot_metadata(avd_name).get("snapshot_name", "") != "":
+            return
+
+        overlays_written, shared_images = android_avd_store_helper_functions.avd_store_remove_overlays(self.__get_avd_directory(avd_name))
+        if shared_images > 0:
+            print("Removed the overlays of AVD [%s]: %.1f MiB written by this run, %.1f MiB of shared images not copied" % (avd_name, overlays_written / (1024 * 1024), shared_images / (1024 * 1024)))
+
+    ## pid of the watchdog of this workspace, 0 if none is running
+    def emulator_watchdog_get_pid(self):
+        watchdog_process = self.__read_json(self.__get_workspace_file_name(self.AVD_WATCHDOG_PROCESS_FILENAME))
+        try:
+            if watchdog_process is None or not jenkins_android_helper_commons.is_process_running(watchdog_process["pid"]):
+                return 0
+
+            # the pid could have been reused by another process
+            start_time = android_emulator_helper_functions.get_process_start_time(watchdog_process["pid"])
+            if watchdog_process["start_time"] != 0 and start_time != 0 and watchdog_process["start_time"] != start_time:
+                return 0
+        except (KeyError, TypeError):
+            return 0
+
+        return watchdog_process["pid"]
+
+    ## starts a detached process which watches the emulators of the workspace until emulator_kill, an emulator
+    ## which is gone or does not answer anymore is restarted with the options of the last emulator_start
+    def emulator_watchdog_start(self):
+        print("Start the emulator watchdog!")
+
+        if self.emulator_avd_name is None or self.emulator_avd_name == '':
+            print("It seems that an AVD was never created! Nothing to watch!")
+            return 1
+
+        if self.__read_json(self.__get_workspace_file_name(self.AVD_START_OPTIONS_STORE_FILENAME)) is None:
+            print("It seems that the emulator was never started! Nothing to watch!")
+            return 1
+
+        watchdog_pid = self.emulator_watchdog_get_pid()
+        if watchdog_pid > 0:
+            print("Emulator watchdog already running [PID: " + str(watchdog_pid) + "]")
+            return 0
+
+        jenkins_android_helper_commons.remove_file_or_dir(self.__get_workspace_file_name(self.AVD_WATCHDOG_STATUS_FILENAME))
+
+        module_directory = os.path.dirname(os.path.abspath(__file__))
+        watchdog_env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ module_directory, os.getenv("PYTHONPATH", "") ])))
+        with open(self.__get_workspace_file_name(self.AVD_WATCHDOG_LOG_FILENAME), 'a') as watchdog_log:
+            watchdog = jenkins_android_helper_trace.traced_popen([ sys.executable, "-u", "-c", "import sys, jenkins_android_sdk; sys.exit(jenkins_android_sdk.AndroidSDK().emulator_watchdog_run())" ],
+                env=watchdog_env, stdin=subprocess.DEVNULL, stdout=watchdog_log, stderr=subprocess.STDOUT, start_new_session=(os.name == "posix"))
+
+        self.__store_json(self.__get_workspace_file_name(self.AVD_WATCHDOG_PROCESS_FILENAME), { "pid": watchdog.pid,
+            "start_time": android_emulator_helper_functions.get_process_start_time(watchdog.pid) })
+
+        print("Emulator watchdog started [PID: " + str(watchdog.pid) + "], status in [" + self.__get_workspace_file_name(self.AVD_WATCHDOG_STATUS_FILENAME) + "]")
+        return 0
+
+    def emulator_watchdog_stop(self):
+        watchdog_pid = self.emulator_watchdog_get_pid()
+        if watchdog_pid > 0:
+            print("Stop the emulator watchdog [PID: " + str(watchdog_pid) + "]")
+            # a restart in progress is finished, so the emulator it started has a session and is killed next
+            with jenkins_android_helper_trace.trace_span("watchdog_stop", category="watchdog", pid=watchdog_pid) as span:
+                stopped = jenkins_android_helper_commons.kill_process_by_pid_with_force_try(watchdog_pid, time_to_force=self.ANDROID_EMULATOR_WATCHDOG_STOP_TIMEOUT)
+                span.set(stopped=stopped)
+
+        jenkins_android_helper_commons.remove_file_or_dir(self.__get_workspace_file_name(self.AVD_WATCHDOG_PROCESS_FILENAME))
+        jenkins_android_helper_commons.remove_file_or_dir(self.__get_workspace_file_name(self.AVD_WATCHDOG_STATUS_FILENAME))
+
+    ## the watchdog loop, runs in its own process until SIGTERM. Every interval the emulator process, the adb
+    ## state and sys.boot_completed of every avd are checked (one host query and one shell command on the kept
+    ## open adb session). An emulator which is gone is restarted right away, one which fails max_failures
+    ## checks in a row is killed and restarted, at most max_restarts times per avd.
+    def emulator_watchdog_run(self):
+        start_options = self.__read_json(self.__get_workspace_file_name(self.AVD_START_OPTIONS_STORE_FILENAME))
+        if start_options is None:
+            print("It seems that the emulator was never started! Nothing to watch!")
+            return 1
+
+        stop_requested = threading.Event()
+        self.__watchdog_stop_requested = stop_requested
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+
+        print("Watching the emulator(s) of AVD(s) [" + ", ".join(self.emulator_avd_names) + "] every " + str(self.ANDROID_EMULATOR_WATCHDOG_INTERVAL) + " seconds")
+
+        avd_states = {}
+        for avd_name in self.emulator_avd_names:
+            avd_states[avd_name] = { "state": self.ANDROID_EMULATOR_WATCHDOG_STATE_HEALTHY, "serial": "", "failures": 0, "restarts": 0, "error": "" }
+
+        while not stop_requested.is_set():
+            # restarted emulators are children of the watchdog, they are only seen as gone once reaped
+            if os.name == "posix":
+                try:
+                    while os.waitpid(-1, os.WNOHANG)[0] > 0:
+                        pass
+                except ChildProcessError:
+                    pass
+
+            for avd_name in self.emulator_avd_names:
+                if stop_requested.is_set():
+                    break
 
-        jenkins_android_helper_commons.kill_process_by_pid_with_force_try(emulator_pid, wait_before_kill=10, time_to_force=20)
+                avd_state = avd_states[avd_name]
+                state, error = self.__emulator_watchdog_check_avd(avd_name)
+                session = self.emulator_read_session(avd_name)
+                avd_state["serial"] = session.get("serial", "") if session is not None else ""
 
+                if state != self.ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY:
+                    avd_state.update(state=state, failures=0, error="")
+                    continue
+
+                avd_state.update(failures=avd_state["failures"] + 1, error=error)
+                jenkins_android_helper_trace.trace_event("watchdog_check_failed", category="watchdog", avd=avd_name, failures=avd_state["failures"], error=error)
+                if avd_state["state"] != self.ANDROID_EMULATOR_WATCHDOG_STATE_FAILED:
+                    print("Check of AVD [%s] failed (%d/%d): %s" % (avd_name, avd_state["failures"], self.ANDROID_EMULATOR_WATCHDOG_MAX_FAILURES, error))
+
+                # a process which is gone does not come back by waiting
+                if avd_state["failures"] < self.ANDROID_EMULATOR_WATCHDOG_MAX_FAILURES and session is not None:
+                    avd_state["state"] = self.ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY
+                    continue
+
+                if avd_state["restarts"] >= self.ANDROID_EMULATOR_WATCHDOG_MAX_RESTARTS:
+                    if avd_state["state"] != self.ANDROID_EMULATOR_WATCHDOG_STATE_FAILED:
+                        print("AVD [%s] was already restarted %d times, giving up" % (avd_name, avd_state["restarts"]))
+                    avd_state["state"] = self.ANDROID_EMULATOR_WATCHDOG_STATE_FAILED
+                    continue
+
+                avd_state.update(state=self.ANDROID_EMULATOR_WATCHDOG_STATE_RESTARTING, restarts=avd_state["restarts"] + 1)
+                self.__emulator_watchdog_write_status(avd_states)
+
+                if self.__emulator_watchdog_restart_avd(avd_name, start_options) == 0:
+                    avd_state.update(state=self.ANDROID_EMULATOR_WATCHDOG_STATE_HEALTHY, failures=0, error="")
+                else:
+                    # restarted again on the next failing check, if there are restarts left
+                    avd_state.update(failures=self.ANDROID_EMULATOR_WATCHDOG_MAX_FAILURES, error="restart failed")
+
+            self.__emulator_watchdog_write_status(avd_states)
+            stop_requested.wait(self.ANDROID_EMULATOR_WATCHDOG_INTERVAL)
+
+        print("Emulator watchdog stopped")
         return 0
 
+    ## returns (state, error) of the emulator of the avd, booting if it was started recently and did not
+    ## finish its boot yet
+    def __emulator_watchdog_check_avd(self, avd_name):
+        session = self.emulator_read_session(avd_name)
+        if session is None:
+            return self.ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY, "emulator process is gone"
+
+        try:
+            adb_client = self.get_adb_client()
+            if adb_client is not None:
+                adb_state = adb_client.get_state(session["serial"])
+                if adb_state != "device":
+                    return self.ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY, "adb state is [" + adb_state + "]"
+
+            rc, output = self.adb_shell_with_output(session["serial"], [ "getprop", "sys.boot_completed" ])
+        except (OSError, ValueError, android_adb_client.AdbClientError) as e:
+            rc, output = 1, str(e)
+
+        if rc == 0 and output.strip() == "1":
+            return self.ANDROID_EMULATOR_WATCHDOG_STATE_HEALTHY, ""
+
+        if not session.get("boot_completed", False) and time.time() - session.get("started_at", 0) < self.ANDROID_EMULATOR_MAX_STARTUP_TIME:
+            return self.ANDROID_EMULATOR_WATCHDOG_STATE_BOOTING, ""
+
+        return self.ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY, "not booted (" + output.strip() + ")"
+
+    ## kills what is left of the emulator and starts it again from the same AVD (and snapshot, if started
+    ## in snapshot mode), the device settings applied since the start are applied again. Once the watchdog
+    ## is stopped nothing new is started, the boot wait ends and the started emulator is left to emulator_kill.
+    def __emulator_watchdog_restart_avd(self, avd_name, start_options):
+        print("Restarting the emulator of AVD [" + avd_name + "]")
+        restart_start = time.monotonic()
+
+        with jenkins_android_helper_trace.trace_span("watchdog_restart", category="watchdog", avd=avd_name) as span:
+            self.__emulator_kill_avd(avd_name)
+
+            start_arguments = dict(start_options)
+            settings = start_arguments.pop("device_settings", [])
+            rc = self.__emulator_watchdog_stopped_rc()
+            if rc == 0:
+                rc = self.emulator_start(avd_names=[ avd_name ], **start_arguments)
+            if rc == 0:
+                rc = self.__emulator_wait_for_start_avd(avd_name, cancel=self.__watchdog_stop_requested)
+            if rc == 0:
+                rc = self.__emulator_watchdog_stopped_rc()
+
+            if rc == 0 and len(settings) > 0:
+                device_settings = [ android_emulator_helper_functions.android_emulator_parse_device_setting(setting) for setting in settings ]
+                rc = self.__emulator_apply_device_settings_avd(avd_name, settings, device_settings)
+            span.set(rc=rc)
+
+        print("Restart of AVD [%s] %s after %.1fs" % (avd_name, "succeeded" if rc == 0 else "failed (" + str(rc) + ")", time.monotonic() - restart_start))
+        return rc
+
+    def __emulator_watchdog_stopped_rc(self):
+        if self.__watchdog_stop_requested is not None and self.__watchdog_stop_requested.is_set():
+            print("Emulator watchdog is stopped, the restart is not continued")
+            return 1
+        return 0
+
+    def __emulator_watchdog_write_status(self, avd_states):
+        states = [ avd_state["state"] for avd_state in avd_states.values() ]
+        state = self.ANDROID_EMULATOR_WATCHDOG_STATE_HEALTHY
+        for worst_state in [ self.ANDROID_EMULATOR_WATCHDOG_STATE_FAILED, self.ANDROID_EMULATOR_WATCHDOG_STATE_RESTARTING, self.ANDROID_EMULATOR_WATCHDOG_STATE_UNHEALTHY, self.ANDROID_EMULATOR_WATCHDOG_STATE_BOOTING ]:
+            if worst_state in states:
+                state = worst_state
+                break
+
+        self.__store_json(self.__get_workspace_file_name(self.AVD_WATCHDOG_STATUS_FILENAME), { "state": state, "pid": os.getpid(), "updated_at": time.time(),
+            "restarts": sum([ avd_state["restarts"] for avd_state in avd_states.values() ]), "avds": avd_states })
+
+    ## 0 if no watchdog runs or it reports all emulators healthy, while an emulator is booted or restarted it
+    ## waits up to timeout seconds (default: the max startup time), 1 if the watchdog gave up or on timeout
+    def emulator_watchdog_check(self, timeout=None):
+        deadline = time.monotonic() + (timeout if timeout is not None else self.ANDROID_EMULATOR_MAX_STARTUP_TIME)
+        waiting_state = ""
+        while self.emulator_watchdog_get_pid() > 0:
+            status = self.__read_json(self.__get_workspace_file_name(self.AVD_WATCHDOG_STATUS_FILENAME))
+            state = status.get("state", "") if status is not None else ""
+
+            if state == self.ANDROID_EMULATOR_WATCHDOG_STATE_HEALTHY:
+                return 0
+
+            if state == self.ANDROID_EMULATOR_WATCHDOG_STATE_FAILED:
+                for avd_name, avd_state in status.get("avds", {}).items():
+                    if avd_state.get("state", "") == self.ANDROID_EMULATOR_WATCHDOG_STATE_FAILED:
+                        print("Emulator watchdog gave up on AVD [%s] after %d restart(s): %s" % (avd_name, avd_state.get("restarts", 0), avd_state.get("error", "")))
+                return 1
+
+            if time.monotonic() >= deadline:
+                print("Emulator watchdog still reports [" + state + "], giving up waiting")
+                return 1
+
+            if state != waiting_state:
+                print("Emulator watchdog reports [" + (state if state != "" else "no status yet") + "], waiting")
+                waiting_state = state
+            time.sleep(1)
+
+        return 0
+
+    ## serials of the emulators of the pool, empty string for an emulator which does not run
+    def emulator_get_serials(self):
+        return [ self.emulator_get_pid_and_serial(retry=True, avd_name=avd_name)[1] for avd_name in self.emulator_avd_names ]
+
+    ## ANDROID_SERIAL is set to the first emulator, ANDROID_SERIALS to the comma separated serials of the whole pool
     def run_command_with_android_serial_set(self, command=[], cwd=None):
-        android_emulator_serial = android_emulator_helper_functions.android_emulator_serial_via_port_from_used_avd_name(self.emulator_avd_name)
-        return subprocess.run(command, cwd=cwd, env=dict(os.environ, ANDROID_SERIAL=android_emulator_serial)).returncode
+        android_emulator_serials = self.emulator_get_serials()
+        android_emulator_serial = android_emulator_serials[0] if len(android_emulator_serials) > 0 else ""
+        with jenkins_android_helper_trace.trace_span("command", category="command", command=" ".join(command)):
+            return jenkins_android_helper_trace.traced_run(command, cwd=cwd, env=dict(os.environ, ANDROID_SERIAL=android_emulator_serial, ANDROID_SERIALS=",".join(filter(None, android_emulator_serials)))).returncode
+
+    ## runs the command once per running emulator in parallel, with ANDROID_SERIAL set to the emulator and
+    ## ANDROID_SHARD_INDEX/ANDROID_SHARD_COUNT to the shard (eg for 'am instrument -e numShards -e shardIndex').
+    ## The output of every shard is streamed line by line with the shard as prefix, returns the first error.
+    ## AVDs of the pool whose emulator does not run are reported, the command is sharded over the others.
+    def run_command_sharded(self, command=[], cwd=None):
+        android_emulator_serials = []
+        missing_avd_names = []
+        for avd_name, android_emulator_serial in zip(self.emulator_avd_names, self.emulator_get_serials()):
+            if android_emulator_serial is None or android_emulator_serial == "":
+                missing_avd_names = missing_avd_names + [ avd_name ]
+            else:
+                android_emulator_serials = android_emulator_serials + [ android_emulator_serial ]
+
+        if len(android_emulator_serials) == 0:
+            print("No running emulator found! Nothing to run the shards on!")
+            return 1
+
+        shard_count = len(android_emulator_serials)
+        if len(missing_avd_names) > 0:
+            print("WARNING: the emulator(s) of AVD(s) [" + ", ".join(missing_avd_names) + "] do not run, only " + str(shard_count) + " of " + str(len(self.emulator_avd_names)) + " shard(s) are used")
+            jenkins_android_helper_trace.trace_event("shards_missing", category="command", missing=len(missing_avd_names), shards=shard_count)
+        print("Running [" + " ".join(command) + "] in " + str(shard_count) + " shard(s) on [" + ", ".join(android_emulator_serials) + "]")
+
+        output_lock = threading.Lock()
+
+        def stream_output(shard_prefix, stream):
+            for line in iter(stream.readline, b""):
+                with output_lock:
+                    sys.stdout.write(shard_prefix + line.decode("utf-8", errors="replace").rstrip("\r\n") + "\n")
+                    sys.stdout.flush()
+            stream.close()
+
+        procs = []
+        stream_threads = []
+        try:
+            for shard_index, android_emulator_serial in enumerate(android_emulator_serials):
+                shard_env = dict(os.environ, ANDROID_SERIAL=android_emulator_serial, ANDROID_SERIALS=",".join(android_emulator_serials),
+                    ANDROID_SHARD_INDEX=str(shard_index), ANDROID_SHARD_COUNT=str(shard_count))
+                proc = jenkins_android_helper_trace.traced_popen(command, cwd=cwd, env=shard_env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                procs = procs + [ proc ]
+
+                stream_thread = threading.Thread(target=stream_output, args=("[shard %d/%d %s] " % (shard_index, shard_count, android_emulator_serial), proc.stdout))
+                stream_thread.start()
+                stream_threads = stream_threads + [ stream_thread ]
+
+            return_codes = []
+            with jenkins_android_helper_trace.trace_span("sharded_command", category="command", command=" ".join(command), shards=shard_count):
+                for proc, stream_thread in zip(procs, stream_threads):
+                    return_codes = return_codes + [ proc.wait() ]
+                    stream_thread.join()
+        finally:
+            # eg interrupted, the shards must not outlive the wrapper
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+        for shard_index, (android_emulator_serial, rc) in enumerate(zip(android_emulator_serials, return_codes)):
+            print("Shard %d/%d on [%s]: %s" % (shard_index, shard_count, android_emulator_serial, "OK" if rc == 0 else "FAILED (" + str(rc) + ")"))
+
+        return self.__first_error(return_codes)
+
+    ## native client for the adb server, so no adb process needs to be forked per command. The server is
+    ## started via the adb binary if it does not run yet, None if it is still not reachable afterwards.
+    def get_adb_client(self):
+        if self.__adb_client_checked:
+            return self.__adb_client
+        self.__adb_client_checked = True
+
+        adb_client = android_adb_client.AdbClient()
+        if not adb_client.is_server_available():
+            adb_start_server_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), 'start-server' ]
+            try:
+                jenkins_android_helper_trace.traced_run(adb_start_server_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                return None
+            if not adb_client.is_server_available():
+                print("adb server on port [" + str(adb_client.port) + "] not reachable, falling back to the adb binary")
+                return None
+
+        self.__adb_client = adb_client
+        return self.__adb_client
+
+    ## runs the command on the device, returns its exit code
+    def adb_shell(self, serial, command=[]):
+        rc, output = self.adb_shell_with_output(serial, command)
+        if output != "":
+            print(output, end="" if output.endswith("\n") else "\n")
+        return rc
+
+    ## runs the command on the device, returns its exit code and output. timeout: seconds the command may
+    ## run without output on the native client. A command is never sent twice: the adb binary is only used
+    ## if the native client could not even send it.
+    def adb_shell_with_output(self, serial, command=[], timeout=None):
+        adb_client = self.get_adb_client()
+        if adb_client is not None:
+            try:
+                return adb_client.shell(serial, " ".join(command), timeout=timeout)
+            except android_adb_client.AdbCommandSentError as e:
+                print("Native adb client failed (" + str(e) + ")")
+                return self.ADB_SHELL_RC_CONNECTION_FAILED, ""
+            except (OSError, ValueError, android_adb_client.AdbClientError) as e:
+                print("Native adb client failed (" + str(e) + "), falling back to the adb binary")
+
+        adb_shell_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), '-s', serial, 'shell' ] + command
+        result = jenkins_android_helper_trace.traced_run(adb_shell_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return result.returncode, result.stdout.decode("utf-8", errors="replace").replace("\r\n", "\n")
+
+    ## sends the commands to the console of the emulator with the given serial (adb emu), timeout: seconds to
+    ## wait for the answer. The adb binary is only used if the console can't be reached, a sent command or
+    ## a 'KO' answer is never sent again, it returns 1.
+    def adb_emu(self, serial, command=[], timeout=None):
+        console_port = android_emulator_helper_functions.get_console_port_from_serial(serial)
+        if console_port > 0:
+            try:
+                android_adb_client.emulator_console_command(console_port, [ " ".join(command) ], command_timeout=timeout)
+                return 0
+            except android_adb_client.AdbCommandSentError as e:
+                # the console might have run it already, it is not sent again through the adb binary
+                print(str(e))
+                return 1
+            except (OSError, android_adb_client.AdbClientError) as e:
+                print("Emulator console on port [" + str(console_port) + "] failed (" + str(e) + "), falling back to the adb binary")
+
+        adb_emu_command = [ self.__get_full_sdk_path(self.ANDROID_SDK_TOOLS_BIN_ADB), '-s', serial, 'emu' ] + command
+        return jenkins_android_helper_trace.traced_run(adb_emu_command).returncode
 
     def write_license_files(self):
         license_dir = self.__get_full_sdk_path(self.ANDROID_SDK_ROOT_LICENSE_DIR)
@@ -516,22 +1553,118 @@ class AndroidSDK:
             licensefile.write("\n")
             licensefile.write(self.ANDROID_SDK_ROOT_LICENSE_PREVIEW_HASH)
 
+    def __get_emulator_session_file_name(self, avd_name):
+        return os.path.join(self.__workspace_directory, self.AVD_SESSION_STORE_FILENAME_FORMAT.format(avd_name))
+
+    ## the session of the emulator started for the given avd (default: the first one), None if there is none
+    ## or if the recorded process is gone (or the pid was reused by another process)
+    def emulator_read_session(self, avd_name=None):
+        avd_name = avd_name if avd_name is not None else self.emulator_avd_name
+        try:
+            with open(self.__get_emulator_session_file_name(avd_name), 'r') as sessionstore:
+                session = json.load(sessionstore)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            if session["avd_name"] != avd_name or not jenkins_android_helper_commons.is_process_running(session["pid"]):
+                return None
+
+            start_time = android_emulator_helper_functions.get_process_start_time(session["pid"])
+            if session["start_time"] != 0 and start_time != 0 and session["start_time"] != start_time:
+                return None
+        except (KeyError, TypeError):
+            return None
+
+        return session
+
+    def __get_workspace_file_name(self, file_name):
+        return os.path.join(self.__workspace_directory, file_name)
+
+    def __read_json(self, file_name):
+        try:
+            with open(file_name, 'r') as jsonstore:
+                return json.load(jsonstore)
+        except (OSError, ValueError):
+            return None
+
+    def __store_json(self, file_name, content):
+        with open(file_name + ".tmp", 'w') as jsonstore:
+            json.dump(content, jsonstore)
+        os.replace(file_name + ".tmp", file_name)
+
+    def __store_session(self, avd_name, session):
+        self.__store_json(self.__get_emulator_session_file_name(avd_name), session)
+
+    def emulator_write_session(self, pid, serial, avd_name=None):
+        avd_name = avd_name if avd_name is not None else self.emulator_avd_name
+        console_port = android_emulator_helper_functions.get_console_port_from_serial(serial)
+
+        session = { "avd_name": avd_name, "pid": pid, "start_time": android_emulator_helper_functions.get_process_start_time(pid),
+                    "console_port": console_port, "adb_port": console_port + 1 if console_port > 0 else -1, "serial": serial, "boot_completed": False }
+
+        self.__store_session(avd_name, session)
+
+    def emulator_update_session(self, avd_name=None, **values):
+        avd_name = avd_name if avd_name is not None else self.emulator_avd_name
+        session = self.emulator_read_session(avd_name)
+        if session is None:
+            return
+
+        session.update(values)
+        self.__store_session(avd_name, session)
+
+    def emulator_remove_session(self, avd_name=None):
+        avd_name = avd_name if avd_name is not None else self.emulator_avd_name
+        jenkins_android_helper_commons.remove_file_or_dir(self.__get_emulator_session_file_name(avd_name))
+
+    ## pid and serial of the emulator running the given avd (default: the first one), taken from the session
+    ## if still valid, otherwise detected and recorded; with retry the serial detection is retried for a while
+    def emulator_get_pid_and_serial(self, retry=False, avd_name=None):
+        avd_name = avd_name if avd_name is not None else self.emulator_avd_name
+        session = self.emulator_read_session(avd_name)
+        if session is not None and session.get("serial", "") != "":
+            return session["pid"], session["serial"]
+
+        emulator_pid = android_emulator_helper_functions.android_emulator_get_pid_from_avd_name(avd_name)
+        if emulator_pid is None or emulator_pid == "" or emulator_pid <= 0:
+            return 0, ""
+
+        if retry:
+            android_emulator_serial = android_emulator_helper_functions.android_emulator_serial_via_port_from_used_avd_name(avd_name)
+        else:
+            android_emulator_serial = android_emulator_helper_functions.android_emulator_serial_via_port_from_used_avd_name_single_run(avd_name)
+
+        if android_emulator_serial is not None and android_emulator_serial != "":
+            self.emulator_write_session(emulator_pid, android_emulator_serial, avd_name)
+        else:
+            android_emulator_serial = ""
+
+        return emulator_pid, android_emulator_serial
+
     def __get_unique_avd_file_name(self):
         return os.path.join(self.__workspace_directory, self.AVD_NAME_UNIQUE_STORE_FILENAME)
 
     ## this shall only be called on avd creation, all other calls will reference this name
     def generate_unique_avd_name(self):
+        self.generate_unique_avd_names(1)
+
+    ## one name per line, the first one is the primary avd
+    def generate_unique_avd_names(self, count):
         with open(self.__get_unique_avd_file_name(), 'w') as avdnamestore:
-            print(uuid.uuid4().hex, file=avdnamestore)
+            for i in range(0, max(count, 1)):
+                print(uuid.uuid4().hex, file=avdnamestore)
 
         self.emulator_read_avd_name()
 
     def emulator_read_avd_name(self):
         try:
             with open(self.__get_unique_avd_file_name()) as f:
-                self.emulator_avd_name = f.readline().strip()
+                self.emulator_avd_names = list(filter(None, [ line.strip() for line in f ]))
         except:
-            self.emulator_avd_name = ""
+            self.emulator_avd_names = []
+
+        self.emulator_avd_name = self.emulator_avd_names[0] if len(self.emulator_avd_names) > 0 else ""
 
     def info(self):
         print("Current SDK directory: " + self.__sdk_directory)
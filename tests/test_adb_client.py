@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## AdbClient.shell against a minimal adb server in this process, the device shell is a local sh, and
+## emulator_console_command against a minimal emulator console. A command must never run twice, also not if
+## it outlives the timeout or the session broke.
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import android_adb_client
+
+SERIAL = "emulator-5554"
+
+## the device shell is a local sh, run with the given environment; output of 'shell:' services is streamed
+class FakeAdbServer:
+    def __init__(self, env=None):
+        self.env = env
+        self.procs = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.sessions = []
+        self.services = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def read_request(self, conn):
+        length = int(conn.recv(4), 16)
+        data = b""
+        while len(data) < length:
+            data = data + conn.recv(length - len(data))
+        return data.decode("utf-8")
+
+    def handle(self, conn):
+        try:
+            if self.read_request(conn) != "host:transport:" + SERIAL:
+                conn.sendall(b"FAIL0010device not found")
+                return
+            conn.sendall(b"OKAY")
+
+            service = self.read_request(conn)
+            self.services.append(service)
+            conn.sendall(b"OKAY")
+            if service == "exec:sh":
+                self.sessions.append(conn)
+                self.run_shell([ "sh" ], conn, stdin=conn.fileno())
+            elif service.startswith("shell:"):
+                self.run_shell([ "sh", "-c", service[len("shell:"):] ], conn, stdin=subprocess.DEVNULL)
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def run_shell(self, command, conn, stdin):
+        proc = subprocess.Popen(command, stdin=stdin, stdout=conn.fileno(), stderr=subprocess.STDOUT, env=self.env)
+        self.procs.append(proc)
+        proc.wait()
+
+    ## like a restarted device, the adb server closes the open sessions
+    def drop_sessions(self):
+        for conn in self.sessions:
+            conn.shutdown(socket.SHUT_RDWR)
+        self.sessions = []
+
+    def close(self):
+        close_listening_socket(self.sock)
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+## a listening socket only closed while a thread is blocked in accept would still accept connections
+def close_listening_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+## answers every command after the delay configured for it with OK, or KO for commands starting with 'ko'
+class FakeEmulatorConsole:
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        self.commands = []
+        self.delays = {}
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        reader = conn.makefile("rb")
+        try:
+            conn.sendall(b"Android Console: type 'help' for a list of commands\r\nOK\r\n")
+            for line in reader:
+                command = line.decode("utf-8").strip()
+                self.commands.append(command)
+                time.sleep(self.delays.get(command, 0))
+                conn.sendall(b"KO: unknown command\r\n" if command.startswith("ko") else b"OK\r\n")
+        except OSError:
+            pass
+        finally:
+            reader.close()
+            conn.close()
+
+    def close(self):
+        close_listening_socket(self.sock)
+
+class EmulatorConsoleTest(unittest.TestCase):
+    def setUp(self):
+        self.console = FakeEmulatorConsole()
+        self.saved_token_file = android_adb_client.EMULATOR_CONSOLE_AUTH_TOKEN_FILE
+        android_adb_client.EMULATOR_CONSOLE_AUTH_TOKEN_FILE = os.path.join(tempfile.gettempdir(), "no-such-token-file")
+
+    def tearDown(self):
+        android_adb_client.EMULATOR_CONSOLE_AUTH_TOKEN_FILE = self.saved_token_file
+        self.console.close()
+
+    def test_answers(self):
+        self.assertEqual(android_adb_client.emulator_console_command(self.console.port, [ "avd status", "kill" ]), [ "", "" ])
+        self.assertEqual(self.console.commands, [ "avd status", "kill" ])
+
+    def test_command_answered_after_the_timeout_is_not_sent_again(self):
+        self.console.delays["avd snapshot save s"] = 2
+        with self.assertRaises(android_adb_client.AdbCommandSentError):
+            android_adb_client.emulator_console_command(self.console.port, [ "avd snapshot save s" ], timeout=1)
+        time.sleep(1.5)
+        self.assertEqual(self.console.commands, [ "avd snapshot save s" ])
+
+    def test_command_timeout(self):
+        self.console.delays["avd snapshot save s"] = 2
+        android_adb_client.emulator_console_command(self.console.port, [ "avd snapshot save s" ], timeout=1, command_timeout=5)
+        self.assertEqual(self.console.commands, [ "avd snapshot save s" ])
+
+    def test_ko_answer_is_a_sent_command(self):
+        with self.assertRaises(android_adb_client.AdbCommandSentError):
+            android_adb_client.emulator_console_command(self.console.port, [ "ko command" ])
+
+    def test_no_console_is_a_setup_error(self):
+        port = self.console.port
+        self.console.close()
+        with self.assertRaises(OSError):
+            android_adb_client.emulator_console_command(port, [ "kill" ])
+
+class AdbClientShellTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.counter = os.path.join(self.tmp_dir, "runs")
+        self.server = FakeAdbServer()
+        self.client = android_adb_client.AdbClient(port=self.server.port, timeout=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def runs(self):
+        try:
+            with open(self.counter) as f:
+                return len(f.read().splitlines())
+        except OSError:
+            return 0
+
+    def counted(self, command):
+        return "echo run >> " + self.counter + "; " + command
+
+    def test_output_and_exit_code(self):
+        self.assertEqual(self.client.shell(SERIAL, "echo hello; exit 3"), (3, "hello\n"))
+        self.assertEqual(self.client.shell(SERIAL, "printf no-newline"), (0, "no-newline"))
+        # both commands on the same session
+        self.assertEqual(self.server.services, [ "exec:sh" ])
+
+    def test_command_running_longer_than_the_timeout_is_not_sent_again(self):
+        with self.assertRaises(android_adb_client.AdbCommandSentError):
+            self.client.shell(SERIAL, self.counted("sleep 2"))
+
+        time.sleep(1.5)
+        self.assertEqual(self.runs(), 1)
+
+        # the broken session is not reused
+        self.assertEqual(self.client.shell(SERIAL, "echo next"), (0, "next\n"))
+        self.assertEqual(self.server.services, [ "exec:sh", "exec:sh" ])
+
+    def test_timeout_per_call(self):
+        self.assertEqual(self.client.shell(SERIAL, self.counted("sleep 2; echo done"), timeout=5), (0, "done\n"))
+        self.assertEqual(self.runs(), 1)
+
+    def test_closed_session_is_replaced_before_the_command_is_sent(self):
+        self.client.shell(SERIAL, "true")
+        self.server.drop_sessions()
+        time.sleep(0.2)
+
+        self.assertEqual(self.client.shell(SERIAL, self.counted("echo again")), (0, "again\n"))
+        self.assertEqual(self.runs(), 1)
+
+    def test_unknown_device_is_a_setup_error(self):
+        with self.assertRaises(android_adb_client.AdbClientError) as context:
+            self.client.shell("emulator-5556", "true")
+        self.assertNotIsInstance(context.exception, android_adb_client.AdbCommandSentError)
+
+if __name__ == "__main__":
+    unittest.main()
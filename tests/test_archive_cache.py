@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## the archive cache: least recently used entries are evicted first under a size limit, a corrupted entry
+## is dropped on a hit, and builds racing for the same archive download it only once.
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+
+import archive_cache_helper_functions
+
+## argv: cache dir, archive content, start time; the same steps as the installer, a slow download into the
+## incoming file of the archive while holding its lock. Prints whether the archive was downloaded.
+SIMULATED_INSTALL = """
+import os, sys, json, time, hashlib
+import archive_cache_helper_functions as cache
+
+cache_dir, content, start_at = sys.argv[1], sys.argv[2].encode("utf-8"), float(sys.argv[3])
+sha = hashlib.sha256(content).hexdigest()
+time.sleep(max(start_at - time.time(), 0))
+
+downloaded = False
+entry = cache.archive_cache_lookup(cache_dir, sha)
+if entry == "":
+    incoming = cache.archive_cache_temp_file(cache_dir, sha)
+    with cache.archive_cache_locked(cache_dir, sha):
+        entry = cache.archive_cache_lookup(cache_dir, sha)
+        if entry == "":
+            with open(incoming, "wb") as download:
+                for idx in range(0, len(content)):
+                    download.write(content[idx:idx + 1])
+                    download.flush()
+                    time.sleep(0.01)
+            entry = cache.archive_cache_insert(cache_dir, sha, incoming)
+            downloaded = True
+
+with open(entry, "rb") as archive:
+    print(json.dumps({ "downloaded": downloaded, "valid": archive.read() == content }))
+"""
+
+class ArchiveCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    ## inserts an archive of the given size, returns its sha256
+    def insert(self, name, size, max_size=0, mtime=None):
+        content = (name.encode("utf-8") * size)[:size]
+        src = os.path.join(self.tmp_dir, name)
+        with open(src, "wb") as src_file:
+            src_file.write(content)
+
+        sha = hashlib.sha256(content).hexdigest()
+        entry = archive_cache_helper_functions.archive_cache_insert(self.cache_dir, sha, src, max_size=max_size)
+        if mtime is not None:
+            os.utime(entry, (mtime, mtime))
+        return sha
+
+    def cached(self):
+        return sorted([ entry for entry in os.listdir(self.cache_dir) if not entry.startswith(archive_cache_helper_functions.ARCHIVE_CACHE_TMP_PREFIX) ])
+
+    def test_least_recently_used_are_evicted_first(self):
+        now = time.time()
+        a = self.insert("a", 1000, mtime=now - 300)
+        b = self.insert("b", 1000, mtime=now - 200)
+        c = self.insert("c", 1000, mtime=now - 100)
+
+        # the hit makes a the most recently used one
+        self.assertNotEqual(archive_cache_helper_functions.archive_cache_lookup(self.cache_dir, a), "")
+        d = self.insert("d", 1000, max_size=3000)
+        self.assertEqual(self.cached(), sorted([ a, c, d ]))
+
+        e = self.insert("e", 1500, max_size=3000)
+        self.assertEqual(self.cached(), sorted([ d, e ]))
+
+    def test_inserted_entry_is_kept_above_the_limit(self):
+        self.insert("a", 1000)
+        big = self.insert("big", 5000, max_size=3000)
+        self.assertEqual(self.cached(), [ big ])
+
+    def test_incoming_files_and_locks_are_not_evicted(self):
+        sha = self.insert("a", 1000)
+        incoming = archive_cache_helper_functions.archive_cache_temp_file(self.cache_dir, "b" * 64)
+        with open(incoming, "wb") as incoming_file:
+            incoming_file.write(b"x" * 5000)
+        with archive_cache_helper_functions.archive_cache_locked(self.cache_dir, "b" * 64):
+            self.assertEqual(archive_cache_helper_functions.archive_cache_evict(self.cache_dir, 1000), 1000)
+
+        self.assertTrue(os.path.isfile(incoming))
+        self.assertEqual(self.cached(), [ sha ])
+
+    def test_corrupted_entry_is_a_miss(self):
+        sha = self.insert("a", 1000)
+        entry = archive_cache_helper_functions.archive_cache_entry_path(self.cache_dir, sha)
+        self.assertEqual(archive_cache_helper_functions.archive_cache_lookup(self.cache_dir, sha), entry)
+
+        with open(entry, "r+b") as entry_file:
+            entry_file.seek(500)
+            entry_file.write(b"corrupted")
+
+        self.assertEqual(archive_cache_helper_functions.archive_cache_lookup(self.cache_dir, sha), "")
+        self.assertFalse(os.path.exists(entry))
+
+        # a truncated entry as well
+        sha = self.insert("b", 1000)
+        entry = archive_cache_helper_functions.archive_cache_entry_path(self.cache_dir, sha)
+        os.truncate(entry, 10)
+        self.assertEqual(archive_cache_helper_functions.archive_cache_lookup(self.cache_dir, sha), "")
+        self.assertEqual(self.cached(), [])
+
+    def test_racing_inserters_download_once(self):
+        content = "archive content downloaded by one of the racing builds"
+        start_at = time.time() + 1
+        procs = [ subprocess.Popen([ sys.executable, "-c", SIMULATED_INSTALL, self.cache_dir, content, str(start_at) ],
+            cwd=REPO_DIRECTORY, env=dict(os.environ, PYTHONPATH=REPO_DIRECTORY), stdout=subprocess.PIPE) for idx in range(0, 4) ]
+
+        results = []
+        for proc in procs:
+            output = proc.communicate()[0]
+            self.assertEqual(proc.returncode, 0)
+            results = results + [ json.loads(output.decode("utf-8").splitlines()[-1]) ]
+
+        self.assertEqual(len([ result for result in results if result["downloaded"] ]), 1)
+        self.assertTrue(all([ result["valid"] for result in results ]))
+        # only the lock file of the archive is left besides the entry
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted([ hashlib.sha256(content.encode("utf-8")).hexdigest(),
+            archive_cache_helper_functions.ARCHIVE_CACHE_TMP_PREFIX + hashlib.sha256(content.encode("utf-8")).hexdigest() + ".lock" ]))
+
+    def test_racing_inserts_of_the_same_archive(self):
+        # without the lock, eg two copies of the same archive from outside the cache, the entry stays valid
+        content = b"x" * 100000
+        sha = hashlib.sha256(content).hexdigest()
+        srcs = []
+        for idx in range(0, 4):
+            srcs = srcs + [ os.path.join(self.tmp_dir, "src%d" % idx) ]
+            with open(srcs[-1], "wb") as src_file:
+                src_file.write(content)
+
+        inserters = [ subprocess.Popen([ sys.executable, "-c", "import sys, archive_cache_helper_functions as cache; cache.archive_cache_insert(*sys.argv[1:])", self.cache_dir, sha, src ],
+            cwd=REPO_DIRECTORY, env=dict(os.environ, PYTHONPATH=REPO_DIRECTORY)) for src in srcs ]
+        for inserter in inserters:
+            self.assertEqual(inserter.wait(), 0)
+
+        self.assertEqual(os.listdir(self.cache_dir), [ sha ])
+        self.assertNotEqual(archive_cache_helper_functions.archive_cache_lookup(self.cache_dir, sha), "")
+
+if __name__ == "__main__":
+    unittest.main()
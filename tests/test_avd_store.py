@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## the sdcard images of the shared store with a stub mksdcard: an image is created once and reused, a size
+## which is not accepted by mksdcard never ends up in a path.
+
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import android_avd_store_helper_functions
+
+## records its calls, argv: size, image
+STUB_MKSDCARD = """#!/bin/sh
+echo "$1" >> "$(dirname "$0")/calls"
+: > "$2"
+"""
+
+class AvdStoreSdcardTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, "store")
+        self.mksdcard = os.path.join(self.tmp_dir, "mksdcard")
+        with open(self.mksdcard, "w") as mksdcard:
+            mksdcard.write(STUB_MKSDCARD)
+        os.chmod(self.mksdcard, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.tmp_dir, "calls")) as calls:
+                return calls.read().split()
+        except OSError:
+            return []
+
+    def test_created_once(self):
+        sdcard_image, create_time = android_avd_store_helper_functions.avd_store_get_sdcard(self.store_dir, self.mksdcard, "200M")
+        self.assertEqual(sdcard_image, os.path.join(self.store_dir, "sdcard-200M.img"))
+        self.assertGreater(create_time, 0)
+        # read-only, the AVDs write into their overlays
+        self.assertEqual(stat.S_IMODE(os.stat(sdcard_image).st_mode), 0o444)
+
+        self.assertEqual(android_avd_store_helper_functions.avd_store_get_sdcard(self.store_dir, self.mksdcard, "200M"), (sdcard_image, 0))
+        self.assertEqual(self.calls(), [ "200M" ])
+
+    def test_valid_sizes(self):
+        for sdcard_size in [ "1024", "512K", "200M", "2G" ]:
+            self.assertTrue(android_avd_store_helper_functions.avd_store_is_valid_sdcard_size(sdcard_size), sdcard_size)
+
+    def test_invalid_sizes_are_refused(self):
+        for sdcard_size in [ "", None, "M", "200MB", "200m", "-1M", " 200M", "200M\n", "../../200M", "200M/../../x", "1G;rm -rf /" ]:
+            with self.assertRaises(ValueError):
+                android_avd_store_helper_functions.avd_store_get_sdcard(self.store_dir, self.mksdcard, sdcard_size)
+
+        self.assertEqual(self.calls(), [])
+        self.assertFalse(os.path.exists(self.store_dir))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## the device settings script run by a local sh, with 'settings' and 'setprop' stubs in the PATH. The wait
+## for the settings provider must end after the given seconds, no matter how long one 'settings get' takes.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import android_emulator_helper_functions
+
+## SETTINGS_UP: 1 if the provider answers, SETTINGS_DELAY: seconds every 'settings' call takes
+STUB_SETTINGS = """#!/bin/sh
+sleep "$SETTINGS_DELAY"
+if [ "$SETTINGS_UP" != "1" ]; then
+    echo "Error: can't find service: settings"
+    exit 1
+fi
+if [ "$1" = "get" ]; then
+    echo 1
+else
+    echo "$@" >> "$SETTINGS_LOG"
+fi
+"""
+
+STUB_SETPROP = """#!/bin/sh
+echo "setprop $@" >> "$SETTINGS_LOG"
+"""
+
+class DeviceSettingsScriptTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, "settings.log")
+        for name, content in [ ("settings", STUB_SETTINGS), ("setprop", STUB_SETPROP) ]:
+            with open(os.path.join(self.tmp_dir, name), "w") as stub:
+                stub.write(content)
+            os.chmod(os.path.join(self.tmp_dir, name), 0o755)
+        self.device_settings = [ android_emulator_helper_functions.android_emulator_parse_device_setting(setting) for setting in [ "global:window_animation_scale=0", "prop:debug.x=a b" ] ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_script(self, provider_timeout, up, delay):
+        script = android_emulator_helper_functions.android_emulator_build_device_settings_script(self.device_settings, provider_timeout)
+        env = dict(os.environ, PATH=self.tmp_dir + os.pathsep + os.environ["PATH"], SETTINGS_UP=up, SETTINGS_DELAY=str(delay), SETTINGS_LOG=self.log)
+        start = time.monotonic()
+        output = subprocess.run([ "sh", "-c", script ], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode("utf-8")
+        return output, time.monotonic() - start
+
+    def test_settings_are_applied(self):
+        output, duration = self.run_script(10, "1", 0)
+
+        self.assertEqual(android_emulator_helper_functions.android_emulator_parse_device_settings_results(output, self.device_settings), [ 0, 0 ])
+        with open(self.log) as log:
+            self.assertEqual(log.read().splitlines(), [ "put global window_animation_scale 0", "setprop debug.x a b" ])
+
+    def test_provider_wait_is_bounded_by_time(self):
+        output, duration = self.run_script(2, "0", 0)
+
+        self.assertIn(android_emulator_helper_functions.ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT_MARKER, output)
+        self.assertEqual(android_emulator_helper_functions.android_emulator_parse_device_settings_results(output, self.device_settings), [ -1, -1 ])
+        self.assertLess(duration, 5)
+
+    def test_slow_settings_calls_do_not_stretch_the_wait(self):
+        # counted in tries, 10 tries of 1.2s each would take 12s
+        output, duration = self.run_script(2, "0", 1)
+
+        self.assertIn(android_emulator_helper_functions.ANDROID_EMULATOR_SETTINGS_PROVIDER_TIMEOUT_MARKER, output)
+        self.assertLess(duration, 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## interrupted, resumed and concurrent downloads of download_file against a local http.server, which can
+## drop the connection after a number of bytes
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import http.server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jenkins_android_helper_commons
+
+class DroppingRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get("Range", "")
+
+        with server.lock:
+            server.requests = server.requests + [ range_header ]
+            drop_after = server.drop_after.pop(0) if len(server.drop_after) > 0 and range_header != "bytes=0-0" else -1
+
+        if server.accept_ranges and range_header.startswith("bytes="):
+            range_start, range_end = range_header[len("bytes="):].split("-")
+            start, end = int(range_start), min(int(range_end), len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        body = data[start:end + 1]
+        try:
+            if drop_after >= 0:
+                # the announced length is not reached, the client sees an incomplete read
+                self.wfile.write(body[:drop_after])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+        except OSError:
+            # the client gave up on this connection
+            self.close_connection = True
+
+class DownloadResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, "archive.zip")
+        self.data = os.urandom(3 * 1024 * 1024 + 123)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DroppingRequestHandler)
+        self.server.daemon_threads = True
+        self.server.data = self.data
+        self.server.accept_ranges = True
+        self.server.drop_after = []
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/archive.zip" % self.server.server_address[1]
+
+        self.saved_settings = (jenkins_android_helper_commons.DOWNLOAD_RETRIES, jenkins_android_helper_commons.DOWNLOAD_RETRY_DELAY, jenkins_android_helper_commons.DOWNLOAD_PARALLEL_MIN_SIZE)
+        jenkins_android_helper_commons.DOWNLOAD_RETRY_DELAY = 0
+
+    def tearDown(self):
+        jenkins_android_helper_commons.DOWNLOAD_RETRIES, jenkins_android_helper_commons.DOWNLOAD_RETRY_DELAY, jenkins_android_helper_commons.DOWNLOAD_PARALLEL_MIN_SIZE = self.saved_settings
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_downloaded(self, checksum):
+        self.assertEqual(checksum, hashlib.sha256(self.data).hexdigest())
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(self.dest + jenkins_android_helper_commons.DOWNLOAD_PART_SUFFIX))
+        self.assertFalse(os.path.exists(self.dest + jenkins_android_helper_commons.DOWNLOAD_PART_STATE_SUFFIX))
+
+    def test_interrupted_range_download_is_resumed_within_the_run(self):
+        self.server.drop_after = [ 1024 * 1024 ]
+
+        checksum = jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024)
+
+        self.assert_downloaded(checksum)
+        self.assertEqual(self.server.requests[-1], "bytes=%d-%d" % (1024 * 1024, len(self.data) - 1))
+
+    def test_interrupted_range_download_is_resumed_by_the_next_run(self):
+        jenkins_android_helper_commons.DOWNLOAD_RETRIES = 0
+        self.server.drop_after = [ 2 * 1024 * 1024 ]
+
+        with self.assertRaises(jenkins_android_helper_commons.DOWNLOAD_ERRORS):
+            jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024)
+        self.assertTrue(os.path.exists(self.dest + jenkins_android_helper_commons.DOWNLOAD_PART_STATE_SUFFIX))
+
+        checksum = jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024)
+
+        self.assert_downloaded(checksum)
+        self.assertEqual(self.server.requests[-1], "bytes=%d-%d" % (2 * 1024 * 1024, len(self.data) - 1))
+
+    def test_interrupted_parallel_download_is_resumed_by_the_next_run(self):
+        jenkins_android_helper_commons.DOWNLOAD_RETRIES = 0
+        jenkins_android_helper_commons.DOWNLOAD_PARALLEL_MIN_SIZE = 1024 * 1024
+        self.server.drop_after = [ 300 * 1024 ]
+
+        with self.assertRaises(jenkins_android_helper_commons.DOWNLOAD_ERRORS):
+            jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024, segments=3)
+
+        checksum = jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024, segments=3)
+
+        self.assert_downloaded(checksum)
+
+    def test_interrupted_single_stream_download_is_restarted(self):
+        self.server.accept_ranges = False
+        self.server.drop_after = [ 1024 * 1024 ]
+
+        checksum = jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024)
+
+        self.assert_downloaded(checksum)
+
+    def test_interrupted_streaming_download_delivers_the_data_in_order(self):
+        self.server.drop_after = [ 1024 * 1024 ]
+        received = []
+
+        checksum = jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024, data_callback=lambda chunk, offset: received.append((offset, chunk)))
+
+        self.assert_downloaded(checksum)
+        # a resumed download delivers every byte exactly once, at increasing offsets
+        self.assertEqual([ offset for offset, chunk in received ], sorted(set([ offset for offset, chunk in received ])))
+        self.assertEqual(b"".join([ chunk for offset, chunk in received ]), self.data)
+
+    def test_concurrent_downloads_to_the_same_file_are_serialized(self):
+        for accept_ranges in [ True, False ]:
+            self.server.accept_ranges = accept_ranges
+            self.server.drop_after = [ 512 * 1024, 512 * 1024 ]
+            checksums = []
+            errors = []
+
+            def download():
+                try:
+                    checksums.append(jenkins_android_helper_commons.download_file(self.url, self.dest, chunk_size=64 * 1024))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [ threading.Thread(target=download) for idx in range(0, 4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(checksums, [ hashlib.sha256(self.data).hexdigest() ] * 4)
+            self.assert_downloaded(checksums[0])
+            # removing it would let a later run lock a different inode than a waiting one
+            self.assertTrue(os.path.exists(self.dest + jenkins_android_helper_commons.DOWNLOAD_PART_SUFFIX + ".lock"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## IniDocument and its (path, mtime, size) cache: a rewritten file is parsed again, and a batch update only
+## touches the updated lines, comments, blank lines, the order and all other keys survive.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ini_helper_functions
+
+CONFIG_INI = """# generated by avdmanager
+avd.ini.encoding=UTF-8
+AvdId=test
+
+; hardware
+hw.lcd.density = 320
+hw.ramSize=1536
+! legacy comment
+hw.ramSize=2048
+image.sysdir.1=system-images/android-24/default/x86_64/
+skin.path=_no_skin
+tag.id=default"""
+
+class IniDocumentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ini_file = os.path.join(self.tmp_dir, "config.ini")
+        self.write(CONFIG_INI)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, content, mtime_ns=None):
+        with open(self.ini_file, "w") as ini_file:
+            ini_file.write(content)
+        if mtime_ns is not None:
+            os.utime(self.ini_file, ns=(mtime_ns, mtime_ns))
+
+    def read(self):
+        with open(self.ini_file) as ini_file:
+            return ini_file.read()
+
+    def test_parse(self):
+        document = ini_helper_functions.ini_file_helper_load(self.ini_file)
+        self.assertEqual(document.get("hw.lcd.density"), "320")
+        # the first of duplicated keys
+        self.assertEqual(document.get("hw.ramSize"), "1536")
+        self.assertEqual(document.get("tag.id"), "default")
+        self.assertIsNone(document.get("# generated by avdmanager"))
+        self.assertEqual(document.keys(), [ "avd.ini.encoding", "AvdId", "hw.lcd.density", "hw.ramSize", "image.sysdir.1", "skin.path", "tag.id" ])
+
+    def test_unchanged_file_is_served_from_the_cache(self):
+        mtime_ns = 1500000000 * 10 ** 9
+        self.write(CONFIG_INI, mtime_ns=mtime_ns)
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "test")
+
+        # same size and mtime, the file is not read again
+        self.write(CONFIG_INI.replace("AvdId=test", "AvdId=tset"), mtime_ns=mtime_ns)
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "test")
+
+    def test_rewritten_file_invalidates_the_cache(self):
+        mtime_ns = 1500000000 * 10 ** 9
+        self.write(CONFIG_INI, mtime_ns=mtime_ns)
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "test")
+
+        # same size, other mtime
+        self.write(CONFIG_INI.replace("AvdId=test", "AvdId=tset"), mtime_ns=mtime_ns + 1)
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "tset")
+
+        # same mtime, other size
+        self.write(CONFIG_INI.replace("AvdId=test", "AvdId=renamed"), mtime_ns=mtime_ns + 1)
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "renamed")
+
+        # replaced by another file
+        other_file = os.path.join(self.tmp_dir, "other.ini")
+        with open(other_file, "w") as other:
+            other.write("AvdId=replaced\n")
+        os.replace(other_file, self.ini_file)
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "replaced")
+
+    def test_changes_are_only_visible_after_save(self):
+        document = ini_helper_functions.ini_file_helper_load(self.ini_file)
+        document.set("AvdId", "changed")
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "test")
+
+        document.save()
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("AvdId"), "changed")
+        self.assertEqual(ini_helper_functions.ini_file_helper_read_all(self.ini_file)["AvdId"], "changed")
+
+    def test_batch_update_keeps_everything_else(self):
+        self.assertTrue(ini_helper_functions.ini_file_helper_add_or_update_key_values(self.ini_file,
+            [ "hw.lcd.density:480", "hw.ramSize:4096", "", None, "hw.keyboard:yes", "image.sysdir.1:system-images/android-27/default/x86_64/" ]))
+
+        self.assertEqual(self.read(), """# generated by avdmanager
+avd.ini.encoding=UTF-8
+AvdId=test
+
+; hardware
+hw.lcd.density=480
+hw.ramSize=4096
+! legacy comment
+image.sysdir.1=system-images/android-27/default/x86_64/
+skin.path=_no_skin
+tag.id=default
+hw.keyboard=yes
+""")
+        self.assertFalse(os.path.exists(self.ini_file + ".tmpout"))
+
+        # the cache holds the saved state
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).lines(), self.read().splitlines(keepends=True))
+
+    def test_batch_update_of_values_with_separators(self):
+        self.assertTrue(ini_helper_functions.ini_file_helper_add_or_update_key_values(self.ini_file, [ "skin.path:C:\\skins\\a=b" ]))
+        self.assertEqual(ini_helper_functions.ini_file_helper_load(self.ini_file).get("skin.path"), "C:\\skins\\a=b")
+        self.assertTrue(ini_helper_functions.ini_file_helper_check_key_for_value(self.ini_file, "skin.path", "C:\\skins\\a=b"))
+
+    def test_missing_file_and_empty_update(self):
+        self.assertFalse(ini_helper_functions.ini_file_helper_add_or_update_key_values(os.path.join(self.tmp_dir, "missing.ini"), [ "a:b" ]))
+        self.assertFalse(ini_helper_functions.ini_file_helper_add_or_update_key_values(self.ini_file, [ "", None ]))
+        self.assertEqual(self.read(), CONFIG_INI)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## many processes lease emulator ports at the same time from one lease directory, like concurrent builds
+## starting their pools. The "emulators" the leases are transferred to are sleeping children of the test,
+## so they can be crashed and reaped by it.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+
+import android_emulator_port_lease_helper_functions
+
+## argv: lease dir, start time, emulator pids; prints the leased ports, one per emulator
+SIMULATED_START = """
+import os, sys, json, time
+import android_emulator_port_lease_helper_functions as lease
+
+lease_dir, start_at, emulators = sys.argv[1], float(sys.argv[2]), [ int(pid) for pid in sys.argv[3:] ]
+time.sleep(max(start_at - time.time(), 0))
+
+ports = lease.port_lease_acquire(lease_dir, len(emulators), os.getpid(), owner="build-%d" % os.getpid())
+for port, emulator in zip(ports, emulators):
+    lease.port_lease_transfer(lease_dir, port, emulator)
+print(json.dumps({ "ports": ports, "emulators": emulators }))
+"""
+
+class PortLeaseConcurrencyTest(unittest.TestCase):
+    STARTS = 16
+    PORTS_PER_START = 2
+
+    def setUp(self):
+        self.lease_dir = tempfile.mkdtemp()
+        self.emulators = {}
+
+    def tearDown(self):
+        for pid in list(self.emulators):
+            self.crash_emulator(pid)
+        shutil.rmtree(self.lease_dir)
+
+    def crash_emulator(self, pid):
+        emulator = self.emulators.pop(pid)
+        emulator.kill()
+        emulator.wait()
+
+    def simulate_starts(self, starts):
+        start_at = time.time() + 1
+        procs = []
+        for idx in range(0, starts):
+            emulators = []
+            for port_idx in range(0, self.PORTS_PER_START):
+                emulator = subprocess.Popen([ "sleep", "60" ])
+                self.emulators[emulator.pid] = emulator
+                emulators = emulators + [ str(emulator.pid) ]
+            procs = procs + [ subprocess.Popen([ sys.executable, "-c", SIMULATED_START, self.lease_dir, str(start_at) ] + emulators,
+                cwd=REPO_DIRECTORY, env=dict(os.environ, PYTHONPATH=REPO_DIRECTORY), stdout=subprocess.PIPE) ]
+
+        results = []
+        for proc in procs:
+            output = proc.communicate()[0]
+            self.assertEqual(proc.returncode, 0)
+            result = json.loads(output.decode("utf-8").splitlines()[-1])
+            self.assertEqual(len(result["ports"]), self.PORTS_PER_START)
+            results = results + [ result ]
+        return results
+
+    def leased_ports(self):
+        return sorted([ int(entry[:-len(android_emulator_port_lease_helper_functions.PORT_LEASE_SUFFIX)]) for entry in os.listdir(self.lease_dir)
+            if entry.endswith(android_emulator_port_lease_helper_functions.PORT_LEASE_SUFFIX) ])
+
+    def test_concurrent_starts_get_distinct_ports(self):
+        results = self.simulate_starts(self.STARTS)
+
+        ports = [ port for result in results for port in result["ports"] ]
+        self.assertEqual(len(ports), self.STARTS * self.PORTS_PER_START)
+        self.assertEqual(len(set(ports)), len(ports))
+        # the adb port is the console port + 1, it must not be the console port of another emulator
+        self.assertEqual(set(ports) & set([ port + 1 for port in ports ]), set())
+        # the starting processes are gone, the leases are held by the emulators
+        self.assertEqual(android_emulator_port_lease_helper_functions.port_lease_reclaim_stale(self.lease_dir), set(ports))
+
+    def test_leases_of_dead_owners_are_reclaimed(self):
+        results = self.simulate_starts(self.STARTS)
+
+        # half of the emulators crash without releasing their ports
+        crashed_ports = []
+        for result in results[:self.STARTS // 2]:
+            for pid in result["emulators"]:
+                self.crash_emulator(pid)
+            crashed_ports = crashed_ports + result["ports"]
+
+        running_ports = set([ port for result in results[self.STARTS // 2:] for port in result["ports"] ])
+        self.assertEqual(android_emulator_port_lease_helper_functions.port_lease_reclaim_stale(self.lease_dir), running_ports)
+        self.assertEqual(self.leased_ports(), sorted(running_ports))
+
+        # new starts reuse the reclaimed ports, never one of the running emulators
+        new_results = self.simulate_starts(self.STARTS // 2)
+        new_ports = [ port for result in new_results for port in result["ports"] ]
+        self.assertEqual(len(set(new_ports)), len(new_ports))
+        self.assertEqual(set(new_ports) & running_ports, set())
+        self.assertEqual(sorted(new_ports), sorted(crashed_ports))
+
+    def test_released_ports_are_free_again(self):
+        results = self.simulate_starts(2)
+        for port in results[0]["ports"]:
+            android_emulator_port_lease_helper_functions.port_lease_release(self.lease_dir, port)
+
+        self.assertEqual(self.leased_ports(), sorted(results[1]["ports"]))
+
+if __name__ == "__main__":
+    unittest.main()
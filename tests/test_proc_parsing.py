@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## the lookup of emulator processes and their listening ports against a fixture /proc directory: socket
+## inodes in fd/, net/tcp and net/tcp6 tables, command lines and stat lines as the kernel writes them.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import android_emulator_helper_functions
+
+PROC_NET_TCP_HEADER = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+
+## listening on 5554 (0x15B2) and 5555 (0x15B3), a connection on 5555 and a listening socket of another process
+PROC_NET_TCP = PROC_NET_TCP_HEADER + """\
+   0: 0100007F:15B2 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 41001 1 0000000000000000 100 0 0 10 0
+   1: 0100007F:15B3 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 41002 1 0000000000000000 100 0 0 10 0
+   2: 0100007F:15B3 0100007F:D2F0 01 00000000:00000000 00:00000000 00000000  1000        0 41003 1 0000000000000000 20 4 30 10 -1
+   3: 00000000:1F90 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 99999 1 0000000000000000 100 0 0 10 0
+"""
+
+## 5554 once more over ipv6 and the grpc port 8554 (0x216A)
+PROC_NET_TCP6 = PROC_NET_TCP_HEADER + """\
+   0: 00000000000000000000000000000000:15B2 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 41004 1 0000000000000000 100 0 0 10 0
+   1: 00000000000000000000000000000000:216A 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 41005 1 0000000000000000 100 0 0 10 0
+"""
+
+EMULATOR_PID = 4711
+
+class ProcParsingTest(unittest.TestCase):
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp()
+        self.saved_proc_dir = android_emulator_helper_functions.PROC_DIRECTORY
+        android_emulator_helper_functions.PROC_DIRECTORY = self.proc_dir
+        android_emulator_helper_functions.android_emulator_invalidate_process_index()
+
+    def tearDown(self):
+        android_emulator_helper_functions.PROC_DIRECTORY = self.saved_proc_dir
+        android_emulator_helper_functions.android_emulator_invalidate_process_index()
+        shutil.rmtree(self.proc_dir)
+
+    def add_process(self, pid, argv, comm="qemu-system-x86", start_time=1234, fds=[], tcp=None, tcp6=None):
+        pid_dir = os.path.join(self.proc_dir, str(pid))
+        os.makedirs(os.path.join(pid_dir, "fd"))
+        os.makedirs(os.path.join(pid_dir, "net"))
+        with open(os.path.join(pid_dir, "cmdline"), "wb") as cmdline:
+            cmdline.write("".join([ arg + "\0" for arg in argv ]).encode("utf-8"))
+        with open(os.path.join(pid_dir, "stat"), "w") as stat:
+            stat.write("%d (%s) S 1 %d %d 0 -1 4194560" % (pid, comm, pid, pid) + " 0" * 12 + " %d" % start_time + " 0" * 30 + "\n")
+        for fd, link in enumerate(fds):
+            os.symlink(link, os.path.join(pid_dir, "fd", str(fd)))
+        for name, content in [ ("tcp", tcp), ("tcp6", tcp6) ]:
+            if content is not None:
+                with open(os.path.join(pid_dir, "net", name), "w") as table:
+                    table.write(content)
+
+    def add_emulator(self):
+        self.add_process(EMULATOR_PID, [ "/sdk/emulator/qemu/linux-x86_64/qemu-system-x86_64", "-avd", "test", "-no-window" ],
+            fds=[ "/dev/null", "socket:[41001]", "pipe:[51000]", "socket:[41002]", "socket:[41003]", "socket:[41004]", "anon_inode:[eventfd]" ],
+            tcp=PROC_NET_TCP, tcp6=PROC_NET_TCP6)
+
+    def test_listening_ports(self):
+        self.add_emulator()
+        self.assertEqual(android_emulator_helper_functions.get_open_ports_for_process_from_proc(EMULATOR_PID), [ "5554", "5555" ])
+        self.assertEqual(android_emulator_helper_functions.android_emulator_detect_used_adb_port_by_pid(EMULATOR_PID), 5554)
+
+    def test_listening_ports_without_ipv6(self):
+        self.add_process(EMULATOR_PID, [ "qemu-system-x86_64", "-avd", "test" ], fds=[ "socket:[41002]" ], tcp=PROC_NET_TCP)
+        self.assertEqual(android_emulator_helper_functions.get_open_ports_for_process_from_proc(EMULATOR_PID), [ "5555" ])
+        self.assertEqual(android_emulator_helper_functions.android_emulator_detect_used_adb_port_by_pid(EMULATOR_PID), -1)
+
+    def test_no_sockets(self):
+        self.add_process(EMULATOR_PID, [ "qemu-system-x86_64", "-avd", "test" ], fds=[ "/dev/null" ], tcp=PROC_NET_TCP)
+        self.assertEqual(android_emulator_helper_functions.get_open_ports_for_process_from_proc(EMULATOR_PID), [])
+
+    def test_process_gone(self):
+        self.assertEqual(android_emulator_helper_functions.get_open_ports_for_process(EMULATOR_PID), [])
+
+    def test_start_time_with_spaces_and_brackets_in_the_name(self):
+        self.add_process(EMULATOR_PID, [ "qemu-system-x86_64" ], comm="qemu (x86) 64", start_time=987654)
+        self.assertEqual(android_emulator_helper_functions.get_process_start_time(EMULATOR_PID), 987654)
+        self.assertEqual(android_emulator_helper_functions.get_process_start_time(EMULATOR_PID + 1), 0)
+
+    def test_scan_running_emulators(self):
+        self.add_emulator()
+        self.add_process(200, [ "/sdk/emulator/qemu/linux-x86_64/qemu-system-x86_64", "-avd", "with-port", "-port", "5556" ], start_time=200)
+        self.add_process(201, [ "qemu-system-aarch64", "-ports", "5560,5561", "-avd", "with ports" ], start_time=201)
+        self.add_process(202, [ "qemu-system-x86_64", "-port", "5562" ])
+        self.add_process(203, [ "/usr/bin/python3", "runner.py", "-avd", "not-an-emulator" ])
+        self.add_process(204, [ "qemu-system-x86_64", "-avd", "bad-port", "-port", "x" ], start_time=204)
+        # kernel thread
+        self.add_process(205, [])
+        os.makedirs(os.path.join(self.proc_dir, "sys"))
+
+        emulators = sorted(android_emulator_helper_functions.android_emulator_scan_running_emulators())
+        AndroidEmulatorProcess = android_emulator_helper_functions.AndroidEmulatorProcess
+        self.assertEqual(emulators, [
+            AndroidEmulatorProcess(pid=200, avd_name="with-port", console_port=5556, adb_port=5557, start_time=200),
+            AndroidEmulatorProcess(pid=201, avd_name="with ports", console_port=5560, adb_port=5561, start_time=201),
+            AndroidEmulatorProcess(pid=204, avd_name="bad-port", console_port=-1, adb_port=-1, start_time=204),
+            AndroidEmulatorProcess(pid=EMULATOR_PID, avd_name="test", console_port=-1, adb_port=-1, start_time=1234) ])
+
+        # exact names only
+        self.assertIsNone(android_emulator_helper_functions.android_emulator_get_process_from_avd_name("with"))
+        self.assertEqual(android_emulator_helper_functions.android_emulator_get_process_from_avd_name("with ports").pid, 201)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## unzip with crafted archives: entries and symlinks pointing outside of the destination are refused, the
+## permissions of files and directories are applied and every entry ends up complete, no matter how the
+## entries are dealt into batches for the workers.
+
+import os
+import sys
+import stat
+import shutil
+import random
+import zipfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jenkins_android_helper_commons
+
+def zip_add(archive, name, data, mode=0o100644, compress_type=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(name, date_time=(2018, 1, 1, 0, 0, 0))
+    info.compress_type = compress_type
+    info.external_attr = mode << 16
+    archive.writestr(info, data)
+
+class UnzipTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp_dir, "archive.zip")
+        self.dest = os.path.join(self.tmp_dir, "dest")
+        os.makedirs(self.dest)
+
+    def tearDown(self):
+        # read-only directories extracted by a test
+        for root, dirs, files in os.walk(self.tmp_dir):
+            for dir_name in dirs:
+                os.chmod(os.path.join(root, dir_name), 0o755)
+        shutil.rmtree(self.tmp_dir)
+
+    def create_archive(self, entries):
+        with zipfile.ZipFile(self.archive, "w") as archive:
+            for entry in entries:
+                zip_add(archive, *entry)
+
+    def assert_extracted_like_zipfile(self):
+        with zipfile.ZipFile(self.archive) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with open(os.path.join(self.dest, info.filename), "rb") as extracted:
+                    self.assertEqual(extracted.read(), archive.read(info), info.filename)
+
+    def test_path_traversal(self):
+        for name in [ "../outside", "lib/../../outside", "/tmp/absolute-outside" ]:
+            self.create_archive([ ("inside", b"ok"), (name, b"evil") ])
+            with self.assertRaises(ValueError):
+                jenkins_android_helper_commons.unzip(self.archive, self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "outside")))
+        self.assertFalse(os.path.exists("/tmp/absolute-outside"))
+
+    def test_symlink_escape(self):
+        for link_target in [ "../../outside", "/etc/passwd" ]:
+            self.create_archive([ ("lib/file", b"content"), ("lib/link", link_target.encode("utf-8"), 0o120777) ])
+            with self.assertRaises(ValueError):
+                jenkins_android_helper_commons.unzip(self.archive, self.dest)
+            self.assertFalse(os.path.lexists(os.path.join(self.dest, "lib", "link")))
+
+    def test_symlink_inside(self):
+        self.create_archive([ ("lib/file", b"content"), ("lib/sub/link", b"../file", 0o120777) ])
+        jenkins_android_helper_commons.unzip(self.archive, self.dest)
+
+        link = os.path.join(self.dest, "lib", "sub", "link")
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.readlink(link), "../file")
+        with open(link, "rb") as linked:
+            self.assertEqual(linked.read(), b"content")
+
+    def test_permission_bits(self):
+        self.create_archive([ ("bin/", b"", 0o40555), ("bin/tool", b"#!/bin/sh\n", 0o100755), ("bin/data", b"data", 0o100640),
+            ("doc/readme", b"readme", 0o100444), ("no-mode", b"no mode", 0) ])
+        jenkins_android_helper_commons.unzip(self.archive, self.dest)
+
+        def mode(name):
+            return stat.S_IMODE(os.stat(os.path.join(self.dest, name)).st_mode)
+        self.assertEqual(mode("bin"), 0o555)
+        self.assertEqual(mode("bin/tool"), 0o755)
+        self.assertEqual(mode("bin/data"), 0o640)
+        self.assertEqual(mode("doc/readme"), 0o444)
+        # without a mode in the archive the umask applies
+        self.assertTrue(mode("no-mode") & stat.S_IRUSR)
+
+    def test_batching(self):
+        # more entries than fit into the batches of the workers, sizes from empty to bigger than a chunk
+        rnd = random.Random(1)
+        entries = []
+        for idx in range(0, 5 * jenkins_android_helper_commons.UNZIP_BATCH_SIZE + 3):
+            size = rnd.choice([ 0, 1, 100, 4096, 3 * jenkins_android_helper_commons.UNZIP_CHUNK_SIZE + 7 ])
+            entries.append(("dir%02d/file%04d" % (idx % 13, idx), rnd.getrandbits(8 * size).to_bytes(size, "little") if size > 0 else b"",
+                0o100644, zipfile.ZIP_STORED if idx % 3 == 0 else zipfile.ZIP_DEFLATED))
+        self.create_archive(entries)
+
+        for workers in [ 1, 4, 16 ]:
+            shutil.rmtree(self.dest)
+            jenkins_android_helper_commons.unzip(self.archive, self.dest, workers=workers)
+            self.assert_extracted_like_zipfile()
+            self.assertEqual(sum([ len(files) for root, dirs, files in os.walk(self.dest) ]), len(entries))
+
+    def test_fewer_entries_than_workers(self):
+        self.create_archive([ ("only", b"one entry") ])
+        jenkins_android_helper_commons.unzip(self.archive, self.dest, workers=8)
+        self.assert_extracted_like_zipfile()
+
+    def test_empty_archive(self):
+        self.create_archive([])
+        jenkins_android_helper_commons.unzip(self.archive, self.dest, workers=8)
+        self.assertEqual(os.listdir(self.dest), [])
+
+if __name__ == "__main__":
+    unittest.main()
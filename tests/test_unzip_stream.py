@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## UnzipStream fed with archives in chunks of arbitrary sizes, like a download delivers them, followed by
+## unzip_apply_attributes on the complete archive. The result has to be the same as extracting with zipfile,
+## input the stream can't handle has to end in a failed finish(), so the caller falls back to unzip.
+
+import io
+import os
+import sys
+import stat
+import shutil
+import random
+import zipfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jenkins_android_helper_commons
+
+## zipfile writes a data descriptor after every entry, if it can't seek back to the local header
+class UnseekableOutput(io.RawIOBase):
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.data.write(data)
+
+def entry_data(rnd, size):
+    # half compressible, half random
+    if rnd.random() < 0.5:
+        return (b"some repeated text for deflate " * (size // 31 + 1))[:size]
+    return rnd.getrandbits(8 * size).to_bytes(size, "little") if size > 0 else b""
+
+def build_archive(entries, seekable=True, force_zip64=False):
+    output = io.BytesIO() if seekable else UnseekableOutput()
+    with zipfile.ZipFile(output, "w") as archive:
+        for name, data, mode, compress_type in entries:
+            info = zipfile.ZipInfo(name, date_time=(2018, 1, 1, 0, 0, 0))
+            info.compress_type = compress_type
+            info.external_attr = mode << 16
+            if name.endswith("/"):
+                archive.writestr(info, b"")
+                continue
+            with archive.open(info, "w", force_zip64=force_zip64) as entry:
+                entry.write(data)
+    return output.data.getvalue() if not seekable else output.getvalue()
+
+def random_entries(seed, count, compress_types):
+    rnd = random.Random(seed)
+    entries = [ ("lib/", b"", 0o40755, zipfile.ZIP_STORED) ]
+    for idx in range(0, count):
+        size = rnd.choice([ 0, 1, 1000, 70000, 3 * jenkins_android_helper_commons.UNZIP_CHUNK_SIZE + 11 ])
+        entries.append(("lib/dir%d/file%03d" % (idx % 3, idx), entry_data(rnd, size), rnd.choice([ 0o100644, 0o100755 ]), compress_types[idx % len(compress_types)]))
+    return entries
+
+class UnzipStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp_dir, "archive.zip")
+        self.dest = os.path.join(self.tmp_dir, "stream")
+        self.reference = os.path.join(self.tmp_dir, "reference")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    ## feeds the archive in chunks of the given sizes (repeated), returns what finish() returned
+    def stream(self, data, chunk_sizes):
+        with open(self.archive, "wb") as archive_file:
+            archive_file.write(data)
+
+        shutil.rmtree(self.dest, ignore_errors=True)
+        stream = jenkins_android_helper_commons.UnzipStream(self.dest)
+        offset = 0
+        idx = 0
+        while offset < len(data):
+            chunk = data[offset:offset + chunk_sizes[idx % len(chunk_sizes)]]
+            stream.feed(chunk, offset)
+            offset = offset + len(chunk)
+            idx = idx + 1
+        return stream.finish()
+
+    def assert_same_as_zipfile(self):
+        self.assertTrue(jenkins_android_helper_commons.unzip_apply_attributes(self.archive, self.dest))
+
+        shutil.rmtree(self.reference, ignore_errors=True)
+        with zipfile.ZipFile(self.archive) as archive:
+            archive.extractall(self.reference)
+            for info in archive.infolist():
+                extracted = os.path.join(self.dest, info.filename)
+                mode = info.external_attr >> 16
+                if stat.S_ISLNK(mode):
+                    self.assertEqual(os.readlink(extracted), archive.read(info).decode("utf-8"))
+                    continue
+                if stat.S_IMODE(mode) != 0:
+                    self.assertEqual(stat.S_IMODE(os.lstat(extracted).st_mode), stat.S_IMODE(mode), info.filename)
+                if info.is_dir():
+                    self.assertTrue(os.path.isdir(extracted))
+                    continue
+                with open(extracted, "rb") as extracted_file, open(os.path.join(self.reference, info.filename), "rb") as reference_file:
+                    self.assertEqual(extracted_file.read(), reference_file.read(), info.filename)
+
+        streamed = sorted([ os.path.relpath(os.path.join(root, name), self.dest) for root, dirs, files in os.walk(self.dest) for name in dirs + files ])
+        extracted = sorted([ os.path.relpath(os.path.join(root, name), self.reference) for root, dirs, files in os.walk(self.reference) for name in dirs + files ])
+        self.assertEqual(streamed, extracted)
+
+    def test_stored_and_deflated_in_arbitrary_chunks(self):
+        data = build_archive(random_entries(1, 12, [ zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED ]))
+        for chunk_sizes in [ [ len(data) ], [ 65536 ], [ 4096 ], [ 1, 7, 30, 4093, 65537 ], [ 3 ] ]:
+            self.assertTrue(self.stream(data, chunk_sizes), chunk_sizes)
+            self.assert_same_as_zipfile()
+
+    def test_data_descriptors(self):
+        data = build_archive(random_entries(2, 12, [ zipfile.ZIP_DEFLATED ]), seekable=False)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertTrue(all([ info.flag_bits & jenkins_android_helper_commons.ZIP_FLAG_DATA_DESCRIPTOR for info in archive.infolist() if not info.is_dir() ]))
+
+        for chunk_sizes in [ [ 65536 ], [ 5, 11, 4099 ] ]:
+            self.assertTrue(self.stream(data, chunk_sizes), chunk_sizes)
+            self.assert_same_as_zipfile()
+
+    def test_zip64(self):
+        for seekable in [ True, False ]:
+            data = build_archive(random_entries(3, 6, [ zipfile.ZIP_DEFLATED ]), seekable=seekable, force_zip64=True)
+            self.assertTrue(self.stream(data, [ 1000, 13 ]))
+            self.assert_same_as_zipfile()
+
+    def test_symlink(self):
+        data = build_archive([ ("bin/tool", b"#!/bin/sh\n", 0o100755, zipfile.ZIP_DEFLATED), ("tool", b"bin/tool", 0o120777, zipfile.ZIP_STORED) ])
+        self.assertTrue(self.stream(data, [ 10 ]))
+        self.assert_same_as_zipfile()
+        self.assertTrue(os.path.islink(os.path.join(self.dest, "tool")))
+
+    def test_stored_entry_with_data_descriptor_is_unsupported(self):
+        data = build_archive(random_entries(4, 3, [ zipfile.ZIP_STORED ]), seekable=False)
+        self.assertFalse(self.stream(data, [ 4096 ]))
+
+    def test_unsupported_compression_is_unsupported(self):
+        data = build_archive(random_entries(5, 3, [ zipfile.ZIP_BZIP2 ]))
+        self.assertFalse(self.stream(data, [ 4096 ]))
+
+    def test_restarted_download_is_unsupported(self):
+        data = build_archive(random_entries(6, 3, [ zipfile.ZIP_DEFLATED ]))
+        stream = jenkins_android_helper_commons.UnzipStream(self.dest)
+        stream.feed(data[:1000], 0)
+        # the download started over
+        stream.feed(data[:1000], 0)
+        stream.feed(data[1000:], 1000)
+        self.assertFalse(stream.finish())
+
+        stream = jenkins_android_helper_commons.UnzipStream(self.dest)
+        stream.feed(data[:1000], 0)
+        stream.feed(None, 0)
+        self.assertFalse(stream.finish())
+
+    def test_truncated_archive_fails(self):
+        data = build_archive(random_entries(7, 3, [ zipfile.ZIP_DEFLATED ]))
+        self.assertFalse(self.stream(data[:len(data) // 2], [ 4096 ]))
+
+    def test_corrupted_entry_fails(self):
+        data = bytearray(build_archive([ ("file", b"x" * 1000, 0o100644, zipfile.ZIP_STORED) ]))
+        # a byte of the stored content, the crc does not match any more
+        data[60] = data[60] ^ 0xFF
+        self.assertFalse(self.stream(bytes(data), [ 4096 ]))
+
+    def test_missing_entry_is_reported_by_apply_attributes(self):
+        data = build_archive(random_entries(8, 3, [ zipfile.ZIP_DEFLATED ]))
+        self.assertTrue(self.stream(data, [ 4096 ]))
+        os.remove(os.path.join(self.dest, "lib", "dir1", "file001"))
+        self.assertFalse(jenkins_android_helper_commons.unzip_apply_attributes(self.archive, self.dest))
+
+if __name__ == "__main__":
+    unittest.main()
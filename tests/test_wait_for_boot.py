@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# This file is part of Jenkins-Android-Emulator Helper.
+#    Copyright (C) 2018  Michael Musenbrock
+#
+# Jenkins-Android-Helper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Jenkins-Android-Helper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Jenkins-Android-Helper.  If not, see <http://www.gnu.org/licenses/>.
+
+## android_emulator_wait_for_boot against the minimal adb server of test_adb_client, the boot poll script
+## runs in a local sh with a 'getprop' stub in the PATH, which answers from one file per property.
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import android_adb_client
+import android_emulator_helper_functions
+from test_adb_client import FakeAdbServer, SERIAL
+
+STUB_GETPROP = """#!/bin/sh
+cat "$BOOT_PROPS/$1" 2>/dev/null
+"""
+
+class WaitForBootTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp_dir, "bin")
+        self.props_dir = os.path.join(self.tmp_dir, "props")
+        os.makedirs(bin_dir)
+        os.makedirs(self.props_dir)
+        with open(os.path.join(bin_dir, "getprop"), 'w') as getprop:
+            getprop.write(STUB_GETPROP)
+        os.chmod(os.path.join(bin_dir, "getprop"), 0o755)
+
+        self.set_props(bootanim="running")
+        self.server = FakeAdbServer(env=dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"], BOOT_PROPS=self.props_dir))
+        self.client = android_adb_client.AdbClient(port=self.server.port, timeout=1)
+        self.timers = []
+
+    def tearDown(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def set_props(self, boot_completed="", bootanim=""):
+        for prop, value in [ ("sys.boot_completed", boot_completed), ("init.svc.bootanim", bootanim) ]:
+            with open(os.path.join(self.props_dir, prop), 'w') as prop_file:
+                prop_file.write(value + "\n")
+
+    def after(self, seconds, function, *args, **kwargs):
+        timer = threading.Timer(seconds, function, args=args, kwargs=kwargs)
+        self.timers.append(timer)
+        timer.start()
+
+    ## (result, seconds taken, output)
+    def wait_for_boot(self, timeout, cancel=None):
+        output = io.StringIO()
+        start = time.monotonic()
+        with contextlib.redirect_stdout(output):
+            result = android_emulator_helper_functions.android_emulator_wait_for_boot("adb", SERIAL, timeout, adb_client=self.client, cancel=cancel)
+        return result, time.monotonic() - start, output.getvalue()
+
+    def test_boot_completed(self):
+        self.after(0.5, self.set_props, boot_completed="1", bootanim="running")
+        self.after(1.0, self.set_props, boot_completed="1", bootanim="stopped")
+
+        result, seconds, output = self.wait_for_boot(30)
+        self.assertTrue(result)
+        self.assertLess(seconds, 5)
+        self.assertIn("Boot state of [%s]: sys.boot_completed=[1] init.svc.bootanim=[running]" % SERIAL, output)
+        self.assertIn("Emulator [%s] finished booting" % SERIAL, output)
+        # one poll script for the whole boot
+        self.assertEqual(len([ service for service in self.server.services if service.startswith("shell:") ]), 1)
+
+    def test_timeout_at_the_deadline(self):
+        result, seconds, output = self.wait_for_boot(2)
+        self.assertFalse(result)
+        self.assertGreaterEqual(seconds, 2)
+        self.assertLess(seconds, 2 + 2 * android_emulator_helper_functions.ANDROID_EMULATOR_BOOT_RESTART_DELAY)
+        self.assertNotIn("finished booting", output)
+
+    def test_timeout_for_an_unknown_device(self):
+        self.server.close()
+        result, seconds, output = self.wait_for_boot(1.5)
+        self.assertFalse(result)
+        self.assertLess(seconds, 1.5 + 2 * android_emulator_helper_functions.ANDROID_EMULATOR_BOOT_RESTART_DELAY)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        self.after(1.0, cancel.set)
+
+        result, seconds, output = self.wait_for_boot(30, cancel=cancel)
+        self.assertFalse(result)
+        self.assertLess(seconds, 1.0 + 2 * android_emulator_helper_functions.ANDROID_EMULATOR_BOOT_CANCEL_INTERVAL + android_emulator_helper_functions.ANDROID_EMULATOR_BOOT_RESTART_DELAY)
+        self.assertIn("Waiting for the boot of [%s] was cancelled" % SERIAL, output)
+
+if __name__ == "__main__":
+    unittest.main()